@@ -0,0 +1,190 @@
+# Copyright (C) 2019 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Accounting for the work done by a publication.
+
+A ReleasePublisher counts the bytes it copies, links, hashes, and feeds to
+zsync and torrent generation, and the files it signs.  Dry runs count what
+they would have done, so the totals are an estimate of the real run; real
+runs count the same things in the same way and add them, with the time
+taken, to a history from which later estimates predict how long a
+publication will take.
+"""
+
+from __future__ import print_function
+
+import errno
+import os
+import threading
+import time
+
+from cdimage.atomicfile import AtomicFile
+from cdimage import osextras
+
+__metaclass__ = type
+
+
+# (name, description, unit)
+cost_fields = (
+    ("copied", "copied", "bytes"),
+    ("linked", "linked", "bytes"),
+    ("hashed", "hashed", "bytes"),
+    ("zsync", "read for zsync metafiles", "bytes"),
+    ("torrent", "read for torrents", "bytes"),
+    ("signed", "signed", "files"),
+)
+
+# Counters that involve a pass over image data, and so dominate the time
+# taken.  Linking and signing are cheap by comparison.
+work_fields = ("copied", "hashed", "zsync", "torrent")
+
+
+class PublishCost:
+    """Counters for the work done (or to be done) by a publication."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = dict((name, 0) for name, _, _ in cost_fields)
+        # Sizes of files that a dry run would have created.
+        self.sizes = {}
+        self.digested = set()
+
+    def __getitem__(self, name):
+        with self.lock:
+            return self.counters[name]
+
+    def add(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def record_size(self, path, size):
+        """Record that path has (or would have) size bytes."""
+        with self.lock:
+            self.sizes[path] = size
+
+    def size(self, path):
+        """Return the size of path, or zero if it does not exist.
+
+        Files that a dry run only pretended to create have the size they
+        would have had.
+        """
+        with self.lock:
+            if path in self.sizes:
+                return self.sizes[path]
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    def exists(self, path):
+        """Return True if path exists, or a dry run pretended to create it."""
+        with self.lock:
+            if path in self.sizes:
+                return True
+        return os.path.exists(path)
+
+    def first_digest(self, path):
+        """Return True the first time path is seen.
+
+        Digests are cached, so only the first time a file is stored needs
+        to read it.
+        """
+        with self.lock:
+            if path in self.digested:
+                return False
+            self.digested.add(path)
+            return True
+
+    @property
+    def work(self):
+        """The number of bytes that must be read or written."""
+        with self.lock:
+            return sum(self.counters[name] for name in work_fields)
+
+    def describe(self):
+        """Yield a line of text for each counter."""
+        with self.lock:
+            counters = dict(self.counters)
+        for name, description, unit in cost_fields:
+            if unit == "bytes":
+                yield "%.1f MiB %s" % (
+                    counters[name] / 1024.0 / 1024.0, description)
+            else:
+                yield "%d %s %s" % (counters[name], unit, description)
+
+
+class PublishHistory:
+    """The cost and duration of recent publications.
+
+    Each line of the history file is a timestamp, the elapsed time in
+    seconds, and a name=value pair for each counter.  Only the most recent
+    entries are kept.
+    """
+
+    def __init__(self, path, keep=20):
+        self.path = path
+        self.keep = keep
+
+    def _read(self):
+        entries = []
+        try:
+            with open(self.path) as history:
+                for line in history:
+                    fields = line.split()
+                    try:
+                        entries.append((
+                            int(fields[0]), float(fields[1]),
+                            dict((name, int(value)) for name, value in (
+                                field.split("=", 1) for field in fields[2:]))))
+                    except (IndexError, ValueError):
+                        continue
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        return entries[-self.keep:]
+
+    def entries(self):
+        """Return a list of (elapsed, counters) pairs, oldest first."""
+        return [(elapsed, counters) for _, elapsed, counters in self._read()]
+
+    def record(self, cost, elapsed, now=None):
+        """Add a publication that did cost's work in elapsed seconds."""
+        if now is None:
+            now = time.time()
+        entries = self._read()
+        entries.append((
+            int(now), elapsed,
+            dict((name, cost[name]) for name, _, _ in cost_fields)))
+        osextras.ensuredir(os.path.dirname(self.path))
+        with AtomicFile(self.path) as history:
+            for entry_time, entry_elapsed, counters in entries[-self.keep:]:
+                print(entry_time, "%.1f" % entry_elapsed, " ".join(
+                    "%s=%d" % (name, counters.get(name, 0))
+                    for name, _, _ in cost_fields), file=history)
+
+    def predict(self, cost):
+        """Predict the seconds a publication doing cost's work will take.
+
+        This assumes that time is proportional to the bytes read and
+        written, at the average rate of recent publications.  Return None
+        if there is no useful history.
+        """
+        entries = self.entries()
+        total_elapsed = sum(elapsed for elapsed, _ in entries)
+        total_work = sum(
+            sum(counters.get(name, 0) for name in work_fields)
+            for _, counters in entries)
+        if not total_work:
+            return None
+        return cost.work * total_elapsed / total_work
@@ -16,6 +16,7 @@
 """Atomic writing of files."""
 
 import codecs
+import hashlib
 import io
 import os
 import sys
@@ -23,11 +24,54 @@ import sys
 __metaclass__ = type
 
 
+class _DigestingWriter:
+    """Wrap a text file, computing a digest of its encoded contents."""
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, s):
+        data = s.encode("UTF-8", "replace")
+        self.digest.update(data)
+        self.size += len(data)
+        self.fd.write(s)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        self.fd.flush()
+
+
+def _same_contents(path, size, digest):
+    try:
+        if os.stat(path).st_size != size:
+            return False
+        existing = hashlib.sha256()
+        with open(path, "rb") as existing_file:
+            for buf in iter(lambda: existing_file.read(64 * 1024), b""):
+                existing.update(buf)
+    except (IOError, OSError):
+        return False
+    return existing.digest() == digest.digest()
+
+
 class AtomicFile:
-    """Facilitate atomic writing of files.  Forces UTF-8 encoding."""
+    """Facilitate atomic writing of files.  Forces UTF-8 encoding.
 
-    def __init__(self, filename):
+    With only_if_changed=True, the existing file is left untouched (keeping
+    its inode and modification time) if the new contents are identical.
+    Afterwards, the changed attribute records whether the file was
+    replaced.
+    """
+
+    def __init__(self, filename, only_if_changed=False):
         self.filename = filename
+        self.only_if_changed = only_if_changed
+        self.changed = False
         if sys.version_info[0] < 3:
             self.fd = codecs.open(
                 '%s.new' % self.filename, 'w', 'UTF-8', 'replace')
@@ -37,15 +81,24 @@ class AtomicFile:
             self.fd = io.open(
                 '%s.new' % self.filename, mode='w',
                 encoding='UTF-8', errors='replace')
+        if only_if_changed:
+            self.writer = _DigestingWriter(self.fd)
+        else:
+            self.writer = self.fd
 
     def __enter__(self):
-        return self.fd
+        return self.writer
 
     def __exit__(self, exc_type, unused_exc_value, unused_exc_tb):
         self.fd.close()
         if exc_type is None:
-            os.rename('%s.new' % self.filename, self.filename)
+            if self.only_if_changed and _same_contents(
+                    self.filename, self.writer.size, self.writer.digest):
+                os.unlink('%s.new' % self.filename)
+            else:
+                os.rename('%s.new' % self.filename, self.filename)
+                self.changed = True
 
     # Not really necessary, but reduces pychecker confusion.
     def write(self, s):
-        self.fd.write(s)
+        self.writer.write(s)
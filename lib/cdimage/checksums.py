@@ -23,6 +23,7 @@ import re
 import subprocess
 
 from cdimage.atomicfile import AtomicFile
+from cdimage.fanout import FanoutReader
 from cdimage.sign import can_sign, sign_cdimage
 
 __metaclass__ = type
@@ -46,6 +47,12 @@ def apply_sed(text, expression):
         sed.wait()
 
 
+def file_key(path):
+    """Return a key that changes whenever path is modified or replaced."""
+    st = os.stat(path)
+    return st.st_dev, st.st_ino, st.st_size, st.st_mtime
+
+
 class ChecksumFile:
     """Manipulate a single checksum file."""
 
@@ -71,14 +78,10 @@ class ChecksumFile:
                     self.entries[bits[1]] = bits[0]
 
     def checksum(self, entry_path):
-        with open(entry_path, "rb") as fh:
-            hash_obj = self.hash_method()
-            while True:
-                buf = fh.read(16 * 1024)
-                if not buf:
-                    break
-                hash_obj.update(buf)
-            return hash_obj.hexdigest()
+        reader = FanoutReader(entry_path)
+        hash_obj = reader.add(self.name, self.hash_method())
+        reader.run()
+        return hash_obj.hexdigest()
 
     def _entry_time(self, path, default):
         try:
@@ -87,17 +90,23 @@ class ChecksumFile:
         except OSError:
             return default
 
-    def add(self, entry_name):
+    def needs_checksum(self, entry_name):
+        """Return true if entry_name is missing or its checksum is stale."""
         try:
             this_time = os.stat(self.path).st_mtime
         except OSError:
             this_time = None
         entry_path = os.path.join(self.directory, entry_name)
         entry_time = self._entry_time(entry_path, None)
-        if (entry_name not in self.entries or
+        return (
+            entry_name not in self.entries or
             (this_time is not None and entry_time is not None and
-             entry_time > this_time)):
-            self.entries[entry_name] = self.checksum(entry_path)
+             entry_time > this_time))
+
+    def add(self, entry_name):
+        if self.needs_checksum(entry_name):
+            self.entries[entry_name] = self.checksum(
+                os.path.join(self.directory, entry_name))
             self.changed = True
 
     def remove(self, entry_name):
@@ -154,11 +163,14 @@ class ChecksumFile:
         if not self.changed:
             return
         if self.entries:
-            with AtomicFile(self.path) as checksums:
+            atomic_file = AtomicFile(self.path, only_if_changed=True)
+            with atomic_file as checksums:
                 for entry_name in sorted(self.entries):
                     print("%s *%s" % (self.entries[entry_name], entry_name),
                           file=checksums)
-            if self.sign:
+            if self.sign and (
+                    atomic_file.changed or
+                    not os.path.exists("%s.gpg" % self.path)):
                 sign_cdimage(self.config, self.path)
         else:
             try:
@@ -184,10 +196,13 @@ class ChecksumFileSet:
         "SHA256SUMS": hashlib.sha256,
     }
 
-    def __init__(self, config, directory, sign=True):
+    def __init__(self, config, directory, sign=True, known=None):
         self.config = config
         self.directory = directory
         self.sign = sign
+        # Checksums already computed elsewhere, as a dictionary mapping
+        # file_key(path) to a dictionary of checksum file names to digests.
+        self.known = known or {}
         self.checksum_files = [
             ChecksumFile(config, directory, filename, hash_method, sign=sign)
             for filename, hash_method in self.checksum_file_methods.items()]
@@ -196,9 +211,37 @@ class ChecksumFileSet:
         for checksum_file in self.checksum_files:
             checksum_file.read()
 
-    def add(self, entry_name):
-        for checksum_file in self.checksum_files:
-            checksum_file.add(entry_name)
+    def add(self, entry_name, checksum_files=None):
+        """Add entry_name to the checksum files that need it.
+
+        If checksum_files is given, only those are considered.  All the
+        missing checksums are computed in a single read of the entry,
+        unless they are already known.
+        """
+        if checksum_files is None:
+            checksum_files = self.checksum_files
+        entry_path = os.path.join(self.directory, entry_name)
+        known = {}
+        if self.known and os.path.exists(entry_path):
+            known = self.known.get(file_key(entry_path), {})
+        reader = FanoutReader(entry_path)
+        hash_objs = []
+        for checksum_file in checksum_files:
+            if not checksum_file.needs_checksum(entry_name):
+                continue
+            if checksum_file.name in known:
+                checksum_file.entries[entry_name] = known[checksum_file.name]
+                checksum_file.changed = True
+            else:
+                hash_obj = reader.add(
+                    checksum_file.name, checksum_file.hash_method())
+                hash_objs.append((checksum_file, hash_obj))
+        if not hash_objs:
+            return
+        reader.run()
+        for checksum_file, hash_obj in hash_objs:
+            checksum_file.entries[entry_name] = hash_obj.hexdigest()
+            checksum_file.changed = True
 
     def remove(self, entry_name):
         for checksum_file in self.checksum_files:
@@ -265,22 +308,68 @@ class MetalinkChecksumFileSet(ChecksumFileSet):
 
     def want_image(self, image):
         """Return true if and only if we want to checksum this image."""
-        return image.endswith(".metalink")
+        return image.endswith(".metalink") or image.endswith(".meta4")
 
 
 def checksum_directory(config, directory, old_directories=None, sign=True,
-                       map_expr=None):
+                       map_expr=None, known=None):
     if old_directories is None:
         old_directories = [directory]
 
     # We don't want to read the existing checksum files directly, as they
     # may contain stale checksums; so we don't use the context manager form
     # here.
-    checksum_files = ChecksumFileSet(config, directory, sign=sign)
+    checksum_files = ChecksumFileSet(
+        config, directory, sign=sign, known=known)
     checksum_files.merge_all(old_directories, map_expr=map_expr)
     checksum_files.write()
 
 
+def update_checksum_directory(config, directory, sources, sign=True):
+    """Update checksums for a directory in which only some entries changed.
+
+    sources maps each changed entry to another directory whose checksum
+    files already describe an entry of the same name (typically the
+    directory that it is a symlink into).  Checksums for those entries are
+    copied from there, falling back to checksumming the entry itself;
+    checksums for all other entries are kept as they are.
+    """
+    checksum_files = ChecksumFileSet(config, directory, sign=sign)
+    checksum_files.read()
+    images = set(
+        name for name in os.listdir(directory)
+        if checksum_files.want_image(name))
+    source_files = {}
+    # Entries that must be checksummed, and the files that need them; each
+    # is read once, however many files need it.
+    missing = {}
+    for checksum_file in checksum_files.checksum_files:
+        for entry_name in set(checksum_file.entries) - images:
+            checksum_file.remove(entry_name)
+        for entry_name in sorted(images):
+            source = sources.get(entry_name)
+            if source is None and entry_name in checksum_file.entries:
+                continue
+            checksum_file.entries.pop(entry_name, None)
+            if source is not None:
+                key = (source, checksum_file.name)
+                if key not in source_files:
+                    source_files[key] = ChecksumFile(
+                        config, source, checksum_file.name,
+                        checksum_file.hash_method, sign=False)
+                    source_files[key].read()
+                source_entries = source_files[key].entries
+                if entry_name in source_entries:
+                    checksum_file.entries[entry_name] = (
+                        source_entries[entry_name])
+                    checksum_file.changed = True
+                    continue
+            missing.setdefault(entry_name, []).append(checksum_file)
+    for entry_name in sorted(missing):
+        checksum_files.add(entry_name, missing[entry_name])
+    checksum_files.write()
+
+
 def metalink_checksum_directory(config, directory, old_directories=None,
                                 sign=True):
     if old_directories is None:
@@ -20,12 +20,18 @@ to co-exist until such time as the whole of cdimage is rewritten.
 """
 
 from collections import Iterable, defaultdict
+import errno
 import fnmatch
+import json
 import operator
 import os
+import re
 import sys
+import tempfile
+import time
 
 from cdimage import osextras
+from cdimage.filecache import load_cached
 
 __metaclass__ = type
 
@@ -204,6 +210,12 @@ all_series.extend([
         distribution="ubuntu-rtm"),
 ])
 
+# Ubuntu Core series, with the first Ubuntu series that builds each.
+core_series_starts = [
+    ("16", "xenial"),
+    ("18", "bionic"),
+]
+
 all_touch_targets = []
 
 
@@ -235,6 +247,134 @@ all_touch_targets.extend([
     Touch("flo", "armel", "armhf"),
 ])
 
+
+def compile_glob(pattern):
+    """Return a predicate equivalent to fnmatch.fnmatchcase(_, pattern)."""
+    if not re.search(r"[*?[]", pattern):
+        return compile_exact(pattern)
+    match = re.compile(fnmatch.translate(pattern)).match
+    return lambda name: match(name) is not None
+
+
+def compile_exact(pattern):
+    """Return a predicate matching only pattern itself."""
+    return lambda name: name == pattern
+
+
+def compile_arch(pattern):
+    """Return a predicate matching architectures against pattern.
+
+    Patterns containing "+" are matched against the full architecture name
+    including any subarchitecture; others are matched against the CPU
+    architecture alone.
+    """
+    match = compile_glob(pattern)
+    if "+" in pattern:
+        return match
+    return lambda arch: match(arch.split("+", 1)[0])
+
+
+def compile_series(pattern):
+    """Return a predicate equivalent to Config.match_series(pattern).
+
+    The predicate takes a Config.  Ranges are resolved against all_series
+    once here rather than on every call.
+    """
+    if "/" in pattern:
+        distribution, series = pattern.split("/", 1)
+    else:
+        distribution, series = None, pattern
+
+    if series == "*":
+        match = None
+    elif "-" in series:
+        series_start, series_end = series.split("-", 1)
+        in_range = not series_start
+        names = set()
+        seen = set()
+        for tryseries in all_series:
+            if tryseries.distribution != (distribution or "ubuntu"):
+                continue
+            if tryseries.name == series_start:
+                in_range = True
+            if tryseries.name not in seen:
+                seen.add(tryseries.name)
+                if in_range:
+                    names.add(tryseries.name)
+            if tryseries.name == series_end:
+                in_range = False
+        match = names.__contains__
+    else:
+        match = compile_exact(series)
+
+    def match_series(config):
+        if distribution is not None and distribution != config.distribution:
+            return False
+        return match is None or match(config.series)
+
+    return match_series
+
+
+class RuleFormat:
+    """A file of whitespace-separated rules.
+
+    Each non-comment line has one field per column followed by a value
+    (which may contain spaces).  Columns are functions compiling a field
+    into a predicate, such as compile_glob or compile_series.  Parsed files
+    are cached until they change on disk.
+    """
+
+    def __init__(self, *columns):
+        self.columns = columns
+
+    def __call__(self, path):
+        rules = []
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                fields = line.split(None, len(self.columns))
+                if len(fields) != len(self.columns) + 1:
+                    continue
+                rules.append((
+                    tuple(compile_field(field) for compile_field, field in
+                          zip(self.columns, fields)),
+                    fields[-1]))
+        return rules
+
+    def matches(self, path, *wanted):
+        """Yield the values of all rules in path matching wanted, in order.
+
+        wanted has one item per column: a string, or a Config for
+        compile_series columns.  A missing file has no rules.
+        """
+        try:
+            rules = load_cached(path, self)
+        except OSError:
+            return
+        for predicates, value in rules:
+            for predicate, item in zip(predicates, wanted):
+                if not predicate(item):
+                    break
+            else:
+                yield value
+
+    def first_match(self, path, *wanted):
+        """Return the value of the first rule in path matching wanted."""
+        for value in self.matches(path, *wanted):
+            return value
+        return None
+
+
+default_arches_rules = RuleFormat(compile_glob, compile_glob, compile_series)
+current_triggers_rules = RuleFormat(
+    compile_exact, compile_exact, compile_series)
+livefs_launchpad_rules = RuleFormat(
+    compile_glob, compile_glob, compile_series, compile_arch)
+livefs_builders_rules = RuleFormat(compile_glob, compile_series, compile_arch)
+
+
 _whitelisted_keys = (
     "PROJECT",
     "CAPPROJECT",
@@ -264,6 +404,167 @@ _whitelisted_keys = (
 )
 
 
+def _wanted_config_key(key):
+    return key.startswith("CDIMAGE_") or key in _whitelisted_keys
+
+
+# Shell variables that a configuration file refers to.
+_shell_reference_re = re.compile(r"\$\{?#?([A-Za-z_][A-Za-z0-9_]*)")
+
+# Constructs whose effect depends on more than the file itself and the
+# environment: command substitution, and reading other files.
+_shell_uncacheable_re = re.compile(
+    r"\$\(|`|(?:^|[;&|])\s*(?:\.|source)\s|\$\$", re.M)
+
+# Variables that the shell sets for itself, rather than taking from the
+# environment.
+_shell_dynamic_names = frozenset(
+    ["LINENO", "OLDPWD", "PPID", "PWD", "RANDOM", "SECONDS"])
+
+# The number of snapshots to keep for each version of the configuration
+# file.  Different scripts pass different values (IMAGE_TYPE, DIST, and so
+# on) in the environment, and each combination needs its own snapshot.
+_config_snapshot_keep = 16
+
+
+def config_snapshot_path(config_path):
+    """Return the path of the cached snapshots of config_path."""
+    return os.path.join(
+        os.path.dirname(config_path),
+        ".%s.snapshot" % os.path.basename(config_path))
+
+
+def _config_stamp(config_path):
+    try:
+        st = os.stat(config_path)
+    except OSError:
+        return None
+    # A file modified within the timestamp granularity may be modified
+    # again without its stamp changing, so don't cache it yet.
+    if time.time() - st.st_mtime < 2:
+        return None
+    return [
+        getattr(st, "st_mtime_ns", st.st_mtime), st.st_size, st.st_ino]
+
+
+def _config_environment(names):
+    return dict((name, os.environ.get(name)) for name in names)
+
+
+def _load_config_snapshots(snapshot_path):
+    try:
+        with open(snapshot_path) as snapshot_file:
+            snapshots = json.load(snapshot_file)
+    except IOError as e:
+        if e.errno not in (errno.ENOENT, errno.EACCES):
+            raise
+        return []
+    except ValueError:
+        return []
+    if not isinstance(snapshots, list):
+        return []
+    return [
+        snapshot for snapshot in snapshots
+        if isinstance(snapshot, dict) and
+        isinstance(snapshot.get("environment"), dict) and
+        isinstance(snapshot.get("values"), dict)]
+
+
+def _config_snapshot_matches(snapshot, stamp):
+    if snapshot.get("stamp") != stamp:
+        return False
+    environment = snapshot["environment"]
+    for name in os.environ:
+        if _wanted_config_key(name) and name not in environment:
+            return False
+    return environment == _config_environment(environment)
+
+
+def _save_config_snapshot(config_path, snapshot_path, stamp, snapshots,
+                          values):
+    try:
+        with open(config_path) as config_file:
+            text = config_file.read()
+    except IOError:
+        return
+    # Ignore comments, which often mention other variables or commands.
+    text = "\n".join(
+        line for line in text.splitlines()
+        if not line.lstrip().startswith("#"))
+    if _shell_uncacheable_re.search(text):
+        return
+    names = set(_shell_reference_re.findall(text))
+    if names & _shell_dynamic_names:
+        return
+    names.update(name for name in os.environ if _wanted_config_key(name))
+    snapshot = {
+        "stamp": stamp,
+        "environment": _config_environment(names),
+        "values": values,
+    }
+    snapshots = [snapshot] + [
+        other for other in snapshots
+        if other.get("stamp") == stamp and
+        other["environment"] != snapshot["environment"]]
+    # Several scripts may start at once, so each writes its own temporary
+    # file rather than sharing AtomicFile's.
+    try:
+        fd, temp_path = tempfile.mkstemp(
+            prefix="%s." % os.path.basename(snapshot_path),
+            dir=os.path.dirname(snapshot_path))
+    except OSError:
+        # The cache is only an optimisation, so a read-only tree just goes
+        # without it.
+        return
+    try:
+        with os.fdopen(fd, "w") as snapshot_file:
+            json.dump(
+                snapshots[:_config_snapshot_keep], snapshot_file,
+                sort_keys=True)
+        os.chmod(temp_path, 0o644)
+        os.rename(temp_path, snapshot_path)
+    except (IOError, OSError, ValueError):
+        osextras.unlink_force(temp_path)
+
+
+def read_config_snapshot(config_path):
+    """Return the configuration from sourcing config_path, as a dict.
+
+    Only CDIMAGE_* and whitelisted keys are returned.  Running a shell for
+    this is comparatively slow, and most scripts run with the same
+    configuration file and environment as the last time, so the result is
+    cached next to config_path.  A cached snapshot is used only if the file
+    has the same modification time, size, and inode number as when it was
+    made, and if every CDIMAGE_* or whitelisted variable in the environment,
+    and every variable the file refers to, has the same value.  Files that
+    use command substitution or read other files are never cached.
+    """
+    snapshot_path = config_snapshot_path(config_path)
+    stamp = _config_stamp(config_path)
+    snapshots = []
+    if stamp is not None:
+        snapshots = _load_config_snapshots(snapshot_path)
+        for snapshot in snapshots:
+            if _config_snapshot_matches(snapshot, stamp):
+                values = snapshot["values"]
+                if sys.version_info[0] < 3:
+                    values = dict(
+                        (key.encode("UTF-8"), value.encode("UTF-8"))
+                        for key, value in values.items())
+                return values
+
+    values = dict(
+        (key, value)
+        for key, value in osextras.read_shell_config(
+            config_path, _whitelisted_keys)
+        if _wanted_config_key(key))
+    # Only save the result if the file did not change while it was read.
+    if stamp is not None and stamp == _config_stamp(config_path):
+        _save_config_snapshot(
+            config_path, snapshot_path, stamp, snapshots, values)
+    return values
+
+
 class Config(defaultdict):
     def __init__(self, read=True, **kwargs):
         super(Config, self).__init__(str)
@@ -283,9 +584,12 @@ class Config(defaultdict):
                 self.read()
 
     def read(self, config_path=None):
-        for key, value in osextras.read_shell_config(
-                config_path, _whitelisted_keys):
-            if key.startswith("CDIMAGE_") or key in _whitelisted_keys:
+        if config_path is not None:
+            values = read_config_snapshot(config_path).items()
+        else:
+            values = osextras.read_shell_config(None, _whitelisted_keys)
+        for key, value in values:
+            if _wanted_config_key(key):
                 super(Config, self).__setitem__(key, value)
 
         # Special entries.
@@ -355,34 +659,22 @@ class Config(defaultdict):
         else:
             return series == self.series
 
-    def set_default_arches(self):
-        default_arches = os.path.join(self.root, "etc", "default-arches")
-        if not os.path.exists(default_arches):
-            return None
+    def want_project(self):
+        """Return the project name used to match production rule files."""
         want_project_bits = [self.project]
         if self.subproject:
             want_project_bits.append(self.subproject)
         if self["UBUNTU_DEFAULTS_LOCALE"]:
             want_project_bits.append(self["UBUNTU_DEFAULTS_LOCALE"])
-        want_project = "-".join(want_project_bits)
-        with open(default_arches) as f:
-            for line in f:
-                line = line.strip()
-                if not line or line.startswith("#"):
-                    continue
-                try:
-                    project, image_type, series, arches = line.split(None, 3)
-                except ValueError:
-                    continue
-                if not fnmatch.fnmatchcase(want_project, project):
-                    continue
-                if not fnmatch.fnmatchcase(self.image_type, image_type):
-                    continue
-                if not self.match_series(series):
-                    continue
-                self["ARCHES"] = arches
-                return arches
-        return None
+        return "-".join(want_project_bits)
+
+    def set_default_arches(self):
+        default_arches = os.path.join(self.root, "etc", "default-arches")
+        arches = default_arches_rules.first_match(
+            default_arches, self.want_project(), self.image_type, self)
+        if arches is not None:
+            self["ARCHES"] = arches
+        return arches
 
     def set_default_cpuarches(self):
         self["CPUARCHES"] = " ".join(
@@ -438,10 +730,9 @@ class Config(defaultdict):
 
     @property
     def core_series(self):
-        if self["DIST"] >= "xenial" and self["DIST"] <= "artful":
-            return '16'
-        if self["DIST"] >= "bionic":
-            return '18'
+        for core_series, start in reversed(core_series_starts):
+            if self["DIST"] >= start:
+                return core_series
         return None
 
     def export(self):
@@ -0,0 +1,192 @@
+# Copyright (C) 2019 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Content-addressed storage for published images.
+
+A release publishes each image several times over: into the simple tree's
+pool, into the full tree, and into the torrent tree.  Instead of writing a
+fresh copy each time, every published copy is a hard link to a single
+object named after the SHA-256 digest of its contents.  The object is
+itself a copy of the daily build rather than a link to it, so published
+images never share an inode with the daily tree, and a new inode is only
+created when the contents differ from everything already stored.
+"""
+
+import errno
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+import hashlib
+from itertools import count
+import os
+import shutil
+import threading
+import time
+
+from cdimage import osextras
+
+__metaclass__ = type
+
+
+# From <linux/fs.h>.
+FICLONE = 0x40049409
+
+_temp_counter = count()
+
+_digest_cache = {}
+_digest_cache_lock = threading.Lock()
+
+
+def _digest_key(path):
+    st = os.stat(path)
+    return path, st.st_dev, st.st_ino, st.st_size, st.st_mtime
+
+
+def remember_digest(path, digest):
+    """Note digest as the SHA-256 digest of path, computed elsewhere."""
+    key = _digest_key(path)
+    with _digest_cache_lock:
+        _digest_cache[key] = digest
+
+
+def file_digest(path):
+    """Return the hex SHA-256 digest of the contents of path.
+
+    Digests are remembered for as long as the file's identity, size, and
+    modification time stay the same.
+    """
+    key = _digest_key(path)
+    with _digest_cache_lock:
+        digest = _digest_cache.get(key)
+    if digest is not None:
+        return digest
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for buf in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(buf)
+    digest = sha256.hexdigest()
+    with _digest_cache_lock:
+        _digest_cache[key] = digest
+    return digest
+
+
+def clone_file(source, target):
+    """Copy source to target, preserving metadata as "cp -a" does.
+
+    Where the file system supports it, target shares its data blocks with
+    source (a reflink) rather than being written out in full.
+    """
+    if fcntl is not None:
+        try:
+            with open(source, "rb") as source_file:
+                with open(target, "wb") as target_file:
+                    fcntl.ioctl(
+                        target_file.fileno(), FICLONE, source_file.fileno())
+            shutil.copystat(source, target)
+            return
+        except (IOError, OSError):
+            pass
+    shutil.copy2(source, target)
+
+
+def _temp_name(path):
+    return "%s.tmp-%d-%d" % (path, os.getpid(), next(_temp_counter))
+
+
+def _link_or_clone(source, target):
+    try:
+        os.link(source, target)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EMLINK, errno.EPERM):
+            raise
+        clone_file(source, target)
+
+
+def install_file(source, target):
+    """Atomically make target a hard link to source, unless it already is.
+
+    If source cannot be linked to (for instance because target is on a
+    different file system), target is a copy of it instead.
+    """
+    if (os.path.exists(target) and not os.path.islink(target) and
+            os.path.samefile(source, target)):
+        return
+    temp_path = _temp_name(target)
+    _link_or_clone(source, temp_path)
+    os.rename(temp_path, target)
+
+
+class ContentStore:
+    """A store of file contents, keyed by their SHA-256 digest."""
+
+    def __init__(self, config):
+        self.config = config
+        self.directory = os.path.join(config.root, "www", ".content")
+
+    def object_path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def add(self, path, existing=None):
+        """Store the contents of path, returning the path to the object.
+
+        If an object with these contents is already stored, it is reused.
+        Otherwise, if existing names a file with the same contents (such
+        as a previously-published copy), that file becomes the object;
+        failing that, path is copied.
+        """
+        digest = file_digest(path)
+        object_path = self.object_path(digest)
+        if os.path.exists(object_path):
+            return object_path
+        osextras.ensuredir(os.path.dirname(object_path))
+        temp_path = _temp_name(object_path)
+        if (existing is not None and
+                os.path.isfile(existing) and
+                not os.path.islink(existing) and
+                os.path.getsize(existing) == os.path.getsize(path) and
+                file_digest(existing) == digest):
+            _link_or_clone(existing, temp_path)
+        else:
+            clone_file(path, temp_path)
+        os.rename(temp_path, object_path)
+        return object_path
+
+    def link(self, source, target):
+        """Make target a copy of source, sharing storage where possible.
+
+        If target already has the same contents as source, it is left
+        alone.
+        """
+        install_file(self.add(source, existing=target), target)
+
+    def prune(self, grace=24 * 60 * 60):
+        """Remove objects that are no longer published anywhere.
+
+        Objects whose status changed within the last grace seconds are
+        kept, in case a concurrent publisher is about to link to them.
+        """
+        now = time.time()
+        for subdir in osextras.listdir_force(self.directory):
+            subdir_path = os.path.join(self.directory, subdir)
+            for name in osextras.listdir_force(subdir_path):
+                path = os.path.join(subdir_path, name)
+                try:
+                    st = os.lstat(path)
+                except OSError as e:
+                    if e.errno == errno.ENOENT:
+                        continue
+                    raise
+                if st.st_nlink == 1 and now - st.st_ctime >= grace:
+                    osextras.unlink_force(path)
@@ -0,0 +1,205 @@
+# Copyright (C) 2019 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Read a file once on behalf of several consumers.
+
+Checksums, zsync metafiles, and torrents all need to read every byte of an
+image.  A FanoutReader reads the file once, in large buffers, and passes
+each buffer to every registered consumer: anything with an update method,
+such as hashlib objects, ZsyncMetafile, TorrentMetafile, or a
+PipeConsumer feeding a subprocess.  Consumers with a close method have it
+called once all the data has been passed to them, and consumers with an
+abort method have that called instead if reading stops early.
+"""
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+import subprocess
+import threading
+import time
+
+__metaclass__ = type
+
+
+# A multiple of every zsync block size and torrent piece length in use, so
+# that consumers rarely have to carry partial blocks between buffers.
+default_bufsize = 4 * 1024 * 1024
+
+# How many buffers a consumer may fall behind the reader before the reader
+# waits for it.
+default_depth = 4
+
+# CPU time used by the current thread, where the platform can tell us;
+# otherwise fall back to elapsed time.
+_thread_time = getattr(time, "thread_time", time.time)
+
+_eof = object()
+_abort = object()
+
+
+def _finish(consumer, sentinel):
+    method = getattr(consumer, "close" if sentinel is _eof else "abort", None)
+    if method is not None:
+        method()
+
+
+class PipeConsumer:
+    """Feed data to the standard input of a subprocess."""
+
+    def __init__(self, command, **kwargs):
+        self.command = command
+        self.process = subprocess.Popen(
+            command, stdin=subprocess.PIPE, **kwargs)
+
+    def update(self, data):
+        self.process.stdin.write(data)
+
+    def close(self):
+        self.process.stdin.close()
+        ret = self.process.wait()
+        if ret != 0:
+            raise subprocess.CalledProcessError(ret, self.command)
+
+    def abort(self):
+        self.process.kill()
+        self.process.stdin.close()
+        self.process.wait()
+
+
+class _ConsumerThread(threading.Thread):
+    def __init__(self, name, consumer, depth, failed):
+        super(_ConsumerThread, self).__init__(name="fanout-%s" % name)
+        self.daemon = True
+        self.consumer = consumer
+        self.queue = Queue(maxsize=depth)
+        self.failed = failed
+        self.error = None
+        self.cpu_time = 0.0
+
+    def run(self):
+        while True:
+            data = self.queue.get()
+            finished = data is _eof or data is _abort
+            if self.error is None:
+                start = _thread_time()
+                try:
+                    if finished:
+                        _finish(self.consumer, data)
+                    else:
+                        self.consumer.update(data)
+                except Exception as e:
+                    self.error = e
+                    self.failed.set()
+                finally:
+                    self.cpu_time += _thread_time() - start
+            # After an error, keep draining so that the reader never blocks
+            # on us.
+            if finished:
+                return
+
+
+class FanoutReader:
+    """Feed the contents of one file to any number of consumers.
+
+    With more than one consumer, each runs in its own thread, so that
+    consumers which release the GIL (such as hashlib objects and pipes)
+    proceed in parallel.  The reader waits whenever the slowest consumer
+    falls depth buffers behind.  If any consumer raises an exception,
+    reading stops, and the first such exception in registration order is
+    re-raised once all consumers have finished.
+    """
+
+    def __init__(self, path, bufsize=default_bufsize, depth=default_depth):
+        self.path = path
+        self.bufsize = bufsize
+        self.depth = depth
+        self.consumers = []
+        self.cpu_times = {}
+        self.read_time = 0.0
+        self.length = 0
+
+    def add(self, name, consumer):
+        """Register consumer under name, and return it."""
+        self.consumers.append((name, consumer))
+        return consumer
+
+    def _read(self, feed, failed=None):
+        with open(self.path, "rb") as f:
+            while failed is None or not failed.is_set():
+                start = time.time()
+                data = f.read(self.bufsize)
+                self.read_time += time.time() - start
+                if not data:
+                    break
+                self.length += len(data)
+                feed(data)
+
+    def _run_inline(self):
+        name, consumer = self.consumers[0]
+        cpu_time = [0.0]
+
+        def feed(data):
+            start = _thread_time()
+            consumer.update(data)
+            cpu_time[0] += _thread_time() - start
+
+        try:
+            try:
+                self._read(feed)
+            except Exception:
+                _finish(consumer, _abort)
+                raise
+            start = _thread_time()
+            _finish(consumer, _eof)
+            cpu_time[0] += _thread_time() - start
+        finally:
+            self.cpu_times[name] = cpu_time[0]
+
+    def _run_threaded(self):
+        failed = threading.Event()
+        threads = [
+            _ConsumerThread(name, consumer, self.depth, failed)
+            for name, consumer in self.consumers]
+        for thread in threads:
+            thread.start()
+
+        def feed(data):
+            for thread in threads:
+                thread.queue.put(data)
+
+        sentinel = _abort
+        try:
+            self._read(feed, failed=failed)
+            if not failed.is_set():
+                sentinel = _eof
+        finally:
+            for thread in threads:
+                thread.queue.put(sentinel)
+            for thread in threads:
+                thread.join()
+            for (name, _), thread in zip(self.consumers, threads):
+                self.cpu_times[name] = thread.cpu_time
+        for thread in threads:
+            if thread.error is not None:
+                raise thread.error
+
+    def run(self):
+        """Read the file, feeding every consumer.  Return its length."""
+        if len(self.consumers) == 1:
+            self._run_inline()
+        elif self.consumers:
+            self._run_threaded()
+        return self.length
@@ -0,0 +1,50 @@
+# Copyright (C) 2019 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Caching of parsed configuration files."""
+
+import os
+import threading
+
+__metaclass__ = type
+
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def load_cached(path, parser):
+    """Return parser(path), reusing an earlier result if path is unchanged.
+
+    A file counts as unchanged if its modification time, size, and inode
+    number are all the same as when it was last parsed, so files replaced
+    using AtomicFile are always reparsed.  Errors from os.stat propagate.
+    """
+    st = os.stat(path)
+    stamp = (st.st_mtime, st.st_size, st.st_ino)
+    key = (path, parser)
+    with _cache_lock:
+        cached = _cache.get(key)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    value = parser(path)
+    with _cache_lock:
+        _cache[key] = (stamp, value)
+    return value
+
+
+def clear_cache():
+    """Forget everything parsed so far."""
+    with _cache_lock:
+        _cache.clear()
@@ -0,0 +1,256 @@
+# Copyright (C) 2019 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Bounded parallel execution of independent jobs."""
+
+import logging
+from multiprocessing.pool import ThreadPool
+import threading
+import time
+
+from cdimage.log import logger
+
+__metaclass__ = type
+
+
+default_jobs = 4
+
+
+def job_count(config, key="CDIMAGE_PUBLISH_JOBS", default=default_jobs):
+    """Return the configured number of parallel jobs (at least one)."""
+    try:
+        jobs = int(config[key])
+    except ValueError:
+        jobs = default
+    return max(jobs, 1)
+
+
+def map_parallel(func, args_list, jobs=default_jobs):
+    """Call func(*args) for each of args_list using up to jobs threads.
+
+    Results are returned in the same order as args_list, regardless of the
+    order in which the calls complete.  If any call raises an exception,
+    the first such exception in args_list order is re-raised once all the
+    calls have finished.
+    """
+    args_list = list(args_list)
+    if jobs <= 1 or len(args_list) <= 1:
+        return [func(*args) for args in args_list]
+
+    pool = ThreadPool(min(jobs, len(args_list)))
+    try:
+        async_results = [
+            pool.apply_async(func, args) for args in args_list]
+        pool.close()
+        pool.join()
+        return [async_result.get() for async_result in async_results]
+    finally:
+        pool.terminate()
+
+
+def _timed_call(func, args):
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+class BackgroundJobs:
+    """Run jobs in the background until an explicit join point.
+
+    Jobs are started as soon as they are submitted, using up to the given
+    number of threads, and run while the caller gets on with other work.
+    """
+
+    def __init__(self, jobs=default_jobs):
+        self.jobs = max(jobs, 1)
+        self.pool = None
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def submit(self, label, func, *args):
+        """Start func(*args) in the background, identified by label."""
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPool(self.jobs)
+            self.pending.append(
+                (label, self.pool.apply_async(_timed_call, (func, args))))
+
+    def join(self):
+        """Wait for all submitted jobs to finish.
+
+        Return a list of (label, result, elapsed seconds) tuples in
+        submission order.  If any job raised an exception, the first such
+        exception in submission order is re-raised once all the jobs have
+        finished.
+        """
+        with self.lock:
+            if self.pool is None:
+                return []
+            pool, pending = self.pool, self.pending
+            self.pool = None
+            self.pending = []
+        try:
+            pool.close()
+            pool.join()
+            finished = []
+            for label, async_result in pending:
+                result, elapsed = async_result.get()
+                finished.append((label, result, elapsed))
+            return finished
+        finally:
+            pool.terminate()
+
+
+class _LogBuffer(logging.Filter):
+    """Hold back log records from threads that are collecting them."""
+
+    def __init__(self):
+        super(_LogBuffer, self).__init__()
+        self.local = threading.local()
+
+    def filter(self, record):
+        records = getattr(self.local, "records", None)
+        if records is None:
+            return True
+        records.append(record)
+        return False
+
+
+class Operation:
+    """A single step in a Plan."""
+
+    def __init__(self, number, label, func, args, after, size):
+        self.number = number
+        self.label = label
+        self.func = func
+        self.args = tuple(args)
+        self.after = tuple(after)
+        self.size = size
+
+    def describe(self):
+        description = "%d. %s" % (self.number, self.label)
+        if self.size:
+            description += " (%.1f MiB)" % (self.size / 1024.0 / 1024.0)
+        if self.after:
+            description += " [after %s]" % ", ".join(
+                str(op.number) for op in self.after)
+        return description
+
+
+class Plan:
+    """A set of operations, some of which depend on others.
+
+    Operations are added in an order in which they could be run one at a
+    time; each may only depend on operations added before it.  When the
+    plan is run, every operation whose dependencies have finished is
+    started, using up to the given number of threads.
+    """
+
+    def __init__(self):
+        self.operations = []
+
+    def add(self, label, func, args=(), after=(), size=0):
+        """Add an operation calling func(*args) to the plan.
+
+        The operation starts only once all the operations in after have
+        finished.  size is an estimate of the number of bytes it copies.
+        Return the new operation, for use in later calls' after lists.
+        """
+        op = Operation(
+            len(self.operations) + 1, label, func, args, after, size)
+        for dependency in op.after:
+            assert dependency in self.operations
+        self.operations.append(op)
+        return op
+
+    @property
+    def size(self):
+        return sum(op.size for op in self.operations)
+
+    def describe(self):
+        """Return a list of lines describing the plan."""
+        return [op.describe() for op in self.operations]
+
+    def run(self, jobs=default_jobs):
+        """Run all the operations in the plan.
+
+        Log messages from each operation are held back until it finishes,
+        and are then emitted in plan order, so the log reads the same as if
+        the operations had been run one at a time.  If any operation raises
+        an exception, no further operations are started, and the first such
+        exception in plan order is re-raised once the running operations
+        have finished.
+        """
+        if jobs <= 1:
+            for op in self.operations:
+                op.func(*op.args)
+            return
+
+        buffer = _LogBuffer()
+        condition = threading.Condition()
+        started = {}
+        finished = {}
+
+        def call(op):
+            buffer.local.records = records = []
+            succeeded = False
+            try:
+                result = op.func(*op.args)
+                succeeded = True
+                return result
+            finally:
+                buffer.local.records = None
+                with condition:
+                    finished[op] = (succeeded, records)
+                    condition.notify()
+
+        def ready(op):
+            return op not in started and all(
+                dependency in finished and finished[dependency][0]
+                for dependency in op.after)
+
+        def emit(op):
+            for record in finished[op][1]:
+                logger.handle(record)
+
+        pool = ThreadPool(jobs)
+        logger.addFilter(buffer)
+        try:
+            emitted = 0
+            with condition:
+                while True:
+                    if all(succeeded for succeeded, _ in finished.values()):
+                        for op in self.operations:
+                            if ready(op):
+                                started[op] = pool.apply_async(call, (op,))
+                    while (emitted < len(self.operations) and
+                           self.operations[emitted] in finished):
+                        emit(self.operations[emitted])
+                        emitted += 1
+                    if len(finished) == len(started):
+                        break
+                    condition.wait()
+            pool.close()
+            pool.join()
+        finally:
+            logger.removeFilter(buffer)
+            pool.terminate()
+
+        # After a failure, some operations never ran.
+        for op in self.operations[emitted:]:
+            if op in finished:
+                emit(op)
+        for op in self.operations:
+            if op in started:
+                started[op].get()
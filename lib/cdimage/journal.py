@@ -0,0 +1,172 @@
+# Copyright (C) 2019 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A journal of completed publication steps.
+
+Publishing takes a long time, and some of its steps cannot simply be
+repeated: images are moved out of the scratch directory, for instance, so a
+second attempt would find nothing to move.  While publishing, each step
+that completes is appended to a journal under log/publish-journal, along
+with the size and inode of each file it produced.  If publication is
+interrupted and run again, steps whose outputs are still as they were are
+skipped.  The journal is removed once publication has finished.
+"""
+
+import errno
+import json
+import os
+import shutil
+import stat
+import threading
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
+
+from cdimage.log import logger
+from cdimage import osextras
+
+__metaclass__ = type
+
+
+def journal_path(config, directory, name="publish"):
+    """Return the path of a journal of publishing to directory.
+
+    Journals are kept out of the published trees, so that mirrors never
+    pick up the journal of an interrupted publication.
+    """
+    relative = os.path.relpath(directory, config.root)
+    return os.path.join(
+        config.root, "log", "publish-journal",
+        "%s.%s" % (quote(relative, safe=""), name))
+
+
+def output_stamp(path):
+    """Return [size, inode] for path, or None if it does not exist.
+
+    Directories change size as their entries change, so only their inode
+    is compared.
+    """
+    try:
+        st = os.lstat(path)
+    except OSError as e:
+        if e.errno in (errno.ENOENT, errno.ENOTDIR):
+            return None
+        raise
+    if stat.S_ISDIR(st.st_mode):
+        return [None, st.st_ino]
+    return [st.st_size, st.st_ino]
+
+
+class PublishJournal:
+    """An append-only record of the steps completed by a publication."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        try:
+            with open(path) as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A step interrupted while being recorded did not
+                        # complete.
+                        continue
+                    self.entries[entry["key"]] = entry
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    @property
+    def resuming(self):
+        """True if an earlier attempt recorded any completed steps."""
+        with self.lock:
+            return bool(self.entries)
+
+    def completed(self, key):
+        """Return True if key was completed and its outputs are unchanged.
+
+        Every step that key requires must also have been completed.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None:
+            return False
+        for path, stamp in entry["outputs"]:
+            if output_stamp(path) != stamp:
+                return False
+        return all(self.completed(other) for other in entry["requires"])
+
+    def record(self, key, outputs=(), requires=(), result=None):
+        """Record that key has completed.
+
+        outputs are the files it produced, as they are now; requires are
+        the keys of other steps that must also complete before key is
+        considered done; result is any JSON-serialisable value to keep
+        with it.
+        """
+        entry = {
+            "key": key,
+            "outputs": [[path, output_stamp(path)] for path in outputs],
+            "requires": list(requires),
+            "result": result,
+        }
+        line = json.dumps(entry, sort_keys=True)
+        with self.lock:
+            osextras.ensuredir(os.path.dirname(self.path))
+            with open(self.path, "a") as journal:
+                journal.write(line + "\n")
+                journal.flush()
+                os.fsync(journal.fileno())
+            self.entries[key] = entry
+
+    def run(self, key, func, *args, **kwargs):
+        """Call func(*args) and record key, unless key was already done.
+
+        If outputs is given, it is called once func has finished, and
+        returns the files that func produced.
+        """
+        outputs = kwargs.pop("outputs", None)
+        if self.completed(key):
+            logger.info("Skipping %s (already done)" % key)
+            return
+        func(*args)
+        self.record(key, outputs=outputs() if outputs is not None else ())
+
+    def moved(self, source):
+        """Return where source was moved to, if it has gone."""
+        with self.lock:
+            entry = self.entries.get("move %s" % source)
+        if entry is None or os.path.lexists(source):
+            return None
+        return entry["result"]
+
+    def move(self, source, target):
+        """shutil.move(source, target), unless that was already done.
+
+        A move whose source is gone cannot be repeated, so it counts as done
+        even if its target has since been modified.
+        """
+        if self.moved(source) == target:
+            return
+        shutil.move(source, target)
+        self.record("move %s" % source, outputs=[target], result=target)
+
+    def remove(self):
+        """Remove the journal, once publication has finished."""
+        with self.lock:
+            osextras.unlink_force(self.path)
+            self.entries = {}
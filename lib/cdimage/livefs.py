@@ -18,7 +18,6 @@
 from __future__ import print_function
 
 from contextlib import closing
-import fnmatch
 from gzip import GzipFile
 import io
 import os
@@ -34,7 +33,11 @@ except ImportError:
     from urllib2 import URLError, unquote, urlopen
 
 from cdimage import osextras, sign
-from cdimage.config import Touch
+from cdimage.config import (
+    Touch,
+    livefs_builders_rules,
+    livefs_launchpad_rules,
+)
 from cdimage.launchpad import get_launchpad
 from cdimage.log import logger
 from cdimage.mail import get_notify_addresses, send_mail
@@ -81,31 +84,11 @@ def split_arch(arch):
 
 
 def live_builder(config, arch):
-    cpuarch, subarch = split_arch(arch)
-    project = config.project
-
     path = os.path.join(config.root, "production", "livefs-builders")
-    if os.path.exists(path):
-        with open(path) as f:
-            for line in f:
-                line = line.strip()
-                if not line or line.startswith("#"):
-                    continue
-                try:
-                    f_project, f_series, f_arch, builder = line.split(None, 3)
-                except ValueError:
-                    continue
-                if not fnmatch.fnmatchcase(project, f_project):
-                    continue
-                if not config.match_series(f_series):
-                    continue
-                if "+" in f_arch:
-                    want_arch = arch
-                else:
-                    want_arch = cpuarch
-                if not fnmatch.fnmatchcase(want_arch, f_arch):
-                    continue
-                return builder
+    builder = livefs_builders_rules.first_match(
+        path, config.project, config, arch)
+    if builder is not None:
+        return builder
 
     raise UnknownArchitecture("No live filesystem builder known for %s" % arch)
 
@@ -286,42 +269,16 @@ def live_build_notify_failure(config, arch, lp_build=None):
 
 
 def live_lp_info(config, arch):
-    cpuarch, subarch = split_arch(arch)
-    want_project_bits = [config.project]
-    if config.subproject:
-        want_project_bits.append(config.subproject)
-    if config["UBUNTU_DEFAULTS_LOCALE"]:
-        want_project_bits.append(config["UBUNTU_DEFAULTS_LOCALE"])
-    want_project = "-".join(want_project_bits)
+    want_project = config.want_project()
     image_type = config.image_type
 
     path = os.path.join(config.root, "production", "livefs-launchpad")
     if not os.path.exists(path):
         path = os.path.join(config.root, "etc", "livefs-launchpad")
-    if os.path.exists(path):
-        with open(path) as f:
-            for line in f:
-                line = line.strip()
-                if not line or line.startswith("#"):
-                    continue
-                try:
-                    f_project, f_image_type, f_series, f_arch, lp_info = (
-                        line.split(None, 4))
-                except ValueError:
-                    continue
-                if not fnmatch.fnmatchcase(want_project, f_project):
-                    continue
-                if not fnmatch.fnmatchcase(image_type, f_image_type):
-                    continue
-                if not config.match_series(f_series):
-                    continue
-                if "+" in f_arch:
-                    want_arch = arch
-                else:
-                    want_arch = cpuarch
-                if not fnmatch.fnmatchcase(want_arch, f_arch):
-                    continue
-                return lp_info.split("/")
+    lp_info = livefs_launchpad_rules.first_match(
+        path, want_project, image_type, config, arch)
+    if lp_info is not None:
+        return lp_info.split("/")
 
     raise UnknownLaunchpadLiveFS(
         "No Launchpad live filesystem definition known for %s/%s/%s/%s" %
@@ -0,0 +1,173 @@
+# Copyright (C) 2019 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Native generation of metalink files.
+
+Each image gets a metalink in both version 3.0 (.metalink) and version 4
+(RFC 5854, .meta4) formats.  Sizes come from the file system and hashes
+from the checksum files already in the image's directory, so images are
+not read again; only images missing from SHA256SUMS are hashed, through
+the content store's digest cache.
+"""
+
+from __future__ import print_function
+
+import hashlib
+import os
+from xml.sax.saxutils import escape, quoteattr
+
+from cdimage.atomicfile import AtomicFile
+from cdimage.checksums import ChecksumFile
+from cdimage.contentstore import file_digest
+from cdimage import osextras
+
+__metaclass__ = type
+
+
+# (checksum file, metalink 3.0 hash type, metalink 4 hash type)
+metalink_hashes = (
+    ("MD5SUMS", "md5", "md5"),
+    ("SHA1SUMS", "sha1", "sha-1"),
+    ("SHA256SUMS", "sha256", "sha-256"),
+)
+
+metalink_extensions = (".metalink", ".meta4")
+
+
+def image_digests(config, directory):
+    """Return {image name: {checksum file name: hex digest}}.
+
+    Only images that exist in directory and are listed in at least one of
+    its checksum files are included.
+    """
+    digests = {}
+    for checksum_name, _, _ in metalink_hashes:
+        checksum_file = ChecksumFile(
+            config, directory, checksum_name, hashlib.md5, sign=False)
+        checksum_file.read()
+        for name, digest in checksum_file.entries.items():
+            digests.setdefault(name, {})[checksum_name] = digest
+    for name in list(digests):
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path):
+            del digests[name]
+        elif "SHA256SUMS" not in digests[name]:
+            digests[name]["SHA256SUMS"] = file_digest(path)
+    return digests
+
+
+def metalink3(name, size, digests, urls, torrent_url=None, identity=None,
+              version=None):
+    """Return a version 3.0 metalink for one file, as text."""
+    lines = [
+        '<?xml version="1.0" encoding="utf-8"?>',
+        '<metalink version="3.0" xmlns="http://www.metalinker.org/" '
+        'generator="cdimage" type="static">',
+        '  <files>',
+        '    <file name=%s>' % quoteattr(name),
+    ]
+    if identity:
+        lines.append('      <identity>%s</identity>' % escape(identity))
+    if version:
+        lines.append('      <version>%s</version>' % escape(version))
+    lines.append('      <size>%d</size>' % size)
+    lines.append('      <verification>')
+    for checksum_name, hash_type, _ in metalink_hashes:
+        if checksum_name in digests:
+            lines.append('        <hash type="%s">%s</hash>' % (
+                hash_type, digests[checksum_name]))
+    lines.append('      </verification>')
+    lines.append('      <resources>')
+    if torrent_url:
+        lines.append(
+            '        <url type="bittorrent" preference="100">%s</url>' %
+            escape(torrent_url))
+    for url in urls:
+        lines.append(
+            '        <url type="%s" preference="90">%s</url>' % (
+                url.split(":", 1)[0], escape(url)))
+    lines.extend([
+        '      </resources>',
+        '    </file>',
+        '  </files>',
+        '</metalink>',
+    ])
+    return "\n".join(lines) + "\n"
+
+
+def metalink4(name, size, digests, urls, torrent_url=None, identity=None,
+              version=None):
+    """Return a version 4 (RFC 5854) metalink for one file, as text."""
+    lines = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<metalink xmlns="urn:ietf:params:xml:ns:metalink">',
+        '  <generator>cdimage</generator>',
+        '  <file name=%s>' % quoteattr(name),
+    ]
+    if identity:
+        lines.append('    <identity>%s</identity>' % escape(identity))
+    if version:
+        lines.append('    <version>%s</version>' % escape(version))
+    lines.append('    <size>%d</size>' % size)
+    for checksum_name, _, hash_type in metalink_hashes:
+        if checksum_name in digests:
+            lines.append('    <hash type="%s">%s</hash>' % (
+                hash_type, digests[checksum_name]))
+    for priority, url in enumerate(urls, 1):
+        lines.append(
+            '    <url priority="%d">%s</url>' % (priority, escape(url)))
+    if torrent_url:
+        lines.append(
+            '    <metaurl mediatype="torrent" priority="1">%s</metaurl>' %
+            escape(torrent_url))
+    lines.extend([
+        '  </file>',
+        '</metalink>',
+    ])
+    return "\n".join(lines) + "\n"
+
+
+def write_metalinks(config, directory, base_urls, identity=None,
+                    version=None):
+    """Write metalinks for every checksummed image in directory.
+
+    Each image is offered from every URL in base_urls, which should each
+    name a copy of directory.  Metalinks for images that no longer exist
+    are removed.  Return a sorted list of the metalink files written.
+    """
+    written = []
+    digests = image_digests(config, directory)
+    for name in sorted(digests):
+        path = os.path.join(directory, name)
+        urls = ["%s/%s" % (base.rstrip("/"), name) for base in base_urls]
+        torrent_url = None
+        if os.path.exists("%s.torrent" % path) and urls:
+            torrent_url = "%s.torrent" % urls[0]
+        size = os.stat(path).st_size
+        for extension, writer in zip(
+                metalink_extensions, (metalink3, metalink4)):
+            with AtomicFile(
+                    "%s%s" % (path, extension),
+                    only_if_changed=True) as metalink:
+                print(writer(
+                    name, size, digests[name], urls, torrent_url=torrent_url,
+                    identity=identity, version=version),
+                    file=metalink, end="")
+            written.append("%s%s" % (name, extension))
+    for name in os.listdir(directory):
+        for extension in metalink_extensions:
+            if (name.endswith(extension) and
+                    name[:-len(extension)] not in digests):
+                osextras.unlink_force(os.path.join(directory, name))
+    return sorted(written)
@@ -29,7 +29,12 @@ from cdimage.proxy import proxy_call
 
 def ensuredir(directory):
     if not os.path.isdir(directory):
-        os.makedirs(directory)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            # Another thread or process may have created it in the meantime.
+            if e.errno != errno.EEXIST or not os.path.isdir(directory):
+                raise
 
 
 def mkemptydir(directory):
@@ -0,0 +1,105 @@
+# Copyright (C) 2019 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Release artifacts prepared ahead of publication.
+
+While a candidate daily build is still being tested, "publish-release
+--prestage" makes the expensive parts of a release (stored copies of the
+images, zsync metafiles, and torrents) in a hidden staging area, under the
+names they will eventually be published as.  Each staged file records the
+identity of the file it was made from; publish-release then links staged
+files into place instead of making them again, provided that their inputs
+are still the same files.  If the daily build is rebuilt or replaced in the
+meantime, its inodes change and the stale staged files are ignored.
+"""
+
+from __future__ import print_function
+
+import errno
+import os
+import threading
+
+from cdimage.atomicfile import AtomicFile
+from cdimage import osextras
+
+__metaclass__ = type
+
+
+def file_stamp(path):
+    """Return a string identifying the current version of path."""
+    st = os.stat(path)
+    return "%d:%d:%d:%r" % (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+
+class StagingArea:
+    """A directory of files staged for a particular release."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.index_path = os.path.join(directory, ".index")
+        self.lock = threading.Lock()
+        self._stamps = None
+
+    @property
+    def stamps(self):
+        if self._stamps is None:
+            self._stamps = {}
+            try:
+                with open(self.index_path) as index:
+                    for line in index:
+                        name, stamp = line.rstrip("\n").split(" ", 1)
+                        self._stamps[name] = stamp
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        return self._stamps
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def lookup(self, name, source):
+        """Return the path to name if it was staged from source as it is now.
+
+        Return None if name was not staged, or if source has changed since.
+        """
+        with self.lock:
+            stamp = self.stamps.get(name)
+        if stamp is None:
+            return None
+        try:
+            if file_stamp(source) != stamp:
+                return None
+        except OSError:
+            return None
+        path = self.path(name)
+        if not os.path.exists(path):
+            return None
+        return path
+
+    def record(self, name, source):
+        """Record that name has just been staged from source."""
+        stamp = file_stamp(source)
+        with self.lock:
+            self.stamps[name] = stamp
+
+    def write(self):
+        """Save the index, forgetting staged files that have gone away."""
+        with self.lock:
+            for name in list(self.stamps):
+                if not os.path.exists(self.path(name)):
+                    del self.stamps[name]
+            osextras.ensuredir(self.directory)
+            with AtomicFile(self.index_path) as index:
+                for name, stamp in sorted(self.stamps.items()):
+                    print(name, stamp, file=index)
@@ -0,0 +1,135 @@
+#! /usr/bin/python
+
+# Copyright (C) 2019 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for cdimage.accounting."""
+
+import os
+
+from cdimage.accounting import PublishCost, PublishHistory
+from cdimage.tests.helpers import TestCase, mkfile
+
+__metaclass__ = type
+
+
+class TestPublishCost(TestCase):
+    def setUp(self):
+        super(TestPublishCost, self).setUp()
+        self.use_temp_dir()
+
+    def test_add(self):
+        cost = PublishCost()
+        cost.add("copied", 100)
+        cost.add("copied", 50)
+        cost.add("signed")
+        self.assertEqual(150, cost["copied"])
+        self.assertEqual(1, cost["signed"])
+        self.assertEqual(0, cost["hashed"])
+
+    def test_size(self):
+        cost = PublishCost()
+        path = os.path.join(self.temp_dir, "image")
+        self.assertEqual(0, cost.size(path))
+        self.assertFalse(cost.exists(path))
+        cost.record_size(path, 1234)
+        self.assertEqual(1234, cost.size(path))
+        self.assertTrue(cost.exists(path))
+        other = os.path.join(self.temp_dir, "other")
+        with mkfile(other) as f:
+            f.write("data")
+        self.assertEqual(4, cost.size(other))
+        self.assertTrue(cost.exists(other))
+
+    def test_first_digest(self):
+        cost = PublishCost()
+        self.assertTrue(cost.first_digest("/a"))
+        self.assertFalse(cost.first_digest("/a"))
+        self.assertTrue(cost.first_digest("/b"))
+
+    def test_work(self):
+        cost = PublishCost()
+        for name in "copied", "linked", "hashed", "zsync", "torrent":
+            cost.add(name, 1)
+        cost.add("signed", 3)
+        # Linking and signing are not counted.
+        self.assertEqual(4, cost.work)
+
+    def test_describe(self):
+        cost = PublishCost()
+        cost.add("copied", 3 * 1024 * 1024)
+        cost.add("torrent", 512 * 1024)
+        cost.add("signed", 2)
+        self.assertEqual([
+            "3.0 MiB copied",
+            "0.0 MiB linked",
+            "0.0 MiB hashed",
+            "0.0 MiB read for zsync metafiles",
+            "0.5 MiB read for torrents",
+            "2 files signed",
+        ], list(cost.describe()))
+
+
+class TestPublishHistory(TestCase):
+    def setUp(self):
+        super(TestPublishHistory, self).setUp()
+        self.use_temp_dir()
+        self.path = os.path.join(self.temp_dir, "log", "history")
+
+    def make_cost(self, **counters):
+        cost = PublishCost()
+        for name, amount in counters.items():
+            cost.add(name, amount)
+        return cost
+
+    def test_missing(self):
+        history = PublishHistory(self.path)
+        self.assertEqual([], history.entries())
+        self.assertIsNone(history.predict(self.make_cost(copied=100)))
+
+    def test_record(self):
+        history = PublishHistory(self.path)
+        history.record(self.make_cost(copied=100, signed=3), 12.34, now=1000)
+        with open(self.path) as f:
+            self.assertEqual(
+                "1000 12.3 copied=100 linked=0 hashed=0 zsync=0 torrent=0 "
+                "signed=3\n", f.read())
+        self.assertEqual([(12.3, {
+            "copied": 100, "linked": 0, "hashed": 0, "zsync": 0,
+            "torrent": 0, "signed": 3,
+        })], history.entries())
+
+    def test_record_keeps_recent(self):
+        history = PublishHistory(self.path, keep=2)
+        for elapsed in 1, 2, 3:
+            history.record(self.make_cost(copied=elapsed), elapsed)
+        self.assertEqual(
+            [2.0, 3.0], [elapsed for elapsed, _ in history.entries()])
+
+    def test_ignores_corrupt_lines(self):
+        with mkfile(self.path) as f:
+            f.write("garbage\n")
+            f.write("1000 10.0 copied=100\n")
+            f.write("1001 ten copied=100\n")
+        history = PublishHistory(self.path)
+        self.assertEqual([(10.0, {"copied": 100})], history.entries())
+
+    def test_predict(self):
+        history = PublishHistory(self.path)
+        history.record(self.make_cost(copied=100, hashed=100), 10)
+        history.record(self.make_cost(zsync=100, linked=1000), 20)
+        # 300 bytes of work took 30 seconds, so 50 bytes take 5.
+        self.assertEqual(
+            5, history.predict(self.make_cost(copied=25, torrent=25)))
+        self.assertEqual(0, history.predict(self.make_cost(linked=100)))
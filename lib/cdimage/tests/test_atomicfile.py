@@ -17,6 +17,8 @@
 
 """Unit tests for cdimage.atomicfile."""
 
+from __future__ import print_function
+
 import os
 
 from cdimage.atomicfile import AtomicFile
@@ -42,3 +44,30 @@ class TestAtomicFile(TestCase):
         with AtomicFile(foo):
             pass
         self.assertFalse(os.path.exists("%s.new" % foo))
+
+    def test_only_if_changed_identical(self):
+        """With only_if_changed, identical contents leave the file alone."""
+        self.use_temp_dir()
+        foo = os.path.join(self.temp_dir, "foo")
+        with AtomicFile(foo) as test:
+            test.write("string\u00e9")
+        inode = os.stat(foo).st_ino
+        atomic_file = AtomicFile(foo, only_if_changed=True)
+        with atomic_file as test:
+            print("string\u00e9", end="", file=test)
+        self.assertFalse(atomic_file.changed)
+        self.assertEqual(inode, os.stat(foo).st_ino)
+        self.assertFalse(os.path.exists("%s.new" % foo))
+
+    def test_only_if_changed_different(self):
+        """With only_if_changed, different contents replace the file."""
+        self.use_temp_dir()
+        foo = os.path.join(self.temp_dir, "foo")
+        with AtomicFile(foo) as test:
+            test.write("string")
+        atomic_file = AtomicFile(foo, only_if_changed=True)
+        with atomic_file as test:
+            test.write("strings")
+        self.assertTrue(atomic_file.changed)
+        with open(foo) as handle:
+            self.assertEqual("strings", handle.read())
@@ -26,14 +26,22 @@ import subprocess
 from textwrap import dedent
 import time
 
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
 from cdimage.checksums import (
     apply_sed,
     ChecksumFile,
     ChecksumFileSet,
     checksum_directory,
+    file_key,
     MetalinkChecksumFileSet,
     metalink_checksum_directory,
+    update_checksum_directory,
 )
+from cdimage import osextras
 from cdimage.config import Config
 from cdimage.tests.helpers import TestCase, mkfile, touch
 
@@ -236,6 +244,25 @@ class TestChecksumFile(TestCase):
             subprocess.call(
                 ["md5sum", "-c", "--status", "MD5SUMS"], cwd=self.temp_dir))
 
+    @mock.patch("cdimage.checksums.sign_cdimage")
+    def test_write_unchanged_skips_signing(self, mock_sign_cdimage):
+        checksum_file = ChecksumFile(
+            self.config, self.temp_dir, "MD5SUMS", hashlib.md5)
+        entry_path = os.path.join(self.temp_dir, "1")
+        with mkfile(entry_path) as entry:
+            print("1", end="", file=entry)
+        checksum_file.add("1")
+        checksum_file.write()
+        mock_sign_cdimage.assert_called_once_with(
+            self.config, checksum_file.path)
+        touch("%s.gpg" % checksum_file.path)
+        inode = os.stat(checksum_file.path).st_ino
+        checksum_file.remove("1")
+        checksum_file.add("1")
+        checksum_file.write()
+        self.assertEqual(1, mock_sign_cdimage.call_count)
+        self.assertEqual(inode, os.stat(checksum_file.path).st_ino)
+
     def test_context_manager(self):
         for name in "1", "2":
             entry_path = os.path.join(self.temp_dir, name)
@@ -313,6 +340,39 @@ class TestChecksumFileSet(TestCase):
         checksum_files.add("entry")
         self.assertChecksumsEqual({"entry": b"test\n"}, checksum_files)
 
+    @mock.patch("cdimage.fanout.FanoutReader.run", autospec=True)
+    def test_add_reads_once(self, mock_run):
+        entry_path = os.path.join(self.temp_dir, "entry")
+        touch(entry_path)
+        checksum_files = self.cls(self.config, self.temp_dir)
+        checksum_files.add("entry")
+        self.assertEqual(1, mock_run.call_count)
+        reader = mock_run.call_args[0][0]
+        self.assertEqual(entry_path, reader.path)
+        self.assertEqual(
+            sorted(cf.name for cf in checksum_files.checksum_files),
+            sorted(name for name, _ in reader.consumers))
+
+    @mock.patch("cdimage.fanout.FanoutReader.run", autospec=True)
+    def test_add_known(self, mock_run):
+        entry_path = os.path.join(self.temp_dir, "entry")
+        touch(entry_path)
+        known = {
+            file_key(entry_path): dict(
+                (cf.name, "known") for cf in self.cls(
+                    self.config, self.temp_dir).checksum_files)}
+        checksum_files = self.cls(self.config, self.temp_dir, known=known)
+        checksum_files.add("entry")
+        self.assertEqual(0, mock_run.call_count)
+        for checksum_file in checksum_files.checksum_files:
+            self.assertEqual({"entry": "known"}, checksum_file.entries)
+        # A different file under the same name is read.
+        with mkfile(entry_path) as entry:
+            print("changed", end="", file=entry)
+        checksum_files = self.cls(self.config, self.temp_dir, known=known)
+        checksum_files.add("entry")
+        self.assertEqual(1, mock_run.call_count)
+
     def test_remove(self):
         entry_path = os.path.join(self.temp_dir, "entry")
         data = "test\n"
@@ -438,6 +498,79 @@ class TestChecksumFileSet(TestCase):
                 %s *foo-i386.iso
                 """) % digests, md5sums.read())
 
+    def test_update_checksum_directory(self):
+        current_dir = os.path.join(self.temp_dir, "current")
+        osextras.ensuredir(current_dir)
+        for date in "20130320", "20130321":
+            date_dir = os.path.join(self.temp_dir, date)
+            for name in "foo-amd64.iso", "foo-i386.iso":
+                with mkfile(os.path.join(date_dir, name)) as image:
+                    print("%s/%s" % (date, name), end="", file=image)
+        date_dir = os.path.join(self.temp_dir, "20130321")
+        with mkfile(os.path.join(date_dir, "MD5SUMS")) as md5sums:
+            print("new-amd64 *foo-amd64.iso", file=md5sums)
+        for name in "foo-amd64.iso", "foo-i386.iso":
+            os.symlink(
+                os.path.join(os.pardir, "20130320", name),
+                os.path.join(current_dir, name))
+        with mkfile(os.path.join(current_dir, "MD5SUMS")) as md5sums:
+            print("old-amd64 *foo-amd64.iso", file=md5sums)
+            print("old-i386 *foo-i386.iso", file=md5sums)
+            print("old-powerpc *foo-powerpc.iso", file=md5sums)
+        for name in "foo-amd64.iso", "foo-i386.iso":
+            osextras.symlink_force(
+                os.path.join(os.pardir, "20130321", name),
+                os.path.join(current_dir, name))
+        update_checksum_directory(
+            self.config, current_dir,
+            {"foo-amd64.iso": date_dir, "foo-i386.iso": date_dir},
+            sign=False)
+        # foo-amd64.iso's checksum is copied from its new directory, while
+        # foo-i386.iso had to be checksummed.  Stale entries are dropped.
+        digest = hashlib.md5(b"20130321/foo-i386.iso").hexdigest()
+        with open(os.path.join(current_dir, "MD5SUMS")) as md5sums:
+            self.assertEqual(dedent("""\
+                new-amd64 *foo-amd64.iso
+                %s *foo-i386.iso
+                """) % digest, md5sums.read())
+
+    @mock.patch("cdimage.fanout.FanoutReader.run", autospec=True)
+    def test_update_checksum_directory_reads_once(self, mock_run):
+        current_dir = os.path.join(self.temp_dir, "current")
+        date_dir = os.path.join(self.temp_dir, "20130321")
+        osextras.ensuredir(current_dir)
+        for name in "foo-amd64.iso", "foo-i386.iso":
+            touch(os.path.join(date_dir, name))
+            os.symlink(
+                os.path.join(os.pardir, "20130321", name),
+                os.path.join(current_dir, name))
+        with mkfile(os.path.join(date_dir, "MD5SUMS")) as md5sums:
+            print("new-amd64 *foo-amd64.iso", file=md5sums)
+        update_checksum_directory(
+            self.config, current_dir,
+            {"foo-amd64.iso": date_dir, "foo-i386.iso": date_dir},
+            sign=False)
+        # Each entry is read once for all the checksums it still needs;
+        # foo-amd64.iso's MD5 was copied, so it is not computed.
+        self.assertEqual([
+            (os.path.join(current_dir, "foo-amd64.iso"),
+             ["SHA1SUMS", "SHA256SUMS"]),
+            (os.path.join(current_dir, "foo-i386.iso"),
+             ["MD5SUMS", "SHA1SUMS", "SHA256SUMS"]),
+        ], [
+            (call[0][0].path,
+             sorted(name for name, _ in call[0][0].consumers))
+            for call in mock_run.call_args_list])
+
+    def test_update_checksum_directory_keeps_unchanged(self):
+        with mkfile(os.path.join(self.temp_dir, "foo-amd64.iso")) as image:
+            print("foo-amd64.iso", end="", file=image)
+        with mkfile(os.path.join(self.temp_dir, "MD5SUMS")) as md5sums:
+            print("old-amd64 *foo-amd64.iso", file=md5sums)
+        update_checksum_directory(self.config, self.temp_dir, {}, sign=False)
+        with open(os.path.join(self.temp_dir, "MD5SUMS")) as md5sums:
+            self.assertEqual("old-amd64 *foo-amd64.iso\n", md5sums.read())
+
 
 class TestMetalinkChecksumFileSet(TestChecksumFileSet):
     def setUp(self):
@@ -460,6 +593,7 @@ class TestMetalinkChecksumFileSet(TestChecksumFileSet):
     def test_want_image(self):
         checksum_files = self.cls(self.config, self.temp_dir)
         self.assertTrue(checksum_files.want_image("foo.metalink"))
+        self.assertTrue(checksum_files.want_image("foo.meta4"))
         self.assertFalse(checksum_files.want_image("foo.iso"))
 
     def test_merge_all(self):
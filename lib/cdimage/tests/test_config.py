@@ -19,10 +19,28 @@
 
 from __future__ import print_function
 
+import fnmatch
 import os
 from textwrap import dedent
-
-from cdimage.config import Config, Series, all_series
+import time
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from cdimage import osextras
+from cdimage.config import (
+    Config,
+    RuleFormat,
+    Series,
+    all_series,
+    compile_arch,
+    compile_exact,
+    compile_glob,
+    compile_series,
+    config_snapshot_path,
+)
 from cdimage.tests.helpers import TestCase, mkfile
 
 __metaclass__ = type
@@ -186,6 +204,123 @@ class TestConfig(TestCase):
         config = Config()
         self.assertEqual("kubuntu", config["PROJECT"])
 
+    def write_old_config(self, text, age=10):
+        os.environ["CDIMAGE_ROOT"] = self.use_temp_dir()
+        config_path = os.path.join(self.temp_dir, "etc", "config")
+        with mkfile(config_path) as f:
+            print(dedent(text), file=f)
+        # Snapshots are only made of files that have not just changed.
+        old = time.time() - age
+        os.utime(config_path, (old, old))
+        return config_path
+
+    def read_without_shell(self, settle=True):
+        if settle:
+            # Looking up a missing key sets it to "" in the environment, so
+            # the first Config in a process may leave a different
+            # environment for the next one.
+            Config()
+        with mock.patch(
+                "cdimage.osextras.read_shell_config",
+                side_effect=AssertionError("shell used")):
+            return Config()
+
+    def test_read_snapshot(self):
+        os.environ.pop("CDIMAGE_EXTRA", None)
+        config_path = self.write_old_config("""\
+            #! /bin/sh
+            PROJECT="${PROJECT:-ubuntu}"
+            CAPPROJECT=Ubuntu
+            DIST=raring
+            export CDIMAGE_EXTRA="extra value"
+            """)
+        config = Config()
+        self.assertTrue(os.path.exists(config_snapshot_path(config_path)))
+        self.assertEqual(dict(config), dict(self.read_without_shell()))
+        self.assertEqual("ubuntu", config["PROJECT"])
+        self.assertEqual("extra value", config["CDIMAGE_EXTRA"])
+        self.assertEqual(Series.find_by_name("raring"), config["DIST"])
+
+    def test_read_snapshot_config_changed(self):
+        config_path = self.write_old_config("""\
+            PROJECT=ubuntu
+            """, age=20)
+        Config()
+        self.write_old_config("""\
+            PROJECT=kubuntu
+            """)
+        self.assertEqual("kubuntu", Config()["PROJECT"])
+        # Only snapshots of the current file are kept.
+        self.assertEqual("kubuntu", self.read_without_shell()["PROJECT"])
+        with open(config_snapshot_path(config_path)) as snapshot:
+            self.assertNotIn("\"ubuntu\"", snapshot.read())
+
+    def test_read_snapshot_environment_changed(self):
+        os.environ.pop("CDIMAGE_NEW", None)
+        os.environ["PROJECT"] = "ubuntu"
+        os.environ["SUFFIX"] = "one"
+        self.write_old_config("""\
+            PROJECT="${PROJECT:-ubuntu}"
+            CAPPROJECT="Ubuntu $SUFFIX"
+            """)
+        self.assertEqual("Ubuntu one", Config()["CAPPROJECT"])
+        self.read_without_shell()
+        # A whitelisted variable.
+        os.environ["PROJECT"] = "kubuntu"
+        self.assertEqual("kubuntu", Config()["PROJECT"])
+        # A variable that the file refers to.
+        os.environ["SUFFIX"] = "two"
+        self.assertEqual("Ubuntu two", Config()["CAPPROJECT"])
+        # A new CDIMAGE_* variable.
+        os.environ["CDIMAGE_NEW"] = "1"
+        self.assertEqual("1", Config()["CDIMAGE_NEW"])
+        # Each environment has its own snapshot.
+        os.environ["PROJECT"] = "ubuntu"
+        os.environ["SUFFIX"] = "one"
+        del os.environ["CDIMAGE_NEW"]
+        self.assertEqual(
+            "Ubuntu one",
+            self.read_without_shell(settle=False)["CAPPROJECT"])
+
+    def test_read_snapshot_recently_changed(self):
+        config_path = self.write_old_config("""\
+            PROJECT=ubuntu
+            """, age=0)
+        self.assertEqual("ubuntu", Config()["PROJECT"])
+        self.assertFalse(os.path.exists(config_snapshot_path(config_path)))
+
+    def test_read_snapshot_uncacheable(self):
+        for text in (
+                "PROJECT=$(echo ubuntu)",
+                "PROJECT=`echo ubuntu`",
+                ". /dev/null; PROJECT=ubuntu",
+                "PROJECT=ubuntu$$",
+                "CAPPROJECT=\"$RANDOM\"",
+                ):
+            config_path = self.write_old_config(text)
+            Config()
+            self.assertFalse(
+                os.path.exists(config_snapshot_path(config_path)), text)
+
+    def test_read_snapshot_corrupt(self):
+        config_path = self.write_old_config("""\
+            PROJECT=ubuntu
+            """)
+        with mkfile(config_snapshot_path(config_path)) as snapshot:
+            snapshot.write("[{\"stamp\": ")
+        self.assertEqual("ubuntu", Config()["PROJECT"])
+        self.assertEqual("ubuntu", self.read_without_shell()["PROJECT"])
+
+    def test_read_snapshot_read_only(self):
+        config_path = self.write_old_config("""\
+            PROJECT=ubuntu
+            """)
+        with mock.patch("tempfile.mkstemp", side_effect=OSError):
+            self.assertEqual("ubuntu", Config()["PROJECT"])
+        self.assertFalse(os.path.exists(config_snapshot_path(config_path)))
+        self.assertEqual(
+            ["config"], osextras.listdir_force(os.path.dirname(config_path)))
+
     def test_match_series(self):
         config = Config(read=False)
         config["DIST"] = "precise"
@@ -210,6 +345,54 @@ class TestConfig(TestCase):
         self.assertTrue(config.match_series("ubuntu-rtm/*"))
         self.assertTrue(config.match_series("ubuntu-rtm/14.09-"))
 
+    def test_compile_series(self):
+        # compile_series agrees with match_series for every series.
+        patterns = ["*", "ubuntu/*", "ubuntu-rtm/*", "ubuntu-rtm/14.09-"]
+        for name in ("lucid", "precise", "quantal", "14.09", "nonexistent"):
+            patterns.extend([
+                name, "%s-" % name, "-%s" % name, "precise-%s" % name])
+        for series in all_series:
+            config = Config(read=False)
+            config["DIST"] = series
+            for pattern in patterns:
+                self.assertEqual(
+                    config.match_series(pattern),
+                    compile_series(pattern)(config),
+                    "%s %s" % (series, pattern))
+
+    def test_compile_glob(self):
+        for pattern in ("*", "ubuntu", "ubuntu*", "*-server", "i?86", "[ab]*"):
+            match = compile_glob(pattern)
+            for name in ("ubuntu", "ubuntu-server", "i386", "arm64", ""):
+                self.assertEqual(
+                    fnmatch.fnmatchcase(name, pattern), match(name))
+        self.assertFalse(compile_exact("ubuntu*")("ubuntu"))
+        self.assertTrue(compile_arch("amd64")("amd64+mac"))
+        self.assertFalse(compile_arch("amd64+*")("amd64"))
+        self.assertTrue(compile_arch("amd64+*")("amd64+mac"))
+
+    def test_rule_format(self):
+        self.use_temp_dir()
+        path = os.path.join(self.temp_dir, "rules")
+        rules = RuleFormat(compile_glob, compile_series)
+        config = Config(read=False)
+        config["DIST"] = "precise"
+        self.assertEqual([], list(rules.matches(path, "ubuntu", config)))
+        with mkfile(path) as f:
+            print(dedent("""                # comment
+                ubuntu	lucid	one
+                malformed
+                ubuntu	precise-	two words
+                *	*	three"""), file=f)
+        self.assertEqual(
+            ["two words", "three"],
+            list(rules.matches(path, "ubuntu", config)))
+        self.assertEqual("three", rules.first_match(path, "kubuntu", config))
+        with mkfile(path) as f:
+            print("kubuntu\t*\tfour", file=f)
+        self.assertEqual("four", rules.first_match(path, "kubuntu", config))
+        self.assertIsNone(rules.first_match(path, "ubuntu", config))
+
     def test_arches_override(self):
         # If ARCHES is set in the environment, it overrides
         # etc/default-arches.
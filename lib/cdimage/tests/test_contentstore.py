@@ -0,0 +1,145 @@
+#! /usr/bin/python
+
+# Copyright (C) 2019 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for cdimage.contentstore."""
+
+from __future__ import print_function
+
+import hashlib
+import os
+
+from cdimage.config import Config
+from cdimage.contentstore import (
+    ContentStore,
+    clone_file,
+    file_digest,
+    remember_digest,
+)
+from cdimage.tests.helpers import TestCase, mkfile
+
+__metaclass__ = type
+
+
+class TestContentStore(TestCase):
+    def setUp(self):
+        super(TestContentStore, self).setUp()
+        self.use_temp_dir()
+        self.config = Config(read=False)
+        self.config.root = self.temp_dir
+        self.store = ContentStore(self.config)
+
+    def make_file(self, name, contents):
+        path = os.path.join(self.temp_dir, name)
+        with mkfile(path) as f:
+            print(contents, file=f, end="")
+        return path
+
+    def assertSameInode(self, first, second):
+        self.assertEqual(os.stat(first).st_ino, os.stat(second).st_ino)
+
+    def assertNotSameInode(self, first, second):
+        self.assertNotEqual(os.stat(first).st_ino, os.stat(second).st_ino)
+
+    def test_file_digest(self):
+        path = self.make_file("daily/foo.iso", "contents")
+        self.assertEqual(
+            hashlib.sha256(b"contents").hexdigest(), file_digest(path))
+
+    def test_remember_digest(self):
+        path = self.make_file("daily/foo.iso", "contents")
+        remember_digest(path, "remembered")
+        self.assertEqual("remembered", file_digest(path))
+        path = self.make_file("daily/foo.iso", "changed")
+        self.assertEqual(
+            hashlib.sha256(b"changed").hexdigest(), file_digest(path))
+
+    def test_clone_file(self):
+        source = self.make_file("source", "contents")
+        os.utime(source, (1000000000, 1000000000))
+        target = os.path.join(self.temp_dir, "target")
+        clone_file(source, target)
+        with open(target) as f:
+            self.assertEqual("contents", f.read())
+        self.assertEqual(1000000000, os.stat(target).st_mtime)
+        self.assertNotSameInode(source, target)
+
+    def test_link_shares_one_copy(self):
+        daily = self.make_file("daily/foo.iso", "contents")
+        pool = os.path.join(self.temp_dir, "simple/.pool/foo.iso")
+        full = os.path.join(self.temp_dir, "full/foo.iso")
+        os.makedirs(os.path.dirname(pool))
+        os.makedirs(os.path.dirname(full))
+        self.store.link(daily, pool)
+        self.store.link(daily, full)
+        self.assertSameInode(pool, full)
+        self.assertSameInode(
+            pool, self.store.object_path(file_digest(daily)))
+        # The daily build is never linked into the published trees.
+        self.assertNotSameInode(daily, pool)
+        self.assertEqual(3, os.stat(pool).st_nlink)
+
+    def test_link_different_contents(self):
+        first = self.make_file("daily/first.iso", "first")
+        second = self.make_file("daily/second.iso", "second")
+        first_target = os.path.join(self.temp_dir, "first.iso")
+        second_target = os.path.join(self.temp_dir, "second.iso")
+        self.store.link(first, first_target)
+        self.store.link(second, second_target)
+        self.assertNotSameInode(first_target, second_target)
+
+    def test_link_keeps_identical_target(self):
+        daily = self.make_file("daily/foo.iso", "contents")
+        target = self.make_file("full/foo.iso", "contents")
+        inode = os.stat(target).st_ino
+        self.store.link(daily, target)
+        self.assertEqual(inode, os.stat(target).st_ino)
+        self.assertSameInode(
+            target, self.store.object_path(file_digest(daily)))
+
+    def test_link_replaces_changed_target(self):
+        daily = self.make_file("daily/foo.iso", "new contents")
+        target = self.make_file("full/foo.iso", "old contents")
+        self.store.link(daily, target)
+        with open(target) as f:
+            self.assertEqual("new contents", f.read())
+        self.assertEqual([], [
+            name for name in os.listdir(os.path.dirname(target))
+            if name != "foo.iso"])
+
+    def test_link_replaces_symlink(self):
+        daily = self.make_file("daily/foo.iso", "contents")
+        target = os.path.join(self.temp_dir, "foo.iso")
+        os.symlink(daily, target)
+        self.store.link(daily, target)
+        self.assertFalse(os.path.islink(target))
+        self.assertNotSameInode(daily, target)
+
+    def test_prune(self):
+        daily = self.make_file("daily/foo.iso", "contents")
+        other = self.make_file("daily/bar.iso", "other")
+        target = os.path.join(self.temp_dir, "foo.iso")
+        self.store.link(daily, target)
+        unreferenced = self.store.add(other)
+        self.store.prune()
+        self.assertTrue(os.path.exists(unreferenced))
+        self.store.prune(grace=0)
+        self.assertFalse(os.path.exists(unreferenced))
+        self.assertTrue(
+            os.path.exists(self.store.object_path(file_digest(daily))))
+        os.unlink(target)
+        self.store.prune(grace=0)
+        self.assertFalse(
+            os.path.exists(self.store.object_path(file_digest(daily))))
@@ -0,0 +1,159 @@
+#! /usr/bin/python
+
+# Copyright (C) 2019 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for cdimage.fanout."""
+
+import hashlib
+import os
+import subprocess
+import threading
+import time
+
+from cdimage.fanout import FanoutReader, PipeConsumer
+from cdimage.tests.helpers import TestCase, mkfile
+
+__metaclass__ = type
+
+
+class RecordingConsumer:
+    def __init__(self, fail_after=None, delay=0, error="consumer failed"):
+        self.data = []
+        self.fail_after = fail_after
+        self.error = error
+        self.delay = delay
+        self.finished = None
+
+    def update(self, data):
+        if self.fail_after is not None and len(self.data) >= self.fail_after:
+            raise ValueError(self.error)
+        time.sleep(self.delay)
+        self.data.append(data)
+
+    def close(self):
+        self.finished = "close"
+
+    def abort(self):
+        self.finished = "abort"
+
+
+class TestFanoutReader(TestCase):
+    def setUp(self):
+        super(TestFanoutReader, self).setUp()
+        self.use_temp_dir()
+        self.path = os.path.join(self.temp_dir, "image.iso")
+        self.data = os.urandom(100000)
+        with mkfile(self.path, mode="wb") as image:
+            image.write(self.data)
+
+    def test_single_consumer(self):
+        reader = FanoutReader(self.path, bufsize=4096)
+        md5 = reader.add("md5", hashlib.md5())
+        self.assertEqual(len(self.data), reader.run())
+        self.assertEqual(hashlib.md5(self.data).hexdigest(), md5.hexdigest())
+        self.assertEqual(["md5"], list(reader.cpu_times))
+
+    def test_many_consumers(self):
+        reader = FanoutReader(self.path, bufsize=4096)
+        hash_objs = [
+            reader.add(name, getattr(hashlib, name)())
+            for name in ("md5", "sha1", "sha256")]
+        recorder = reader.add("recorder", RecordingConsumer())
+        self.assertEqual(len(self.data), reader.run())
+        for hash_obj in hash_objs:
+            self.assertEqual(
+                getattr(hashlib, hash_obj.name)(self.data).hexdigest(),
+                hash_obj.hexdigest())
+        self.assertEqual(self.data, b"".join(recorder.data))
+        self.assertEqual(
+            [4096] * 24 + [100000 - 4096 * 24],
+            [len(data) for data in recorder.data])
+        self.assertEqual("close", recorder.finished)
+        self.assertEqual(
+            ["md5", "recorder", "sha1", "sha256"], sorted(reader.cpu_times))
+        self.assertEqual(len(self.data), reader.length)
+
+    def test_no_consumers(self):
+        reader = FanoutReader(self.path)
+        self.assertEqual(0, reader.run())
+
+    def test_single_consumer_error(self):
+        reader = FanoutReader(self.path, bufsize=4096)
+        consumer = reader.add("failing", RecordingConsumer(fail_after=2))
+        self.assertRaisesRegex(ValueError, "consumer failed", reader.run)
+        self.assertEqual("abort", consumer.finished)
+        self.assertIn("failing", reader.cpu_times)
+
+    def test_consumer_error_aborts_others(self):
+        reader = FanoutReader(self.path, bufsize=4096, depth=1)
+        good = reader.add("good", RecordingConsumer())
+        bad = reader.add("bad", RecordingConsumer(fail_after=2))
+        self.assertRaisesRegex(ValueError, "consumer failed", reader.run)
+        self.assertEqual("abort", good.finished)
+        # The failing consumer is not called again after its error.
+        self.assertIsNone(bad.finished)
+        # Reading stops soon after the error.
+        self.assertLess(reader.length, len(self.data))
+
+    def test_first_error_in_registration_order(self):
+        reader = FanoutReader(self.path, bufsize=4096)
+        # Both consumers see the first buffer, and both fail on it.
+        reader.add("first", RecordingConsumer(fail_after=0, error="first"))
+        reader.add("second", RecordingConsumer(fail_after=0, error="second"))
+        self.assertRaisesRegex(ValueError, "^first$", reader.run)
+
+    def test_backpressure(self):
+        # A slow consumer holds the reader back to within depth buffers.
+        reader = FanoutReader(self.path, bufsize=4096, depth=2)
+        slow = RecordingConsumer(delay=0.01)
+        reader.add("slow", slow)
+        reader.add("fast", hashlib.md5())
+        lags = []
+        done = threading.Event()
+
+        def watch():
+            while not done.is_set():
+                lags.append(reader.length // 4096 - len(slow.data))
+                time.sleep(0.002)
+
+        watcher = threading.Thread(target=watch)
+        watcher.start()
+        try:
+            reader.run()
+        finally:
+            done.set()
+            watcher.join()
+        self.assertEqual(self.data, b"".join(slow.data))
+        # At most depth buffers queued, one being consumed, and one that
+        # the reader has read but not yet managed to queue.
+        self.assertLessEqual(max(lags), 4)
+
+    def test_pipe_consumer(self):
+        output_path = os.path.join(self.temp_dir, "copy")
+        reader = FanoutReader(self.path, bufsize=4096)
+        md5 = reader.add("md5", hashlib.md5())
+        with open(output_path, "wb") as output:
+            reader.add("cat", PipeConsumer(["cat"], stdout=output))
+            reader.run()
+        with open(output_path, "rb") as output:
+            self.assertEqual(self.data, output.read())
+        self.assertEqual(hashlib.md5(self.data).hexdigest(), md5.hexdigest())
+
+    def test_pipe_consumer_failure(self):
+        reader = FanoutReader(self.path, bufsize=4096)
+        with open(os.devnull, "wb") as devnull:
+            reader.add("cat", PipeConsumer(
+                ["sh", "-c", "cat; exit 3"], stdout=devnull))
+            self.assertRaises(subprocess.CalledProcessError, reader.run)
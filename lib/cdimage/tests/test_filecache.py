@@ -0,0 +1,63 @@
+#! /usr/bin/python
+
+# Copyright (C) 2019 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for cdimage.filecache."""
+
+from __future__ import print_function
+
+import os
+
+from cdimage.filecache import clear_cache, load_cached
+from cdimage.tests.helpers import TestCase, mkfile
+
+__metaclass__ = type
+
+
+class TestFileCache(TestCase):
+    def setUp(self):
+        super(TestFileCache, self).setUp()
+        self.use_temp_dir()
+        self.addCleanup(clear_cache)
+        self.parsed = []
+
+    def parse(self, path):
+        with open(path) as f:
+            self.parsed.append(path)
+            return f.read()
+
+    def test_load_cached_reuses_result(self):
+        path = os.path.join(self.temp_dir, "rules")
+        with mkfile(path) as f:
+            print("one", file=f)
+        self.assertEqual("one\n", load_cached(path, self.parse))
+        self.assertEqual("one\n", load_cached(path, self.parse))
+        self.assertEqual([path], self.parsed)
+
+    def test_load_cached_notices_changes(self):
+        path = os.path.join(self.temp_dir, "rules")
+        with mkfile(path) as f:
+            print("one", file=f)
+        self.assertEqual("one\n", load_cached(path, self.parse))
+        with mkfile(path) as f:
+            print("two", file=f)
+        os.utime(path, (0, 0))
+        self.assertEqual("two\n", load_cached(path, self.parse))
+        self.assertEqual([path, path], self.parsed)
+
+    def test_load_cached_missing(self):
+        self.assertRaises(
+            OSError, load_cached, os.path.join(self.temp_dir, "missing"),
+            self.parse)
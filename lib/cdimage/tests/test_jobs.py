@@ -0,0 +1,183 @@
+#! /usr/bin/python
+
+# Copyright (C) 2019 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for cdimage.jobs."""
+
+import threading
+import time
+
+from cdimage.config import Config
+from cdimage.jobs import BackgroundJobs, Plan, job_count, map_parallel
+from cdimage.log import logger
+from cdimage.tests.helpers import TestCase
+
+__metaclass__ = type
+
+
+class TestJobs(TestCase):
+    def test_job_count_default(self):
+        config = Config(read=False)
+        self.assertEqual(4, job_count(config))
+
+    def test_job_count_configured(self):
+        config = Config(read=False)
+        config["CDIMAGE_PUBLISH_JOBS"] = "2"
+        self.assertEqual(2, job_count(config))
+        config["CDIMAGE_PUBLISH_JOBS"] = "0"
+        self.assertEqual(1, job_count(config))
+
+    def test_map_parallel_preserves_order(self):
+        def slow_identity(delay, value):
+            time.sleep(delay)
+            return value
+
+        self.assertEqual(
+            ["a", "b", "c"],
+            map_parallel(
+                slow_identity, [(0.05, "a"), (0.01, "b"), (0, "c")], jobs=3))
+
+    def test_map_parallel_runs_concurrently(self):
+        barrier = threading.Event()
+        seen = []
+
+        def wait_for_peer(value):
+            seen.append(value)
+            if len(seen) == 2:
+                barrier.set()
+            # With only one thread this would time out and return False.
+            return barrier.wait(5)
+
+        self.assertEqual([True, True], map_parallel(
+            wait_for_peer, [("a",), ("b",)], jobs=2))
+
+    def test_map_parallel_serial(self):
+        calls = []
+        self.assertEqual(
+            [2, 4], map_parallel(
+                lambda n: calls.append(n) or n * 2, [(1,), (2,)], jobs=1))
+        self.assertEqual([1, 2], calls)
+
+    def test_map_parallel_raises_first_error(self):
+        finished = []
+
+        def maybe_fail(value):
+            if value == "bad":
+                raise ValueError(value)
+            time.sleep(0.01)
+            finished.append(value)
+
+        self.assertRaisesRegex(
+            ValueError, "bad", map_parallel,
+            maybe_fail, [("good",), ("bad",), ("also good",)], jobs=3)
+        self.assertCountEqual(["good", "also good"], finished)
+
+    def test_background_jobs_run_before_join(self):
+        started = threading.Event()
+        jobs = BackgroundJobs(jobs=2)
+        jobs.submit("a", started.set)
+        # The job runs without waiting for join.
+        self.assertTrue(started.wait(5))
+        self.assertEqual([("a", None)], [
+            (label, result) for label, result, _ in jobs.join()])
+
+    def test_background_jobs_join_in_submission_order(self):
+        def slow_identity(delay, value):
+            time.sleep(delay)
+            return value
+
+        jobs = BackgroundJobs(jobs=3)
+        jobs.submit("first", slow_identity, 0.05, 1)
+        jobs.submit("second", slow_identity, 0, 2)
+        finished = jobs.join()
+        self.assertEqual(
+            [("first", 1), ("second", 2)],
+            [(label, result) for label, result, _ in finished])
+        self.assertGreaterEqual(finished[0][2], 0.04)
+        self.assertEqual([], jobs.join())
+
+    def test_background_jobs_raises_first_error(self):
+        def fail(value):
+            raise ValueError(value)
+
+        jobs = BackgroundJobs(jobs=2)
+        jobs.submit("a", fail, "first")
+        jobs.submit("b", fail, "second")
+        self.assertRaisesRegex(ValueError, "first", jobs.join)
+        self.assertEqual([], jobs.join())
+
+    def test_plan_describe(self):
+        plan = Plan()
+        first = plan.add("first", len, ("a",), size=1024 * 1024)
+        second = plan.add("second", len, ("b",), size=512 * 1024)
+        plan.add("third", len, ("c",), after=[first, second])
+        self.assertEqual([
+            "1. first (1.0 MiB)",
+            "2. second (0.5 MiB)",
+            "3. third [after 1, 2]",
+        ], plan.describe())
+        self.assertEqual(1536 * 1024, plan.size)
+
+    def test_plan_runs_independent_operations_concurrently(self):
+        barrier = threading.Event()
+        seen = []
+
+        def wait_for_peer(value):
+            seen.append(value)
+            if len(seen) == 2:
+                barrier.set()
+            self.assertTrue(barrier.wait(5))
+
+        plan = Plan()
+        first = plan.add("a", wait_for_peer, ("a",))
+        second = plan.add("b", wait_for_peer, ("b",))
+        plan.add("c", seen.append, ("c",), after=[first, second])
+        plan.run(jobs=2)
+        self.assertCountEqual(["a", "b"], seen[:2])
+        self.assertEqual("c", seen[2])
+
+    def test_plan_logs_in_plan_order(self):
+        def log_later(delay, message):
+            time.sleep(delay)
+            logger.info(message)
+
+        self.capture_logging()
+        plan = Plan()
+        plan.add("slow", log_later, (0.05, "slow"))
+        plan.add("fast", log_later, (0, "fast"))
+        plan.run(jobs=2)
+        self.assertLogEqual(["slow", "fast"])
+
+    def test_plan_serial(self):
+        calls = []
+        plan = Plan()
+        plan.add("a", calls.append, ("a",))
+        plan.add("b", calls.append, ("b",))
+        plan.run(jobs=1)
+        self.assertEqual(["a", "b"], calls)
+
+    def test_plan_failure_skips_dependants(self):
+        calls = []
+
+        def fail():
+            raise ValueError("failed")
+
+        plan = Plan()
+        failed = plan.add("fail", fail)
+        independent = plan.add("independent", calls.append, ("independent",))
+        plan.add("dependant", calls.append, ("dependant",), after=[failed])
+        plan.add("later", calls.append, ("later",), after=[independent])
+        self.assertRaisesRegex(ValueError, "failed", plan.run, jobs=2)
+        self.assertNotIn("dependant", calls)
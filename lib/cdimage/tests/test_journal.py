@@ -0,0 +1,197 @@
+#! /usr/bin/python
+
+# Copyright (C) 2019 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for cdimage.journal."""
+
+import os
+
+from cdimage.config import Config
+from cdimage.journal import PublishJournal, journal_path, output_stamp
+from cdimage.tests.helpers import TestCase, mkfile, touch
+
+__metaclass__ = type
+
+
+class TestPublishJournal(TestCase):
+    def setUp(self):
+        super(TestPublishJournal, self).setUp()
+        self.use_temp_dir()
+        self.path = os.path.join(self.temp_dir, "target", ".publish-journal")
+
+    def test_output_stamp(self):
+        path = os.path.join(self.temp_dir, "output")
+        self.assertIsNone(output_stamp(path))
+        with mkfile(path) as f:
+            f.write("data")
+        self.assertEqual([4, os.stat(path).st_ino], output_stamp(path))
+
+    def test_output_stamp_directory(self):
+        path = os.path.join(self.temp_dir, "directory")
+        os.mkdir(path)
+        stamp = output_stamp(path)
+        self.assertEqual([None, os.stat(path).st_ino], stamp)
+        touch(os.path.join(path, "entry"))
+        self.assertEqual(stamp, output_stamp(path))
+
+    def test_journal_path(self):
+        config = Config(read=False)
+        config.root = self.temp_dir
+        self.assertEqual(
+            os.path.join(
+                self.temp_dir, "log", "publish-journal",
+                "www%2Ffull%2Fdaily-live%2F20130320.publish-desktop"),
+            journal_path(
+                config,
+                os.path.join(
+                    self.temp_dir, "www", "full", "daily-live", "20130320"),
+                name="publish-desktop"))
+
+    def test_missing(self):
+        journal = PublishJournal(self.path)
+        self.assertFalse(journal.resuming)
+        self.assertFalse(journal.completed("step"))
+
+    def test_record(self):
+        journal = PublishJournal(self.path)
+        journal.record("step")
+        self.assertTrue(journal.resuming)
+        self.assertTrue(journal.completed("step"))
+        self.assertTrue(PublishJournal(self.path).completed("step"))
+        self.assertFalse(PublishJournal(self.path).completed("other"))
+
+    def test_outputs_verified(self):
+        output = os.path.join(self.temp_dir, "output")
+        with mkfile(output) as f:
+            f.write("data")
+        journal = PublishJournal(self.path)
+        journal.record("step", outputs=[output])
+        self.assertTrue(PublishJournal(self.path).completed("step"))
+        # A different size means the output was not completely written.
+        with mkfile(output) as f:
+            f.write("more data")
+        self.assertFalse(PublishJournal(self.path).completed("step"))
+        os.unlink(output)
+        self.assertFalse(PublishJournal(self.path).completed("step"))
+
+    def test_outputs_replaced(self):
+        output = os.path.join(self.temp_dir, "output")
+        with mkfile(output) as f:
+            f.write("data")
+        journal = PublishJournal(self.path)
+        journal.record("step", outputs=[output])
+        # Same size, but a different file.
+        with mkfile("%s.new" % output) as f:
+            f.write("atad")
+        os.rename("%s.new" % output, output)
+        self.assertFalse(PublishJournal(self.path).completed("step"))
+
+    def test_requires(self):
+        journal = PublishJournal(self.path)
+        journal.record("step", requires=["other"])
+        self.assertFalse(journal.completed("step"))
+        journal.record("other")
+        self.assertTrue(journal.completed("step"))
+
+    def test_ignores_corrupt_lines(self):
+        journal = PublishJournal(self.path)
+        journal.record("step")
+        with open(self.path, "a") as f:
+            f.write('{"key": "interrupted", "outp')
+        journal = PublishJournal(self.path)
+        self.assertTrue(journal.completed("step"))
+        self.assertFalse(journal.completed("interrupted"))
+
+    def test_run(self):
+        calls = []
+        journal = PublishJournal(self.path)
+        journal.run("step", calls.append, 1)
+        self.assertEqual([1], calls)
+        journal = PublishJournal(self.path)
+        self.capture_logging()
+        journal.run("step", calls.append, 2)
+        self.assertEqual([1], calls)
+        self.assertLogEqual(["Skipping step (already done)"])
+
+    def test_run_outputs(self):
+        output = os.path.join(self.temp_dir, "output")
+
+        def write():
+            with mkfile(output) as f:
+                f.write("data")
+
+        journal = PublishJournal(self.path)
+        journal.run("step", write, outputs=lambda: [output])
+        self.assertTrue(PublishJournal(self.path).completed("step"))
+        os.unlink(output)
+        journal = PublishJournal(self.path)
+        self.assertFalse(journal.completed("step"))
+        journal.run("step", write, outputs=lambda: [output])
+        self.assertTrue(os.path.exists(output))
+
+    def test_run_failure_not_recorded(self):
+        def fail():
+            raise ValueError("failed")
+
+        journal = PublishJournal(self.path)
+        self.assertRaises(ValueError, journal.run, "step", fail)
+        self.assertFalse(journal.completed("step"))
+
+    def test_move(self):
+        source = os.path.join(self.temp_dir, "source")
+        target = os.path.join(self.temp_dir, "target", "image")
+        with mkfile(source) as f:
+            f.write("data")
+        touch(target)
+        journal = PublishJournal(self.path)
+        self.assertIsNone(journal.moved(source))
+        journal.move(source, target)
+        self.assertFalse(os.path.exists(source))
+        with open(target) as f:
+            self.assertEqual("data", f.read())
+        journal = PublishJournal(self.path)
+        self.assertEqual(target, journal.moved(source))
+        # A later step may modify the target; the move is still done.
+        with mkfile(target) as f:
+            f.write("modified")
+        journal.move(source, target)
+        with open(target) as f:
+            self.assertEqual("modified", f.read())
+
+    def test_move_source_reappeared(self):
+        source = os.path.join(self.temp_dir, "source")
+        target = os.path.join(self.temp_dir, "target", "image")
+        with mkfile(source) as f:
+            f.write("old")
+        os.makedirs(os.path.dirname(target))
+        journal = PublishJournal(self.path)
+        journal.move(source, target)
+        # A new build has produced the source again, so it must be moved.
+        with mkfile(source) as f:
+            f.write("new")
+        journal = PublishJournal(self.path)
+        self.assertIsNone(journal.moved(source))
+        journal.move(source, target)
+        self.assertFalse(os.path.exists(source))
+        with open(target) as f:
+            self.assertEqual("new", f.read())
+
+    def test_remove(self):
+        journal = PublishJournal(self.path)
+        journal.record("step")
+        journal.remove()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(journal.resuming)
+        journal.remove()
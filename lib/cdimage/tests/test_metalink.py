@@ -0,0 +1,140 @@
+#! /usr/bin/python
+
+# Copyright (C) 2019 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for cdimage.metalink."""
+
+from __future__ import print_function
+
+import hashlib
+import os
+from xml.etree import ElementTree
+
+from cdimage.config import Config
+from cdimage.metalink import (
+    image_digests,
+    metalink3,
+    metalink4,
+    write_metalinks,
+)
+from cdimage.tests.helpers import TestCase, mkfile, touch
+
+__metaclass__ = type
+
+
+ns3 = "{http://www.metalinker.org/}"
+ns4 = "{urn:ietf:params:xml:ns:metalink}"
+
+
+class TestMetalink(TestCase):
+    def setUp(self):
+        super(TestMetalink, self).setUp()
+        self.use_temp_dir()
+        self.config = Config(read=False)
+
+    def make_image(self, name, contents, sums=("SHA256SUMS",)):
+        path = os.path.join(self.temp_dir, name)
+        with mkfile(path) as f:
+            print(contents, end="", file=f)
+        for checksum_name in sums:
+            with mkfile(os.path.join(self.temp_dir, checksum_name),
+                        mode="a") as f:
+                print("%s-of-%s *%s" % (checksum_name, name, name), file=f)
+        return path
+
+    def test_image_digests(self):
+        self.make_image("foo.iso", "foo", sums=("MD5SUMS", "SHA256SUMS"))
+        self.make_image("bar.iso", "bar", sums=("MD5SUMS",))
+        # Listed, but gone.
+        self.make_image("gone.iso", "gone")
+        os.unlink(os.path.join(self.temp_dir, "gone.iso"))
+        self.assertEqual({
+            # Digests are taken from the checksum files, not the images.
+            "foo.iso": {
+                "MD5SUMS": "MD5SUMS-of-foo.iso",
+                "SHA256SUMS": "SHA256SUMS-of-foo.iso",
+            },
+            # SHA-256 is always available.
+            "bar.iso": {
+                "MD5SUMS": "MD5SUMS-of-bar.iso",
+                "SHA256SUMS": hashlib.sha256(b"bar").hexdigest(),
+            },
+        }, image_digests(self.config, self.temp_dir))
+
+    def test_metalink3(self):
+        root = ElementTree.fromstring(metalink3(
+            "foo & bar.iso", 123,
+            {"MD5SUMS": "md5", "SHA256SUMS": "sha256"},
+            ["https://a/foo.iso", "http://b/foo.iso"],
+            torrent_url="https://a/foo.iso.torrent",
+            identity="Ubuntu", version="13.04"))
+        self.assertEqual("3.0", root.get("version"))
+        files = root.findall("%sfiles/%sfile" % (ns3, ns3))
+        self.assertEqual(1, len(files))
+        self.assertEqual("foo & bar.iso", files[0].get("name"))
+        self.assertEqual("Ubuntu", files[0].findtext("%sidentity" % ns3))
+        self.assertEqual("13.04", files[0].findtext("%sversion" % ns3))
+        self.assertEqual("123", files[0].findtext("%ssize" % ns3))
+        self.assertEqual([("md5", "md5"), ("sha256", "sha256")], [
+            (digest.get("type"), digest.text) for digest in files[0].findall(
+                "%sverification/%shash" % (ns3, ns3))])
+        self.assertEqual([
+            ("bittorrent", "https://a/foo.iso.torrent"),
+            ("https", "https://a/foo.iso"),
+            ("http", "http://b/foo.iso"),
+        ], [
+            (url.get("type"), url.text) for url in files[0].findall(
+                "%sresources/%surl" % (ns3, ns3))])
+
+    def test_metalink4(self):
+        root = ElementTree.fromstring(metalink4(
+            "foo.iso", 123, {"SHA1SUMS": "sha1", "SHA256SUMS": "sha256"},
+            ["https://a/foo.iso", "http://b/foo.iso"],
+            torrent_url="https://a/foo.iso.torrent"))
+        files = root.findall("%sfile" % ns4)
+        self.assertEqual(1, len(files))
+        self.assertEqual("123", files[0].findtext("%ssize" % ns4))
+        self.assertEqual([("sha-1", "sha1"), ("sha-256", "sha256")], [
+            (digest.get("type"), digest.text)
+            for digest in files[0].findall("%shash" % ns4)])
+        self.assertEqual([
+            ("1", "https://a/foo.iso"), ("2", "http://b/foo.iso"),
+        ], [
+            (url.get("priority"), url.text)
+            for url in files[0].findall("%surl" % ns4)])
+        self.assertEqual(
+            "https://a/foo.iso.torrent",
+            files[0].findtext("%smetaurl" % ns4))
+
+    def test_write_metalinks(self):
+        self.make_image("foo.iso", "foo")
+        touch(os.path.join(self.temp_dir, "foo.iso.torrent"))
+        touch(os.path.join(self.temp_dir, "old.iso.metalink"))
+        self.assertEqual(
+            ["foo.iso.meta4", "foo.iso.metalink"],
+            write_metalinks(
+                self.config, self.temp_dir, ["https://a/dir", "https://b/"],
+                identity="Ubuntu", version="13.04"))
+        self.assertFalse(
+            os.path.exists(os.path.join(self.temp_dir, "old.iso.metalink")))
+        root = ElementTree.parse(
+            os.path.join(self.temp_dir, "foo.iso.metalink")).getroot()
+        self.assertEqual([
+            "https://a/dir/foo.iso.torrent",
+            "https://a/dir/foo.iso",
+            "https://b/foo.iso",
+        ], [url.text for url in root.iter("%surl" % ns3)])
+        self.assertTrue(
+            os.path.exists(os.path.join(self.temp_dir, "foo.iso.meta4")))
@@ -0,0 +1,82 @@
+#! /usr/bin/python
+
+# Copyright (C) 2019 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for cdimage.staging."""
+
+from __future__ import print_function
+
+import os
+
+from cdimage.staging import StagingArea, file_stamp
+from cdimage.tests.helpers import TestCase, mkfile, touch
+
+__metaclass__ = type
+
+
+class TestStagingArea(TestCase):
+    def setUp(self):
+        super(TestStagingArea, self).setUp()
+        self.use_temp_dir()
+        self.staging = StagingArea(os.path.join(self.temp_dir, "staging"))
+        self.source = os.path.join(self.temp_dir, "daily", "foo.iso")
+        with mkfile(self.source) as f:
+            print("daily", file=f)
+
+    def stage(self, name):
+        touch(self.staging.path(name))
+        self.staging.record(name, self.source)
+
+    def test_file_stamp(self):
+        st = os.stat(self.source)
+        self.assertEqual(
+            "%d:%d:%d:%r" % (st.st_dev, st.st_ino, st.st_size, st.st_mtime),
+            file_stamp(self.source))
+
+    def test_lookup(self):
+        self.assertIsNone(self.staging.lookup("bar.iso", self.source))
+        self.stage("bar.iso")
+        self.assertEqual(
+            self.staging.path("bar.iso"),
+            self.staging.lookup("bar.iso", self.source))
+
+    def test_lookup_persists(self):
+        self.stage("bar.iso")
+        self.staging.write()
+        staging = StagingArea(self.staging.directory)
+        self.assertEqual(
+            self.staging.path("bar.iso"),
+            staging.lookup("bar.iso", self.source))
+
+    def test_lookup_source_replaced(self):
+        self.stage("bar.iso")
+        os.unlink(self.source)
+        with mkfile(self.source) as f:
+            print("daily", file=f)
+        self.assertIsNone(self.staging.lookup("bar.iso", self.source))
+
+    def test_lookup_staged_file_removed(self):
+        self.stage("bar.iso")
+        os.unlink(self.staging.path("bar.iso"))
+        self.assertIsNone(self.staging.lookup("bar.iso", self.source))
+
+    def test_write_forgets_removed_files(self):
+        self.stage("bar.iso")
+        self.stage("baz.iso")
+        os.unlink(self.staging.path("baz.iso"))
+        self.staging.write()
+        with open(self.staging.index_path) as index:
+            self.assertEqual(
+                ["bar.iso %s\n" % file_stamp(self.source)], index.readlines())
@@ -0,0 +1,156 @@
+#! /usr/bin/python
+
+# Copyright (C) 2019 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for cdimage.torrent."""
+
+import hashlib
+import os
+import subprocess
+from unittest import skipUnless
+
+from cdimage import osextras
+from cdimage.tests.helpers import TestCase, mkfile
+from cdimage.torrent import (
+    TorrentMetafile,
+    bdecode,
+    bencode,
+    make_torrent_metafile,
+    piece_length,
+)
+
+__metaclass__ = type
+
+
+btmakemetafile_available = osextras.find_on_path("btmakemetafile")
+
+
+class TestTorrent(TestCase):
+    def setUp(self):
+        super(TestTorrent, self).setUp()
+        self.use_temp_dir()
+
+    def test_bencode(self):
+        self.assertEqual(b"i42e", bencode(42))
+        self.assertEqual(b"i-3e", bencode(-3))
+        self.assertEqual(b"4:spam", bencode(b"spam"))
+        self.assertEqual(b"4:spam", bencode(u"spam"))
+        self.assertEqual(b"l4:spami42ee", bencode([b"spam", 42]))
+        self.assertEqual(
+            b"d3:bar4:spam3:fooi42ee", bencode({"foo": 42, "bar": b"spam"}))
+        self.assertRaises(TypeError, bencode, True)
+        self.assertRaises(TypeError, bencode, 1.5)
+
+    def test_bdecode(self):
+        value = {b"a": [b"b", 1, {b"c": b""}], b"d": -1}
+        self.assertEqual(value, bdecode(bencode(value)))
+        self.assertRaises(ValueError, bdecode, b"4:abc")
+        self.assertRaises(ValueError, bdecode, b"i1ei2e")
+        self.assertRaises(ValueError, bdecode, b"x")
+
+    def test_piece_length(self):
+        self.assertEqual(2 ** 15, piece_length(0))
+        self.assertEqual(2 ** 15, piece_length(4 * 1024 * 1024))
+        self.assertEqual(2 ** 16, piece_length(4 * 1024 * 1024 + 1))
+        self.assertEqual(2 ** 19, piece_length(700 * 1024 * 1024))
+        self.assertEqual(2 ** 20, piece_length(3 * 1024 * 1024 * 1024))
+        self.assertEqual(2 ** 21, piece_length(9 * 1024 * 1024 * 1024))
+
+    def test_info(self):
+        data = os.urandom(100)
+        metafile = TorrentMetafile(32)
+        metafile.update(data)
+        self.assertEqual({
+            "length": 100,
+            "name": "foo.iso",
+            "piece length": 32,
+            "pieces": b"".join(
+                hashlib.sha1(data[offset:offset + 32]).digest()
+                for offset in range(0, 100, 32)),
+        }, metafile.info("foo.iso"))
+
+    def test_update_is_incremental(self):
+        data = os.urandom(10000)
+        whole = TorrentMetafile(1024)
+        whole.update(data)
+        pieces = TorrentMetafile(1024)
+        for offset in range(0, len(data), 777):
+            pieces.update(data[offset:offset + 777])
+        self.assertEqual(whole.info("foo"), pieces.info("foo"))
+
+    def test_getvalue(self):
+        metafile = TorrentMetafile(32)
+        metafile.update(b"x" * 32)
+        metainfo = bdecode(metafile.getvalue(
+            "foo.iso", "https://tracker/announce",
+            announce_list=[["https://tracker/announce"], ["https://ipv6"]],
+            comment="Ubuntu CD releases.ubuntu.com", creation_date=1000))
+        self.assertEqual({
+            b"announce": b"https://tracker/announce",
+            b"announce-list": [
+                [b"https://tracker/announce"], [b"https://ipv6"]],
+            b"comment": b"Ubuntu CD releases.ubuntu.com",
+            b"creation date": 1000,
+            b"info": {
+                b"length": 32,
+                b"name": b"foo.iso",
+                b"piece length": 32,
+                b"pieces": hashlib.sha1(b"x" * 32).digest(),
+            },
+        }, metainfo)
+
+    def test_make_torrent_metafile(self):
+        path = os.path.join(self.temp_dir, "foo.iso")
+        with mkfile(path, mode="wb") as image:
+            image.write(b"x" * 40000)
+        make_torrent_metafile(
+            path, "%s.torrent" % path, "https://tracker/announce")
+        with open("%s.torrent" % path, "rb") as torrent:
+            metainfo = bdecode(torrent.read())
+        self.assertNotIn(b"announce-list", metainfo)
+        self.assertNotIn(b"comment", metainfo)
+        self.assertEqual(b"foo.iso", metainfo[b"info"][b"name"])
+        self.assertEqual(2 ** 15, metainfo[b"info"][b"piece length"])
+        self.assertEqual(40, len(metainfo[b"info"][b"pieces"]))
+        self.assertFalse(os.path.exists("%s.torrent.new" % path))
+
+    @skipUnless(btmakemetafile_available, "btmakemetafile not available")
+    def test_matches_btmakemetafile(self):
+        for size, name in (
+            (0, "empty.iso"),
+            (2 ** 15 * 3, "exact.iso"),
+            (5 * 1024 * 1024 + 123, "odd.img"),
+        ):
+            path = os.path.join(self.temp_dir, name)
+            with mkfile(path, mode="wb") as image:
+                image.write(os.urandom(size))
+            make_torrent_metafile(
+                path, "%s.native" % path, "https://tracker/announce",
+                announce_list=[["https://tracker/announce"], ["https://ipv6"]],
+                comment="Ubuntu CD releases.ubuntu.com")
+            with open(os.devnull, "w") as devnull:
+                subprocess.check_call([
+                    "btmakemetafile", "https://tracker/announce",
+                    "--announce_list", "https://tracker/announce|https://ipv6",
+                    "--comment", "Ubuntu CD releases.ubuntu.com", path,
+                ], stdout=devnull, stderr=devnull)
+            with open("%s.native" % path, "rb") as native_file:
+                native = bdecode(native_file.read())
+            with open("%s.torrent" % path, "rb") as reference_file:
+                reference = bdecode(reference_file.read())
+            # Only the creation date may differ.
+            del native[b"creation date"]
+            del reference[b"creation date"]
+            self.assertEqual(reference, native, name)
@@ -0,0 +1,104 @@
+#! /usr/bin/python
+
+# Copyright (C) 2019 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for cdimage.trash."""
+
+import errno
+import os
+import subprocess
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from cdimage.config import Config
+from cdimage.tests.helpers import TestCase, touch
+from cdimage.trash import (
+    move_to_trash,
+    reap_trash,
+    start_reaper,
+    trash_directory,
+)
+
+__metaclass__ = type
+
+
+class TestTrash(TestCase):
+    def setUp(self):
+        super(TestTrash, self).setUp()
+        self.use_temp_dir()
+        self.config = Config(read=False)
+        self.config.root = self.temp_dir
+        self.trash = trash_directory(self.config)
+
+    def test_move_to_trash(self):
+        path = os.path.join(self.temp_dir, "www", "full", "20130321")
+        touch(os.path.join(path, "file"))
+        self.assertTrue(move_to_trash(self.config, path))
+        self.assertFalse(os.path.exists(path))
+        trashed = os.listdir(self.trash)
+        self.assertEqual(1, len(trashed))
+        self.assertTrue(trashed[0].endswith(".20130321"))
+        self.assertEqual(
+            ["file"], os.listdir(os.path.join(self.trash, trashed[0])))
+
+    def test_move_to_trash_symlink(self):
+        path = os.path.join(self.temp_dir, "www", "full", "20130321.1")
+        touch(os.path.join(self.temp_dir, "www", "full", "20130321", "file"))
+        os.symlink("20130321", path)
+        self.assertFalse(move_to_trash(self.config, path))
+        self.assertFalse(os.path.lexists(path))
+        self.assertFalse(os.path.exists(self.trash))
+
+    def test_move_to_trash_other_file_system(self):
+        path = os.path.join(self.temp_dir, "www", "full", "20130321")
+        touch(os.path.join(path, "file"))
+        with mock.patch("os.rename", side_effect=OSError(errno.EXDEV, "")):
+            self.assertFalse(move_to_trash(self.config, path))
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual([], os.listdir(self.trash))
+
+    def test_reap_trash(self):
+        touch(os.path.join(self.trash, "item", "file"))
+        # Left behind by a reaper that died.
+        touch(os.path.join(self.trash, ".reaping-999999999", "stale", "file"))
+        # Claimed by a reaper that is still running.
+        live_claim = ".reaping-%d" % os.getppid()
+        touch(os.path.join(self.trash, live_claim, "busy", "file"))
+        reap_trash(self.config)
+        self.assertEqual([live_claim], os.listdir(self.trash))
+
+    def test_start_reaper_inline(self):
+        touch(os.path.join(self.trash, "item", "file"))
+        with mock.patch("cdimage.osextras.find_on_path", return_value=False):
+            start_reaper(self.config)
+        self.assertEqual([], os.listdir(self.trash))
+
+    @mock.patch("subprocess.Popen")
+    def test_start_reaper_background(self, mock_popen):
+        touch(os.path.join(self.trash, "item", "file"))
+        with mock.patch("cdimage.osextras.find_on_path", return_value=True):
+            start_reaper(self.config)
+        mock_popen.assert_called_once_with(
+            ["ionice", "-c", "3", "reap-trash"], stdin=mock.ANY,
+            stdout=mock.ANY, stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+        self.assertEqual(["item"], os.listdir(self.trash))
+
+    @mock.patch("subprocess.Popen")
+    def test_start_reaper_empty(self, mock_popen):
+        start_reaper(self.config)
+        self.assertEqual(0, mock_popen.call_count)
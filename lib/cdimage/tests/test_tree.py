@@ -20,40 +20,66 @@
 from __future__ import print_function
 
 from functools import wraps
+import gzip
+import hashlib
 try:
     from html.parser import HTMLParser
 except ImportError:
     from HTMLParser import HTMLParser
+try:
+    import lzma
+except ImportError:
+    lzma = None
 import os
 import shutil
+import socket
 import sys
 from textwrap import dedent
 import traceback
+try:
+    import xmlrpc.client as xmlrpc_client
+except ImportError:
+    import xmlrpclib as xmlrpc_client
 
 try:
     from unittest import mock
 except ImportError:
     import mock
 
+from cdimage.accounting import PublishHistory
 from cdimage import osextras
 from cdimage.config import Config, Series, all_series
+from cdimage.fanout import FanoutReader
 from cdimage.tests.helpers import TestCase, date_to_time, mkfile, touch
+from cdimage.torrent import bdecode
 from cdimage.tree import (
+    ArtifactIndex,
     ChinaDailyTree,
     ChinaDailyTreePublisher,
     ChinaReleaseTree,
     DailyTree,
     DailyTreePublisher,
+    DirectorySnapshot,
     FullReleaseTree,
     Link,
     Paragraph,
     Publisher,
+    QAProducts,
     SimpleReleasePublisher,
     SimpleReleaseTree,
     Span,
+    TimeoutSafeTransport,
+    TimeoutTransport,
     TorrentTree,
     Tree,
     UnorderedList,
+    find_web_index_directories,
+    make_web_indices_recursive,
+    rewrite_jigdo,
+    web_index_prefix,
+    web_index_status,
+    xmlrpc_timeout,
+    zsyncmake,
 )
 
 __metaclass__ = type
@@ -186,10 +212,11 @@ class TestTree(TestCase):
             self.wait_for_pid(pid, 0)
             log_path = os.path.join(self.temp_dir, "log", "mark-current.log")
             with open(log_path) as log:
-                self.assertEqual(
-                    "[2013-03-21 00:00:00] %s\n" %
+                self.assertEqual([
+                    "[2013-03-21 00:00:00] %s" %
                     self.config["SSH_ORIGINAL_COMMAND"],
-                    log.read())
+                    "Marked 20130321 current in 0.0 seconds",
+                ], log.read().splitlines())
 
             with open(os.path.join(publish_base, "20130321", ".marked_good"),
                       "r") as marked_good:
@@ -226,6 +253,160 @@ class TestTags(TestCase):
             str(tag))
 
 
+class TestRewriteJigdo(TestCase):
+    def setUp(self):
+        super(TestRewriteJigdo, self).setUp()
+        self.use_temp_dir()
+        self.source = os.path.join(self.temp_dir, "old.jigdo")
+        self.target = os.path.join(self.temp_dir, "new.jigdo")
+
+    def test_chunk_boundaries(self):
+        data = b"".join(
+            b"File=old-%d\nDebian=old\n" % i for i in range(100))
+        with mkfile(self.source, mode="wb") as source:
+            source.write(data)
+        expected = data.replace(b"=old", b"=newer")
+        for chunk_size in (1, 3, 4, 7, 4096):
+            written = rewrite_jigdo(
+                self.source, self.target, "=old", "=newer",
+                chunk_size=chunk_size)
+            self.assertEqual(len(expected), written)
+            with open(self.target, "rb") as target:
+                self.assertEqual(expected, target.read())
+
+    def test_gzip(self):
+        with open(self.source, "wb") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="wb") as source:
+                source.write(b"Filename=old.iso\nTemplate=old.template\n")
+        self.assertNotEqual(0, rewrite_jigdo(
+            self.source, self.target, "=old", "=new"))
+        with gzip.open(self.target, "rb") as target:
+            self.assertEqual(
+                b"Filename=new.iso\nTemplate=new.template\n", target.read())
+
+    def test_unchanged_hardlinks(self):
+        with mkfile(self.source) as source:
+            print("Filename=other.iso", file=source)
+        touch(self.target)
+        self.assertEqual(
+            0, rewrite_jigdo(self.source, self.target, "=old", "=new"))
+        self.assertEqual(
+            os.stat(self.source).st_ino, os.stat(self.target).st_ino)
+        self.assertFalse(os.path.exists("%s.new" % self.target))
+
+    def test_unchanged_in_place(self):
+        with mkfile(self.source) as source:
+            print("Filename=other.iso", file=source)
+        inode = os.stat(self.source).st_ino
+        self.assertEqual(
+            0, rewrite_jigdo(self.source, self.source, "=old", "=new"))
+        self.assertEqual(inode, os.stat(self.source).st_ino)
+        self.assertFalse(os.path.exists("%s.new" % self.source))
+
+    @mock.patch("cdimage.tree._replace_stream", side_effect=IOError)
+    def test_failure_removes_temporary(self, *args):
+        with mkfile(self.source) as source:
+            print("Filename=old.iso", file=source)
+        self.assertRaises(
+            IOError, rewrite_jigdo, self.source, self.target, "=old", "=new")
+        self.assertFalse(os.path.exists(self.target))
+        self.assertFalse(os.path.exists("%s.new" % self.target))
+
+
+class TestArtifactIndex(TestCase):
+    def setUp(self):
+        super(TestArtifactIndex, self).setUp()
+        self.use_temp_dir()
+        self.directory = os.path.join(self.temp_dir, "daily")
+        for name in (
+            "eoan-desktop-amd64.iso", "eoan-desktop-amd64.iso.zsync",
+            "eoan-desktop-amd64.manifest", "amd64.tar.xz",
+        ):
+            touch(os.path.join(self.directory, name))
+
+    def test_exists(self):
+        index = ArtifactIndex(self.directory).refresh()
+        self.assertTrue(index.exists(
+            os.path.join(self.directory, "eoan-desktop-amd64.iso")))
+        self.assertTrue(index.exists(
+            os.path.join(self.directory, "amd64.tar.xz")))
+        self.assertFalse(index.exists(
+            os.path.join(self.directory, "eoan-desktop-amd64.img")))
+
+    @mock.patch("os.path.exists")
+    def test_missing_entries_are_not_probed(self, mock_exists):
+        index = ArtifactIndex(self.directory).refresh()
+        self.assertFalse(index.exists(
+            os.path.join(self.directory, "eoan-desktop-amd64.img")))
+        mock_exists.assert_not_called()
+
+    def test_suffixes(self):
+        index = ArtifactIndex(self.directory).refresh()
+        self.assertEqual(
+            set([".iso", ".iso.zsync", ".manifest"]),
+            index.suffixes("eoan-desktop-amd64"))
+        self.assertEqual(
+            set(["-desktop-amd64.iso", "-desktop-amd64.iso.zsync",
+                 "-desktop-amd64.manifest"]),
+            index.suffixes("eoan"))
+        self.assertEqual(set([".tar.xz"]), index.suffixes("amd64"))
+        self.assertEqual(set(), index.suffixes("eoan-desktop-i386"))
+
+    def test_removed_after_listing(self):
+        index = ArtifactIndex(self.directory).refresh()
+        path = os.path.join(self.directory, "eoan-desktop-amd64.iso")
+        os.unlink(path)
+        self.assertFalse(index.exists(path))
+
+    def test_created_after_listing(self):
+        index = ArtifactIndex(self.directory).refresh()
+        path = os.path.join(self.directory, "eoan-desktop-amd64.img")
+        touch(path)
+        os.utime(self.directory, (1000000000, 1000000000))
+        self.assertTrue(index.exists(path))
+        self.assertIn(".img", index.suffixes("eoan-desktop-amd64"))
+
+    def test_dangling_symlink(self):
+        path = os.path.join(self.directory, "eoan-desktop-i386.iso")
+        os.symlink("nonexistent", path)
+        index = ArtifactIndex(self.directory).refresh()
+        self.assertFalse(index.exists(path))
+
+    def test_refresh(self):
+        index = ArtifactIndex(self.directory).refresh()
+        path = os.path.join(self.directory, "eoan-desktop-i386.iso")
+        touch(path)
+        self.assertTrue(index.refresh().exists(path))
+        self.assertIn(".iso", index.suffixes("eoan-desktop-i386"))
+
+    @mock.patch("cdimage.osextras.listdir_force")
+    def test_refresh_unchanged(self, mock_listdir):
+        mock_listdir.return_value = []
+        index = ArtifactIndex(self.directory)
+        index.refresh()
+        index.refresh()
+        # The directory was only just created, so it might change again
+        # without its modification time changing.
+        self.assertEqual(2, mock_listdir.call_count)
+        os.utime(self.directory, (1000000000, 1000000000))
+        index.refresh()
+        index.refresh()
+        self.assertEqual(3, mock_listdir.call_count)
+
+    def test_other_directory(self):
+        index = ArtifactIndex(self.directory).refresh()
+        path = os.path.join(self.temp_dir, "other")
+        self.assertFalse(index.exists(path))
+        touch(path)
+        self.assertTrue(index.exists(path))
+
+    def test_missing_directory(self):
+        index = ArtifactIndex(os.path.join(self.temp_dir, "missing"))
+        self.assertFalse(index.refresh().exists(
+            os.path.join(self.temp_dir, "missing", "foo.iso")))
+        self.assertEqual(set(), index.suffixes("foo"))
+
+
 class TestPublisher(TestCase):
     def setUp(self):
         super(TestPublisher, self).setUp()
@@ -277,6 +458,41 @@ class TestPublisher(TestCase):
                 self.assertEqual(
                     image_type, Publisher._guess_image_type(publish_type))
 
+    @mock.patch("cdimage.osextras.find_on_path", return_value=True)
+    @mock.patch("subprocess.check_call")
+    def test_zsyncmake_block_size(self, mock_check_call, *args):
+        path = os.path.join(self.temp_dir, "image.iso")
+        with open(path, "wb") as f:
+            f.truncate(100000000)
+        self.capture_logging()
+        zsyncmake(path, "%s.zsync" % path, "image.iso")
+        # Large images get the block size that is known to work up front,
+        # so the image is only read once.
+        mock_check_call.assert_called_once_with([
+            "zsyncmake", "-b", "2048", "-o", "%s.zsync" % path,
+            "-u", "image.iso", path,
+        ])
+        self.assertLogEqual([])
+
+    def test_make_zsync_waits(self):
+        publisher = Publisher(Tree(self.config, self.temp_dir), "daily")
+        with mock.patch("cdimage.tree.zsyncmake") as mock_zsyncmake:
+            publisher.make_zsync("in.iso", "in.iso.zsync", "in.iso")
+            self.capture_logging()
+            publisher.wait_for_zsync()
+        mock_zsyncmake.assert_called_once_with(
+            "in.iso", "in.iso.zsync", "in.iso")
+        self.assertLogEqual(["Made in.iso.zsync in 0.0 seconds"])
+
+    @mock.patch("cdimage.osextras.find_on_path", return_value=False)
+    def test_zsyncmake_native(self, *args):
+        path = os.path.join(self.temp_dir, "image.iso")
+        with mkfile(path, mode="wb") as image:
+            image.write(b"x" * 5000)
+        zsyncmake(path, "%s.zsync" % path, "image.iso")
+        with open("%s.zsync" % path, "rb") as metafile:
+            self.assertIn(b"\nBlocksize: 2048\n", metafile.read())
+
 
 class TestPublisherWebIndices(TestCase):
     """Test Publisher.make_web_indices and its subsidiary methods."""
@@ -360,6 +576,36 @@ class TestPublisherWebIndices(TestCase):
             "debian-installer/+filebug\">debian-installer</a> package.</p>",
             "\n".join(map(str, desc)))
 
+    def test_descriptions_memoised(self):
+        self.config["PROJECT"] = "ubuntu"
+        self.config["CAPPROJECT"] = "Ubuntu"
+        self.config["DIST"] = "trusty"
+        publisher = Publisher(self.tree, "daily-live")
+        with mock.patch.object(
+                publisher, "_render_cdtypestr",
+                wraps=publisher._render_cdtypestr) as render:
+            for _ in range(3):
+                self.assertEqual(
+                    "desktop image", publisher.cdtypestr("desktop", "iso"))
+            self.assertEqual(1, render.call_count)
+            self.config["DIST"] = "precise"
+            self.assertEqual(
+                "desktop CD", publisher.cdtypestr("desktop", "iso"))
+            self.assertEqual(2, render.call_count)
+
+        with mock.patch.object(
+                publisher, "_render_cdtypedesc",
+                wraps=publisher._render_cdtypedesc) as render:
+            first = publisher.cdtypedesc("desktop", "iso")
+            second = publisher.cdtypedesc("desktop", "iso")
+            self.assertIn("most people", first[0])
+            self.assertNotIn("most people", second[0])
+            publisher.prefmsg_emitted = False
+            self.assertEqual(first, publisher.cdtypedesc("desktop", "iso"))
+            self.assertTrue(publisher.prefmsg_emitted)
+            self.assertEqual(second, publisher.cdtypedesc("desktop", "iso"))
+            self.assertEqual(2, render.call_count)
+
     def test_archdesc(self):
         self.config["ARCHES"] = "amd64 i386"
         publisher = Publisher(self.tree, "daily-live")
@@ -468,6 +714,56 @@ class TestPublisherWebIndices(TestCase):
         self.assertFalse(
             publisher.find_any_with_extension(self.directory, "manifest"))
 
+    def test_directory_snapshot(self):
+        for name in (
+            "MD5SUMS",
+            "trusty-desktop-amd64.iso", "trusty-desktop-amd64.iso.torrent",
+            "trusty-desktop-i386.list",
+        ):
+            touch(os.path.join(self.directory, name))
+        os.symlink(
+            "nonexistent", os.path.join(self.directory, "dangling.iso"))
+        snapshot = DirectorySnapshot(self.directory)
+        self.assertIn("dangling.iso", snapshot)
+        self.assertTrue(snapshot.path_exists(
+            os.path.join(self.directory, "trusty-desktop-amd64.iso")))
+        self.assertFalse(snapshot.path_exists(
+            os.path.join(self.directory, "dangling.iso")))
+        self.assertCountEqual(
+            ["trusty-desktop-amd64.iso", "trusty-desktop-amd64.iso.torrent",
+             "trusty-desktop-i386.list"],
+            snapshot.with_prefix("trusty-desktop-"))
+        self.assertCountEqual(
+            ["trusty-desktop-amd64.iso", "dangling.iso"],
+            snapshot.with_suffix(".iso"))
+        self.assertCountEqual([], snapshot.with_suffix(".manifest"))
+        touch(os.path.join(self.directory, "new.manifest"))
+        self.assertNotIn("new.manifest", snapshot)
+        self.assertIs(snapshot, DirectorySnapshot.of(snapshot))
+
+    def test_make_web_indices_lists_directory_once(self):
+        self.config["PROJECT"] = "ubuntu"
+        self.config["CAPPROJECT"] = "Ubuntu"
+        self.config["DIST"] = "trusty"
+        names = []
+        for publish_type in ("desktop", "server", "src", "dvd"):
+            for arch in ("amd64", "i386", "arm64", "armhf", "ppc64el"):
+                for extension in (
+                    "iso", "iso.zsync", "iso.torrent", "list", "manifest",
+                    "jigdo", "template", "img.xz", "tar.gz", "img",
+                ):
+                    names.append(
+                        "trusty-%s-%s.%s" % (publish_type, arch, extension))
+        self.assertEqual(200, len(names))
+        for name in names:
+            touch(os.path.join(self.directory, name))
+        publisher = Publisher(self.tree, "daily-live")
+        real_listdir = os.listdir
+        with mock.patch("os.listdir", side_effect=real_listdir) as listdir:
+            publisher.make_web_indices(
+                self.directory, "trusty", status="daily")
+        listdir.assert_called_once_with(self.directory)
+
     def test_make_web_indices(self):
         # We don't attempt to test the entire text here; that would be very
         # tedious.  Instead, we simply test that a sample run has no missing
@@ -538,6 +834,112 @@ class TestPublisherWebIndices(TestCase):
                 "AddIcon ../../cdicons/torrent.png .torrent .metalink\n",
                 htaccess.read())
 
+    def test_make_web_indices_reports_changes(self):
+        self.config["PROJECT"] = "ubuntu"
+        self.config["CAPPROJECT"] = "Ubuntu"
+        self.config["DIST"] = "trusty"
+        for name in ("trusty-desktop-amd64.iso", "trusty-desktop-amd64.list"):
+            touch(os.path.join(self.directory, name))
+        publisher = Publisher(self.tree, "daily-live")
+        self.assertTrue(publisher.make_web_indices(
+            self.directory, "trusty", status="daily"))
+        self.assertFalse(publisher.make_web_indices(
+            self.directory, "trusty", status="daily"))
+        touch(os.path.join(self.directory, "trusty-desktop-i386.iso"))
+        self.assertTrue(publisher.make_web_indices(
+            self.directory, "trusty", status="daily"))
+
+    def test_web_index_prefix(self):
+        self.assertEqual(
+            (None, "trusty", "trusty"),
+            web_index_prefix("trusty-desktop-amd64.iso"))
+        self.assertEqual(
+            ("ubuntu", "trusty", "ubuntu-14.04.5"),
+            web_index_prefix("ubuntu-14.04.5-desktop-amd64.iso"))
+        self.assertEqual(
+            ("kubuntu", "trusty", "kubuntu-14.04-beta2"),
+            web_index_prefix("kubuntu-14.04-beta2-desktop-i386.list"))
+        self.assertEqual(
+            ("ubuntu-gnome", "trusty", "ubuntu-gnome-14.04"),
+            web_index_prefix("ubuntu-gnome-14.04-desktop-amd64.iso"))
+        self.assertIsNone(web_index_prefix("trusty-desktop-amd64.manifest"))
+        self.assertIsNone(web_index_prefix("ubuntu-1.0-desktop-amd64.iso"))
+        self.assertIsNone(web_index_prefix("SHA256SUMS"))
+
+    def test_web_index_status(self):
+        www = os.path.join(self.config.root, "www")
+        self.assertEqual("daily", web_index_status(self.config, os.path.join(
+            www, "full", "daily-live", "20130326")))
+        self.assertEqual("release", web_index_status(
+            self.config, os.path.join(www, "full", "releases", "trusty")))
+        self.assertEqual("release", web_index_status(
+            self.config, os.path.join(www, "simple", "trusty")))
+
+    def test_find_web_index_directories(self):
+        www = os.path.join(self.config.root, "www")
+        for path in (
+            "full/daily-live/20130326/trusty-desktop-amd64.iso",
+            "full/kubuntu/daily-live/20130326/trusty-desktop-amd64.iso",
+            "full/kubuntu/daily-live/20130326/trusty-desktop-amd64.list",
+            "full/releases/trusty/release/ubuntu-14.04.5-desktop-amd64.iso",
+            "full/releases/trusty/release/ubuntu-14.04-desktop-amd64.iso",
+            "full/releases/trusty/release/"
+            "ubuntu-14.04.5-desktop-amd64.list",
+            "full/releases/trusty/release/MD5SUMS",
+            "simple/.pool/ubuntu-14.04.5-desktop-amd64.iso",
+            "simple/trusty/ubuntu-14.04.5-desktop-amd64.iso",
+            "china-images/trusty/daily-live/20130326/"
+            "trusty-desktop-amd64.iso",
+        ):
+            touch(os.path.join(www, path))
+        os.symlink(
+            "20130326", os.path.join(www, "full", "daily-live", "current"))
+        self.assertEqual([
+            (os.path.join(www, "china-images/trusty/daily-live/20130326"),
+             "ubuntu", "Ubuntu Chinese Edition", "trusty", "trusty",
+             "daily"),
+            (os.path.join(www, "full/daily-live/20130326"),
+             "ubuntu", "Ubuntu", "trusty", "trusty", "daily"),
+            (os.path.join(www, "full/kubuntu/daily-live/20130326"),
+             "kubuntu", "Kubuntu", "trusty", "trusty", "daily"),
+            (os.path.join(www, "full/releases/trusty/release"),
+             "ubuntu", "Ubuntu", "trusty", "ubuntu-14.04.5", "release"),
+            (os.path.join(www, "simple/trusty"),
+             "ubuntu", "Ubuntu", "trusty", "ubuntu-14.04.5", "release"),
+        ], list(find_web_index_directories(self.config, www)))
+
+    def test_make_web_indices_recursive(self):
+        www = os.path.join(self.config.root, "www")
+        daily = os.path.join(www, "full", "daily-live", "20130326")
+        release = os.path.join(www, "full", "releases", "trusty", "release")
+        touch(os.path.join(daily, "trusty-desktop-amd64.iso"))
+        touch(os.path.join(release, "ubuntu-14.04-desktop-amd64.iso"))
+        self.config["PROJECT"] = "kubuntu"
+        self.config["DIST"] = "precise"
+        for jobs in (1, 2):
+            self.capture_logging()
+            results = make_web_indices_recursive(self.config, www, jobs=jobs)
+            # The caller's configuration is left alone.
+            self.assertEqual("kubuntu", self.config["PROJECT"])
+            self.assertEqual("precise", self.config["DIST"].name)
+            self.assertEqual("kubuntu", os.environ["PROJECT"])
+            if jobs == 1:
+                self.assertEqual(
+                    [(daily, True, None), (release, True, None)], results)
+                self.assertLogEqual([
+                    "Web indices changed in 2 of 2 directories",
+                    "  %s" % daily,
+                    "  %s" % release,
+                ])
+            else:
+                self.assertEqual(
+                    [(daily, False, None), (release, False, None)], results)
+                self.assertLogEqual([
+                    "Web indices changed in 0 of 2 directories",
+                ])
+        with open(os.path.join(release, "HEADER.html")) as header:
+            self.assertIn("<title>Ubuntu 14.04", header.read())
+
 
 class TestDailyTree(TestCase):
     def setUp(self):
@@ -589,6 +991,103 @@ class TestDailyTree(TestCase):
             "ubuntu\thoary\t/daily/current/hoary-install-i386.iso\t0",
         ], self.tree.manifest())
 
+    def test_split_publish_base(self):
+        for relative_path, expected in (
+            ("daily-live", ("ubuntu", "daily-live", "daily-live")),
+            ("bionic/daily-live",
+             ("ubuntu", "bionic/daily-live", "daily-live")),
+            ("kubuntu/daily-live", ("kubuntu", "daily-live", "daily-live")),
+            ("ubuntu-server/bionic/daily-preinstalled",
+             ("ubuntu-server", "bionic/daily-preinstalled",
+              "daily-preinstalled")),
+            ("ubuntu-touch/ubuntu-rtm/14.09/daily-preinstalled",
+             ("ubuntu-touch", "ubuntu-rtm/14.09/daily-preinstalled",
+              "daily-preinstalled")),
+            ("ubuntu-core/16/edge", ("ubuntu-core", "16/edge", "daily-live")),
+            ("ubuntu-core/18/stable",
+             ("ubuntu-core", "18/stable", "daily-live")),
+            ("ubuntu-core/bionic/daily-preinstalled",
+             ("ubuntu-core", "bionic/daily-preinstalled",
+              "daily-preinstalled")),
+        ):
+            self.assertEqual(
+                expected, self.tree.split_publish_base(relative_path))
+
+    def test_split_publish_base_locale(self):
+        self.config["UBUNTU_DEFAULTS_LOCALE"] = "es"
+        self.assertEqual(
+            ("kubuntu-es", "daily-live", "daily-live"),
+            self.tree.split_publish_base("kubuntu/daily-live"))
+        self.assertEqual(
+            ("ubuntu-es", "bionic/daily-live", "daily-live"),
+            self.tree.split_publish_base("bionic/daily-live"))
+
+    def test_split_publish_base_matches_image_type_dir(self):
+        self.config.root = self.temp_dir
+        for project, series, image_type in (
+            ("ubuntu", "eoan", "daily-live"),
+            ("ubuntu", "bionic", "daily-live"),
+            ("ubuntu-core", "bionic", "daily-live"),
+            ("ubuntu-core", "xenial", "daily-preinstalled"),
+            ("ubuntu-server", "eoan", "daily-preinstalled"),
+        ):
+            self.config["PROJECT"] = project
+            self.config["DIST"] = series
+            tree = DailyTree(self.config, self.temp_dir)
+            publisher = DailyTreePublisher(tree, image_type)
+            relative_path = os.path.relpath(
+                publisher.publish_base, tree.directory)
+            self.assertEqual(
+                project, tree.split_publish_base(relative_path)[0])
+            self.assertEqual(
+                image_type, tree.split_publish_base(relative_path)[2])
+
+    @mock.patch("time.time", return_value=date_to_time("20130321"))
+    def test_purge(self, *args):
+        self.config.root = self.temp_dir
+        tree = DailyTree(self.config)
+        for path in (
+            "daily-live/20130321",
+            "kubuntu/daily-live/20130318", "kubuntu/daily-live/20130320",
+            "ubuntu-core/16/edge/20130317", "ubuntu-core/16/edge/20130318",
+            "ubuntu-core/16/edge/20130319",
+            "xubuntu/daily/20130301",
+        ):
+            touch(os.path.join(tree.directory, path, "file"))
+        with mkfile(os.path.join(
+                tree.directory, "daily-live", "20130319", "file"),
+                mode="wb") as f:
+            f.write(b"x" * 1024 * 1024)
+        os.symlink(
+            "20130318",
+            os.path.join(tree.directory, "kubuntu", "daily-live", "pending"))
+        with mkfile(os.path.join(
+                self.temp_dir, "etc", "purge-days")) as purge_days:
+            print("ubuntu 1", file=purge_days)
+            print("kubuntu/daily-live 1", file=purge_days)
+        with mkfile(os.path.join(
+                self.temp_dir, "etc", "purge-count")) as purge_count:
+            print("ubuntu-core/daily-live 2", file=purge_count)
+        self.capture_logging()
+        tree.purge(dry_run=True)
+        self.assertLogEqual([
+            "Not purging images for xubuntu/daily",
+            "Would purge 2 images, freeing 1.0 MiB",
+            "Would purge ubuntu/daily-live/20130319",
+            "Would purge ubuntu-core/16/edge/20130317",
+        ])
+        tree.purge()
+        self.assertCountEqual(
+            ["20130321"],
+            os.listdir(os.path.join(tree.directory, "daily-live")))
+        self.assertCountEqual(
+            ["20130318", "20130320", "pending"],
+            os.listdir(os.path.join(tree.directory, "kubuntu", "daily-live")))
+        self.assertCountEqual(
+            ["20130318", "20130319"],
+            os.listdir(os.path.join(
+                tree.directory, "ubuntu-core", "16", "edge")))
+
 
 # As well as simply mocking isotracker.ISOTracker, we have to go through
 # some contortions to avoid needing ubuntu-archive-tools to be on sys.path
@@ -846,6 +1345,18 @@ class TestDailyTreePublisher(TestCase):
                 Debian=http://ports.ubuntu.com/ubuntu-ports --try-last
                 """), jigdo.read())
 
+    def test_replace_jigdo_mirror_unchanged(self):
+        jigdo_path = os.path.join(self.temp_dir, "jigdo")
+        with mkfile(jigdo_path) as jigdo:
+            print("Debian=http://ports.ubuntu.com/ubuntu-ports", file=jigdo)
+        inode = os.stat(jigdo_path).st_ino
+        publisher = self.make_publisher("ubuntu", "daily")
+        self.assertEqual(0, publisher.replace_jigdo_mirror(
+            jigdo_path, "http://archive.ubuntu.com/ubuntu/",
+            "http://ports.ubuntu.com/ubuntu-ports"))
+        self.assertEqual(inode, os.stat(jigdo_path).st_ino)
+        self.assertFalse(os.path.exists("%s.new" % jigdo_path))
+
     @mock.patch("cdimage.osextras.find_on_path", return_value=True)
     @mock.patch("cdimage.tree.zsyncmake")
     def test_publish_binary(self, mock_zsyncmake, *args):
@@ -872,6 +1383,7 @@ class TestDailyTreePublisher(TestCase):
             "%s-desktop-i386.list" % self.config.series,
             "%s-desktop-i386.manifest" % self.config.series,
         ], os.listdir(target_dir))
+        publisher.wait_for_zsync()
         mock_zsyncmake.assert_called_once_with(
             os.path.join(
                 target_dir, "%s-desktop-i386.iso" % self.config.series),
@@ -879,6 +1391,85 @@ class TestDailyTreePublisher(TestCase):
                 target_dir, "%s-desktop-i386.iso.zsync" % self.config.series),
             "%s-desktop-i386.iso" % self.config.series)
 
+    @mock.patch("subprocess.Popen")
+    def test_detect_image_extension(self, mock_popen):
+        publisher = self.make_publisher("ubuntu", "daily-live")
+        prefix = os.path.join(publisher.image_output("i386"), "image")
+        path = "%s.%s" % (prefix, publisher.source_extension)
+        iso = b"\0" * 32768 + b"\x01CD001\x01" + b"\0" * 2041
+        mbr = b"\0" * 510 + b"\x55\xaa"
+        tar = b"\0" * 257 + b"ustar\x0000" + b"\0" * 248
+        with mkfile(path, mode="wb") as image:
+            image.write(iso)
+        self.assertEqual("iso", publisher.detect_image_extension(prefix))
+        with mkfile(path, mode="wb") as image:
+            image.write(mbr)
+        self.assertEqual("img", publisher.detect_image_extension(prefix))
+        with gzip.GzipFile(path, mode="wb") as image:
+            image.write(mbr)
+        self.assertEqual("img.gz", publisher.detect_image_extension(prefix))
+        with gzip.GzipFile(path, mode="wb") as image:
+            image.write(tar)
+        self.assertEqual("tar.gz", publisher.detect_image_extension(prefix))
+        if lzma is not None:
+            with lzma.LZMAFile(path, mode="wb") as image:
+                image.write(iso)
+            self.assertEqual(
+                "iso.xz", publisher.detect_image_extension(prefix))
+        # None of these needed file(1).
+        self.assertEqual(0, mock_popen.call_count)
+
+    def test_detect_image_extension_falls_back_to_type_file(self):
+        publisher = self.make_publisher("ubuntu", "daily-live")
+        prefix = os.path.join(publisher.image_output("i386"), "image")
+        path = "%s.%s" % (prefix, publisher.source_extension)
+        with gzip.GzipFile(path, mode="wb") as image:
+            image.write(b"unrecognised")
+        with mkfile("%s.type" % prefix) as type_file:
+            print("x86 boot sector", file=type_file)
+        self.assertEqual("img.gz", publisher.detect_image_extension(prefix))
+
+    @mock.patch("cdimage.osextras.find_on_path", return_value=False)
+    def test_publish_binaries(self, *args):
+        self.config["ARCHES"] = "amd64 arm64 i386 ppc64el s390x"
+        publisher = self.make_publisher("ubuntu-server", "daily")
+        for arch in self.config.arches:
+            source_dir = publisher.image_output(arch)
+            touch(os.path.join(
+                source_dir, "%s-server-%s.raw" % (self.config.series, arch)))
+        self.capture_logging()
+        published = publisher.publish_binaries("server", "20120807")
+        self.assertEqual([
+            "ubuntu-server/daily/%s-server-%s" % (self.config.series, arch)
+            for arch in self.config.arches], published)
+        target_dir = os.path.join(publisher.publish_base, "20120807")
+        self.assertCountEqual([
+            "%s-server-%s.iso" % (self.config.series, arch)
+            for arch in self.config.arches], os.listdir(target_dir))
+        self.assertCountEqual(
+            [publisher.image_output(arch) for arch in self.config.arches],
+            publisher.checksum_dirs)
+
+    @mock.patch("cdimage.osextras.find_on_path", return_value=False)
+    def test_publish_binaries_native_zsync(self, *args):
+        self.config["ARCHES"] = "amd64 i386"
+        self.config["CDIMAGE_NATIVE_ZSYNC"] = "1"
+        publisher = self.make_publisher("ubuntu-server", "daily")
+        for arch in self.config.arches:
+            source_dir = publisher.image_output(arch)
+            touch(os.path.join(
+                source_dir, "%s-server-%s.raw" % (self.config.series, arch)))
+        self.capture_logging()
+        publisher.publish_binaries("server", "20120807")
+        publisher.wait_for_zsync()
+        target_dir = os.path.join(publisher.publish_base, "20120807")
+        self.assertCountEqual(
+            ["%s-server-%s.iso" % (self.config.series, arch)
+             for arch in self.config.arches] +
+            ["%s-server-%s.iso.zsync" % (self.config.series, arch)
+             for arch in self.config.arches],
+            os.listdir(target_dir))
+
     @mock.patch("cdimage.osextras.find_on_path", return_value=True)
     @mock.patch("cdimage.tree.DailyTreePublisher.detect_image_extension",
                 return_value="img.xz")
@@ -965,6 +1556,7 @@ class TestDailyTreePublisher(TestCase):
             "%s-src-2.list" % self.config.series,
             "%s-src-2.template" % self.config.series,
         ], os.listdir(target_dir))
+        publisher.wait_for_zsync()
         mock_zsyncmake.assert_has_calls([
             mock.call(
                 os.path.join(target_dir, "%s-src-1.iso" % self.config.series),
@@ -976,7 +1568,7 @@ class TestDailyTreePublisher(TestCase):
                 os.path.join(
                     target_dir, "%s-src-2.iso.zsync" % self.config.series),
                 "%s-src-2.iso" % self.config.series),
-        ])
+        ], any_order=True)
 
     def test_link(self):
         publisher = self.make_publisher("ubuntu", "daily-live")
@@ -1060,7 +1652,11 @@ class TestDailyTreePublisher(TestCase):
             self.assertEqual(
                 os.path.join(os.pardir, "20130321", name), os.readlink(path))
         self.assertEqual([target_dir], publisher.checksum_dirs)
-        mock_polish_directory.assert_called_once_with("current")
+        mock_polish_directory.assert_called_once_with(
+            "current", checksum_sources={
+                "trusty-desktop-amd64.iso": target_dir,
+                "trusty-desktop-amd64.manifest": target_dir,
+            })
 
     @mock.patch("cdimage.tree.DailyTreePublisher.polish_directory")
     def test_mark_current_single_to_single(self, mock_polish_directory):
@@ -1112,7 +1708,13 @@ class TestDailyTreePublisher(TestCase):
             os.path.join(publisher.publish_base, "20130320"),
             os.path.join(publisher.publish_base, "20130321"),
         ], publisher.checksum_dirs)
-        mock_polish_directory.assert_called_once_with("current")
+        mock_polish_directory.assert_called_once_with(
+            "current", checksum_sources=dict(
+                ("trusty-desktop-%s.%s" % (arch, ext),
+                 os.path.join(publisher.publish_base, date))
+                for date, arch in (
+                    ("20130320", "i386"), ("20130321", "amd64"))
+                for ext in ("iso", "manifest")))
 
     @mock.patch("cdimage.tree.DailyTreePublisher.polish_directory")
     def test_mark_current_mixed_to_single(self, mock_polish_directory):
@@ -1183,7 +1785,11 @@ class TestDailyTreePublisher(TestCase):
         self.assertEqual(
             [os.path.join(publisher.publish_base, "20130321")],
             publisher.checksum_dirs)
-        mock_polish_directory.assert_called_once_with("current")
+        mock_polish_directory.assert_called_once_with(
+            "current", checksum_sources=dict(
+                ("trusty-desktop-i386.%s" % ext,
+                 os.path.join(publisher.publish_base, "20130321"))
+                for ext in ("iso", "manifest")))
         mock_polish_directory.reset_mock()
         publisher.checksum_dirs = []
         publisher.mark_current("20130320", ["amd64+mac", "powerpc"])
@@ -1212,7 +1818,12 @@ class TestDailyTreePublisher(TestCase):
             os.path.join(publisher.publish_base, "20130320"),
             os.path.join(publisher.publish_base, "20130321"),
         ], publisher.checksum_dirs)
-        mock_polish_directory.assert_called_once_with("current")
+        mock_polish_directory.assert_called_once_with(
+            "current", checksum_sources=dict(
+                ("trusty-desktop-%s.%s" % (arch, ext),
+                 os.path.join(publisher.publish_base, "20130320"))
+                for arch in ("amd64+mac", "powerpc")
+                for ext in ("iso", "manifest")))
 
     @mock.patch("cdimage.tree.DailyTreePublisher.polish_directory")
     def test_mark_current_ignores_old_series(self, mock_polish_directory):
@@ -1345,6 +1956,51 @@ class TestDailyTreePublisher(TestCase):
             publisher.cdimage_project(
                 "Ubuntu Chinese Desktop i386", "localized-iso-china"))
 
+    def test_qa_products_wildcards(self):
+        products = QAProducts([
+            ("Ubuntu Desktop amd64", "ubuntu", "daily-live", "desktop",
+             "amd64", "iso"),
+            ("Ubuntu Desktop i386", "ubuntu", "daily-live", "desktop",
+             "i386", "iso"),
+            ("Ubuntu Server amd64", "ubuntu-server", "daily", "server",
+             "amd64", "iso"),
+            ("Ubuntu Desktop amd64 (dup)", "ubuntu/foo", "daily-live",
+             "desktop", "amd64", "other"),
+        ])
+        self.assertEqual(
+            ("Ubuntu Desktop i386", "iso"),
+            products.lookup("ubuntu", "daily-live", "desktop", "i386"))
+        self.assertEqual(
+            ("Ubuntu Desktop amd64", "iso"),
+            products.lookup("ubuntu", None, "", "amd64"))
+        self.assertEqual(
+            ("Ubuntu Server amd64", "iso"),
+            products.lookup(None, "daily", None, None))
+        self.assertIsNone(
+            products.lookup("kubuntu", "daily-live", "desktop", "i386"))
+        self.assertEqual(
+            ("ubuntu/foo", "daily-live", "desktop", "amd64"),
+            products.reverse_lookup("Ubuntu Desktop amd64 (dup)", "other"))
+        self.assertIsNone(
+            products.reverse_lookup("Ubuntu Desktop amd64", "other"))
+
+    def test_qa_product_reloads_changed_file(self):
+        publisher = self.make_publisher("ubuntu", "daily-live")
+        product_list = os.path.join(self.temp_dir, "etc", "qa-products")
+        with mkfile(product_list) as qaproducts:
+            print("Old\tubuntu\tdaily-live\tdesktop\ti386\tiso",
+                  file=qaproducts)
+        self.assertEqual(
+            ("Old", "iso"),
+            publisher.qa_product("ubuntu", "daily-live", "desktop", "i386"))
+        with mkfile(product_list) as qaproducts:
+            print("New\tubuntu\tdaily-live\tdesktop\ti386\tiso",
+                  file=qaproducts)
+        os.utime(product_list, (0, 0))
+        self.assertEqual(
+            ("New", "iso"),
+            publisher.qa_product("ubuntu", "daily-live", "desktop", "i386"))
+
     @mock_isotracker
     def test_post_qa(self):
         publisher = self.make_publisher("ubuntu", "daily-live")
@@ -1411,7 +2067,144 @@ class TestDailyTreePublisher(TestCase):
             publisher.post_qa, "bad-date",
             ["ubuntu/daily-live/trusty-desktop-i386"])
 
-    @mock.patch("subprocess.call", return_value=0)
+    def test_send_qa_posts_groups_by_target(self):
+        trackers = []
+
+        class ISOTracker(isotracker_module.ISOTracker):
+            def __init__(self, target):
+                super(ISOTracker, self).__init__(target)
+                trackers.append(self)
+
+        publisher = self.make_publisher("ubuntu", "daily-live")
+        publisher.send_qa_posts(ISOTracker, [
+            ("iso-trusty", "Ubuntu Desktop i386", "20130221", ""),
+            ("iso-precise", "Ubuntu Desktop i386", "20130221", ""),
+            ("iso-trusty", "Ubuntu Desktop amd64", "20130221", ""),
+        ])
+        self.assertEqual(
+            {
+                "iso-trusty": [
+                    ["Ubuntu Desktop i386", "20130221", ""],
+                    ["Ubuntu Desktop amd64", "20130221", ""],
+                ],
+                "iso-precise": [["Ubuntu Desktop i386", "20130221", ""]],
+            },
+            dict((tracker.target, tracker.posted) for tracker in trackers))
+        self.assertEqual([], osextras.listdir_force(publisher.qa_spool))
+
+    @mock.patch("traceback.print_exc")
+    def test_send_qa_posts_spools_failures(self, *args):
+        class ISOTracker(isotracker_module.ISOTracker):
+            def post_build(self, product, date, note=""):
+                if product.endswith("i386"):
+                    raise Exception("tracker is down")
+                super(ISOTracker, self).post_build(product, date, note=note)
+
+        publisher = self.make_publisher("ubuntu", "daily-live")
+        self.capture_logging()
+        publisher.send_qa_posts(ISOTracker, [
+            ("iso-trusty", "Ubuntu Desktop i386", "20130221", "note"),
+            ("iso-trusty", "Ubuntu Desktop amd64", "20130221", ""),
+        ])
+        self.assertLogEqual([
+            "Failed to post Ubuntu Desktop i386 20130221 to iso-trusty; "
+            "spooled for retry.",
+        ])
+        self.assertEqual(
+            [["Ubuntu Desktop amd64", "20130221", ""]],
+            isotracker_module.tracker.posted)
+        self.assertEqual(1, len(os.listdir(publisher.qa_spool)))
+
+        # The next run retries spooled posts first.
+        publisher.send_qa_posts(isotracker_module.ISOTracker, [
+            ("iso-trusty", "Ubuntu Desktop amd64", "20130222", ""),
+        ])
+        self.assertEqual([
+            ["Ubuntu Desktop i386", "20130221", "note"],
+            ["Ubuntu Desktop amd64", "20130222", ""],
+        ], isotracker_module.tracker.posted)
+        self.assertEqual([], os.listdir(publisher.qa_spool))
+
+    def test_send_qa_posts_sets_timeout(self):
+        proxies = []
+
+        class ISOTracker(isotracker_module.ISOTracker):
+            def __init__(self, target):
+                super(ISOTracker, self).__init__(target)
+                proxies.append(
+                    xmlrpc_client.ServerProxy("https://localhost/"))
+
+        self.config["CDIMAGE_QA_TIMEOUT"] = "5"
+        publisher = self.make_publisher("ubuntu", "daily-live")
+        old_timeout = socket.getdefaulttimeout()
+        publisher.send_qa_posts(ISOTracker, [
+            ("iso-trusty", "Ubuntu Desktop i386", "20130221", ""),
+        ])
+        # The process-wide default is left alone.
+        self.assertEqual(old_timeout, socket.getdefaulttimeout())
+        transport = proxies[0]("transport")
+        self.assertIsInstance(transport, TimeoutSafeTransport)
+        self.assertEqual(5, transport.timeout)
+        self.assertIs(
+            xmlrpc_client.ServerProxy,
+            type(xmlrpc_client.ServerProxy("http://localhost/")))
+
+    def test_timeout_transport(self):
+        transport = TimeoutTransport(10)
+        self.assertEqual(10, transport.make_connection("localhost").timeout)
+        with xmlrpc_timeout(10):
+            proxy = xmlrpc_client.ServerProxy("http://localhost/")
+            explicit = xmlrpc_client.ServerProxy(
+                "http://localhost/", transport=transport)
+        self.assertIsInstance(proxy("transport"), TimeoutTransport)
+        self.assertEqual(10, proxy("transport").timeout)
+        self.assertIs(transport, explicit("transport"))
+
+    @mock.patch("traceback.print_exc")
+    def test_send_qa_posts_keeps_spool_until_sent(self, *args):
+        class ISOTracker(isotracker_module.ISOTracker):
+            def post_build(self, product, date, note=""):
+                raise Exception("tracker is down")
+
+        publisher = self.make_publisher("ubuntu", "daily-live")
+        post = ("iso-trusty", "Ubuntu Desktop i386", "20130221", "")
+        publisher.spool_qa_post(post)
+        self.capture_logging()
+        publisher.send_qa_posts(ISOTracker, [])
+        self.assertEqual([post], publisher.spooled_qa_posts())
+        # A crash while sending leaves the post spooled as well.
+        with mock.patch.object(
+                isotracker_module.ISOTracker, "post_build",
+                side_effect=KeyboardInterrupt):
+            self.assertRaises(
+                KeyboardInterrupt, publisher.send_qa_posts,
+                isotracker_module.ISOTracker, [])
+        self.assertEqual([post], publisher.spooled_qa_posts())
+        publisher.send_qa_posts(isotracker_module.ISOTracker, [])
+        self.assertEqual([], publisher.spooled_qa_posts())
+        self.assertEqual(
+            [["Ubuntu Desktop i386", "20130221", ""]],
+            isotracker_module.tracker.posted)
+
+    @mock_isotracker
+    @mock.patch("subprocess.Popen")
+    @mock.patch("cdimage.osextras.find_on_path", return_value=True)
+    def test_queue_qa_posts(self, mock_find_on_path, mock_popen):
+        publisher = self.make_publisher("ubuntu", "daily-live")
+        os.makedirs(os.path.join(publisher.publish_base, "20130221"))
+        isotracker_module.tracker = None
+        publisher.queue_qa_posts(
+            "20130221", ["ubuntu/daily-live/trusty-desktop-i386"])
+        # Nothing is posted from the publishing process itself.
+        self.assertIsNone(isotracker_module.tracker)
+        self.assertEqual(
+            [("iso-trusty", "Ubuntu Desktop i386", "20130221", "")],
+            publisher.spooled_qa_posts())
+        mock_find_on_path.assert_called_once_with("post-qa")
+        self.assertEqual(1, mock_popen.call_count)
+        self.assertEqual(["post-qa", "--retry"], mock_popen.call_args[0][0])
+
+    @mock.patch("subprocess.call")
     @mock.patch("cdimage.tree.DailyTreePublisher.make_web_indices")
     def test_polish_directory(self, mock_make_web_indices, mock_call):
         publisher = self.make_publisher("ubuntu", "daily-live")
@@ -1423,12 +2216,26 @@ class TestDailyTreePublisher(TestCase):
         self.assertCountEqual([
             ".publish_info",
             "MD5SUMS",
+            "MD5SUMS-metalink",
             "SHA1SUMS",
             "SHA256SUMS",
             "%s-desktop-i386.iso" % self.config.series,
+            "%s-desktop-i386.iso.meta4" % self.config.series,
+            "%s-desktop-i386.iso.metalink" % self.config.series,
         ], os.listdir(target_dir))
         mock_make_web_indices.assert_called_once_with(
             target_dir, self.config.series, status="daily")
+        # Metalinks are written natively unless asked otherwise.
+        mock_call.assert_not_called()
+
+    @mock.patch("subprocess.call", return_value=0)
+    def test_make_metalink_external(self, mock_call):
+        self.config["CDIMAGE_EXTERNAL_METALINK"] = "1"
+        publisher = self.make_publisher("ubuntu", "daily-live")
+        target_dir = os.path.join(publisher.publish_base, "20130320")
+        touch(os.path.join(
+            target_dir, "%s-desktop-i386.iso" % self.config.series))
+        publisher.make_metalink(target_dir, self.config.series)
         metalink_builder = os.path.join(
             self.temp_dir, "MirrorMetalink", "build.py")
         mock_call.assert_called_once_with([
@@ -1437,6 +2244,31 @@ class TestDailyTreePublisher(TestCase):
             publisher.tree.site_name
         ])
 
+    def test_make_metalink_native(self):
+        # Metalinks are built from the checksums already in the directory.
+        self.config["CDIMAGE_METALINK_MIRRORS"] = (
+            "https://mirror.example.org/cdimage/")
+        publisher = self.make_publisher("ubuntu", "daily-live")
+        target_dir = os.path.join(publisher.publish_base, "20130320")
+        image = "%s-desktop-i386.iso" % self.config.series
+        touch(os.path.join(target_dir, image))
+        with mkfile(os.path.join(target_dir, "SHA256SUMS")) as sha256sums:
+            print("%s *%s" % ("0" * 64, image), file=sha256sums)
+        self.capture_logging()
+        publisher.make_metalink(target_dir, self.config.series)
+        self.assertCountEqual([
+            "MD5SUMS-metalink", "SHA256SUMS",
+            image, "%s.meta4" % image, "%s.metalink" % image,
+        ], os.listdir(target_dir))
+        with open(os.path.join(target_dir, "%s.meta4" % image)) as meta4:
+            contents = meta4.read()
+        self.assertIn('<hash type="sha-256">%s</hash>' % ("0" * 64), contents)
+        reldir = os.path.relpath(target_dir, publisher.tree.directory)
+        self.assertIn(
+            "<url priority=\"1\">https://mirror.example.org/cdimage/%s/%s"
+            "</url>" % (reldir, image),
+            contents)
+
     def test_create_publish_info_file(self):
         publisher = self.make_publisher("ubuntu", "daily-live")
         target_dir = os.path.join(publisher.publish_base, "20130320")
@@ -1512,8 +2344,8 @@ class TestDailyTreePublisher(TestCase):
     @mock.patch("cdimage.osextras.find_on_path", return_value=True)
     @mock.patch("cdimage.tree.zsyncmake")
     @mock.patch("cdimage.tree.DailyTreePublisher.make_metalink")
-    @mock.patch("cdimage.tree.DailyTreePublisher.post_qa")
-    def test_publish(self, mock_post_qa, *args):
+    @mock.patch("cdimage.tree.DailyTreePublisher.queue_qa_posts")
+    def test_publish(self, mock_queue_qa, *args):
         self.config["ARCHES"] = "i386"
         self.config["CDIMAGE_INSTALL_BASE"] = "1"
         publisher = self.make_publisher("ubuntu", "daily-live")
@@ -1536,6 +2368,8 @@ class TestDailyTreePublisher(TestCase):
             "Publishing i386 live manifest ...",
             "Making i386 zsync metafile ...",
             "No keys found; not signing images.",
+            "Made %s-desktop-i386.iso.zsync in 0.0 seconds" %
+            self.config.series,
         ])
         target_dir = os.path.join(publisher.publish_base, "20120807")
         self.assertEqual([], os.listdir(source_dir))
@@ -1556,7 +2390,7 @@ class TestDailyTreePublisher(TestCase):
         self.assertCountEqual(
             [".htaccess", "20120807", "current", "pending"],
             os.listdir(publisher.publish_base))
-        mock_post_qa.assert_called_once_with(
+        mock_queue_qa.assert_called_once_with(
             "20120807",
             ["ubuntu/daily-live/%s-desktop-i386" % self.config.series])
 
@@ -1566,6 +2400,58 @@ class TestDailyTreePublisher(TestCase):
                 "%s-desktop-i386.iso 20120807\n" % self.config.series,
                 info.read())
 
+    @mock.patch("cdimage.osextras.find_on_path", return_value=True)
+    @mock.patch("cdimage.tree.zsyncmake")
+    @mock.patch("cdimage.tree.DailyTreePublisher.make_metalink")
+    @mock.patch("cdimage.tree.DailyTreePublisher.queue_qa_posts")
+    def test_publish_resume(self, mock_queue_qa, mock_make_metalink,
+                            mock_zsyncmake, *args):
+        self.config["ARCHES"] = "i386"
+        self.config["CDIMAGE_INSTALL_BASE"] = "1"
+        self.config["CDIMAGE_LIVE"] = "1"
+        publisher = self.make_publisher("ubuntu", "daily-live")
+        source_dir = publisher.image_output("i386")
+        touch(os.path.join(source_dir, "%s-desktop-i386.%s" % (
+            self.config.series, publisher.source_extension)))
+        touch(os.path.join(
+            source_dir, "%s-desktop-i386.manifest" % self.config.series))
+        mock_queue_qa.side_effect = [IOError("interrupted"), None]
+        self.capture_logging()
+        self.assertRaises(IOError, publisher.publish, "20120807")
+        target_dir = os.path.join(publisher.publish_base, "20120807")
+        self.assertEqual([], os.listdir(source_dir))
+        # The journal is kept out of the published tree.
+        journal_path = publisher.journal.path
+        self.assertTrue(os.path.exists(journal_path))
+        self.assertEqual(
+            os.path.join(self.temp_dir, "log", "publish-journal"),
+            os.path.dirname(journal_path))
+        self.assertEqual(1, mock_zsyncmake.call_count)
+
+        publisher = self.make_publisher("ubuntu", "daily-live")
+        self.capture_logging()
+        publisher.publish("20120807")
+        log = self.captured_log_messages()
+        self.assertEqual([
+            "Resuming interrupted publication of 20120807 ...",
+            "Skipping new publish directory (already done)",
+            "Publishing i386 ...",
+            "Publishing i386 live manifest ...",
+        ], log[:4])
+        # Publishing i386 again dropped it from the checksum files, so the
+        # directory is polished again.
+        self.assertNotIn("Skipping polish (already done)", log)
+        self.assertIn("SHA256SUMS", os.listdir(target_dir))
+        # The image was already moved and its zsync metafile made.
+        self.assertEqual(1, mock_zsyncmake.call_count)
+        self.assertFalse(os.path.exists(journal_path))
+        self.assertIn(
+            "%s-desktop-i386.iso" % self.config.series,
+            os.listdir(target_dir))
+        self.assertEqual(2, mock_queue_qa.call_count)
+        self.assertEqual(
+            mock_queue_qa.call_args_list[0], mock_queue_qa.call_args_list[1])
+
     def test_get_purge_data_no_config(self):
         publisher = self.make_publisher("ubuntu", "daily")
         self.assertIsNone(publisher.get_purge_data("daily", "purge-days"))
@@ -1815,6 +2701,36 @@ class TestChinaDailyTree(TestDailyTree):
     def test_site_name(self):
         self.assertEqual("china-images.ubuntu.com", self.tree.site_name)
 
+    def test_split_publish_base(self):
+        self.assertEqual(
+            ("ubuntu-zh_CN", "bionic/daily-live", "daily-live"),
+            self.tree.split_publish_base("bionic/daily-live"))
+
+    def test_split_publish_base_locale(self):
+        self.config["UBUNTU_DEFAULTS_LOCALE"] = "zh_CN"
+        self.assertEqual(
+            ("ubuntu-zh_CN", "bionic/daily-live", "daily-live"),
+            self.tree.split_publish_base("bionic/daily-live"))
+
+    @mock.patch("time.time", return_value=date_to_time("20130321"))
+    def test_purge(self, *args):
+        self.config.root = self.temp_dir
+        tree = ChinaDailyTree(self.config)
+        for name in "20130319", "20130320", "20130321":
+            touch(os.path.join(tree.directory, "bionic", "daily", name, "f"))
+        with mkfile(os.path.join(
+                self.temp_dir, "etc", "purge-days")) as purge_days:
+            print("ubuntu-zh_CN/daily 1", file=purge_days)
+        self.capture_logging()
+        tree.purge()
+        self.assertLogEqual([
+            "Purging 1 image, freeing 0.0 MiB",
+            "Purging ubuntu-zh_CN/bionic/daily/20130319",
+        ])
+        self.assertCountEqual(
+            ["20130320", "20130321"],
+            os.listdir(os.path.join(tree.directory, "bionic", "daily")))
+
 
 class TestChinaDailyTreePublisher(TestDailyTreePublisher):
     def setUp(self):
@@ -1902,6 +2818,7 @@ class TestChinaDailyTreePublisher(TestDailyTreePublisher):
             "%s-desktop-i386.list" % self.config.series,
             "%s-desktop-i386.manifest" % self.config.series,
         ], os.listdir(target_dir))
+        publisher.wait_for_zsync()
         mock_zsyncmake.assert_called_once_with(
             os.path.join(
                 target_dir, "%s-desktop-i386.iso" % self.config.series),
@@ -1912,6 +2829,12 @@ class TestChinaDailyTreePublisher(TestDailyTreePublisher):
     def test_publish_core_binary(self):
         pass
 
+    def test_publish_binaries(self):
+        pass
+
+    def test_publish_binaries_native_zsync(self):
+        pass
+
     def test_publish_livecd_base(self):
         pass
 
@@ -1922,6 +2845,9 @@ class TestChinaDailyTreePublisher(TestDailyTreePublisher):
     def test_post_qa(self):
         pass
 
+    def test_queue_qa_posts(self):
+        pass
+
     @mock_isotracker
     def test_post_qa_oversized(self):
         publisher = self.make_publisher("ubuntu", "daily-live")
@@ -1941,8 +2867,8 @@ class TestChinaDailyTreePublisher(TestDailyTreePublisher):
     @mock.patch("cdimage.osextras.find_on_path", return_value=True)
     @mock.patch("cdimage.tree.zsyncmake")
     @mock.patch("cdimage.tree.DailyTreePublisher.make_metalink")
-    @mock.patch("cdimage.tree.DailyTreePublisher.post_qa")
-    def test_publish(self, mock_post_qa, *args):
+    @mock.patch("cdimage.tree.DailyTreePublisher.queue_qa_posts")
+    def test_publish(self, mock_queue_qa, *args):
         self.config["ARCHES"] = "i386"
         self.config["CDIMAGE_LIVE"] = "1"
         publisher = self.make_publisher("ubuntu", "daily-live")
@@ -1963,6 +2889,8 @@ class TestChinaDailyTreePublisher(TestDailyTreePublisher):
             "Publishing i386 live manifest ...",
             "Making i386 zsync metafile ...",
             "No keys found; not signing images.",
+            "Made %s-desktop-i386.iso.zsync in 0.0 seconds" %
+            self.config.series,
         ])
         target_dir = os.path.join(publisher.publish_base, "20120807")
         self.assertEqual([], os.listdir(source_dir))
@@ -1982,7 +2910,7 @@ class TestChinaDailyTreePublisher(TestDailyTreePublisher):
         self.assertCountEqual(
             [".htaccess", "20120807", "current", "pending"],
             os.listdir(publisher.publish_base))
-        mock_post_qa.assert_called_once_with(
+        mock_queue_qa.assert_called_once_with(
             "20120807",
             ["ubuntu-zh_CN/%s/daily-live/%s-desktop-i386" % (
                 self.config.series, self.config.series)])
@@ -2209,6 +3137,18 @@ class TestReleasePublisherMixin:
         with open(new_path) as new:
             self.assertEqual("sentinel\n", new.read())
 
+    def test_copy_shares_storage(self):
+        old_path = os.path.join(self.temp_dir, "old")
+        with mkfile(old_path) as old:
+            print("sentinel", file=old)
+        publisher = self.get_publisher()
+        for name in "pool", "full":
+            publisher.copy(old_path, os.path.join(self.temp_dir, name))
+        pool_stat = os.stat(os.path.join(self.temp_dir, "pool"))
+        full_stat = os.stat(os.path.join(self.temp_dir, "full"))
+        self.assertEqual(pool_stat.st_ino, full_stat.st_ino)
+        self.assertNotEqual(os.stat(old_path).st_ino, pool_stat.st_ino)
+
     def test_symlink(self):
         pool_path = os.path.join(self.temp_dir, ".pool", "foo.iso")
         touch(pool_path)
@@ -2363,8 +3303,9 @@ class TestFullReleasePublisher(TestCase, TestReleasePublisherMixin):
             self.get_publisher(official="no").want_torrent("desktop"))
         self.assertFalse(self.get_publisher().want_torrent("src"))
 
+    @mock.patch("cdimage.osextras.find_on_path", return_value=True)
     @mock.patch("subprocess.check_call")
-    def test_make_torrents(self, mock_check_call):
+    def test_make_torrents(self, mock_check_call, *args):
         self.config["CAPPROJECT"] = "Ubuntu"
         paths = [
             os.path.join(
@@ -2399,6 +3340,7 @@ class TestFullReleasePublisher(TestCase, TestReleasePublisherMixin):
             ("kubuntu-6.06.2", "kubuntu-6.06.2"),
             self.get_publisher(official="named").publish_release_prefixes())
 
+    @mock.patch("cdimage.tree.md4_is_native", return_value=False)
     @mock.patch("cdimage.osextras.find_on_path", return_value=True)
     @mock.patch("subprocess.call", side_effect=call_btmakemetafile_zsyncmake)
     def test_publish_release_arch_ubuntu_desktop_named(self, mock_call, *args):
@@ -2421,11 +3363,13 @@ class TestFullReleasePublisher(TestCase, TestReleasePublisherMixin):
         publisher = self.get_publisher(official="named", status="rc")
         publisher.publish_release_arch(
             "daily-live", "20130327", "desktop", "i386")
+        publisher.wait_for_zsync()
         self.assertLogEqual([
             "Copying desktop-i386 image ...",
             "Making i386 zsync metafile ...",
             "Creating torrent for %s/ubuntu-13.04-rc-desktop-i386.iso ..." %
             target_dir,
+            "Made ubuntu-13.04-rc-desktop-i386.iso.zsync in 0.0 seconds",
         ])
         self.assertCountEqual([
             "ubuntu-13.04-rc-desktop-i386.iso",
@@ -2436,19 +3380,19 @@ class TestFullReleasePublisher(TestCase, TestReleasePublisherMixin):
         target_base = os.path.join(target_dir, "ubuntu-13.04-rc-desktop-i386")
         self.assertFalse(os.path.islink("%s.iso" % target_base))
         self.assertFalse(os.path.islink("%s.manifest" % target_base))
-        self.assertEqual(2, mock_call.call_count)
-        mock_call.assert_has_calls([
-            mock.call([
-                "zsyncmake", "-o", "%s.iso.zsync" % target_base,
-                "-u", "ubuntu-13.04-rc-desktop-i386.iso",
-                "%s.iso" % target_base,
-            ]),
-            mock.call([
-                "btmakemetafile", mock.ANY,
-                "--comment", "Ubuntu CD cdimage.ubuntu.com",
-                "%s.iso" % target_base,
-            ], stdout=mock.ANY),
+        # The torrent is made natively while the image is read for its
+        # checksums; zsyncmake is used since hashlib has no MD4.
+        mock_call.assert_called_once_with([
+            "zsyncmake", "-b", "2048", "-o", "%s.iso.zsync" % target_base,
+            "-u", "ubuntu-13.04-rc-desktop-i386.iso",
+            "%s.iso" % target_base,
         ])
+        with open("%s.iso.torrent" % target_base, "rb") as torrent:
+            metainfo = bdecode(torrent.read())
+        self.assertEqual(
+            b"Ubuntu CD cdimage.ubuntu.com", metainfo[b"comment"])
+        self.assertEqual(
+            b"ubuntu-13.04-rc-desktop-i386.iso", metainfo[b"info"][b"name"])
         self.assertCountEqual([
             "ubuntu-13.04-rc-desktop-i386.iso",
             "ubuntu-13.04-rc-desktop-i386.iso.torrent",
@@ -2494,11 +3438,7 @@ class TestFullReleasePublisher(TestCase, TestReleasePublisherMixin):
         target_base = os.path.join(target_dir, "trusty-desktop-i386")
         self.assertFalse(os.path.islink("%s.iso" % target_base))
         self.assertFalse(os.path.islink("%s.manifest" % target_base))
-        mock_call.assert_called_once_with([
-            "btmakemetafile", mock.ANY,
-            "--comment", "Ubuntu CD cdimage.ubuntu.com",
-            "%s.iso" % target_base,
-        ], stdout=mock.ANY)
+        mock_call.assert_not_called()
         self.assertCountEqual([
             "trusty-desktop-i386.iso", "trusty-desktop-i386.iso.torrent",
         ], os.listdir(torrent_dir))
@@ -2509,6 +3449,7 @@ class TestFullReleasePublisher(TestCase, TestReleasePublisherMixin):
             os.stat("%s.iso.torrent" % target_base),
             os.stat("%s.iso.torrent" % torrent_base))
 
+    @mock.patch("cdimage.tree.md4_is_native", return_value=False)
     @mock.patch("cdimage.osextras.find_on_path", return_value=True)
     @mock.patch("subprocess.call", side_effect=call_btmakemetafile_zsyncmake)
     def test_publish_release_kubuntu_desktop_named(self, mock_call, *args):
@@ -2544,6 +3485,10 @@ class TestFullReleasePublisher(TestCase, TestReleasePublisherMixin):
             "Making i386 zsync metafile ...",
             "Creating torrent for %s/kubuntu-%s-desktop-i386.iso ..." % (
                 target_dir, series.version),
+            "Made kubuntu-%s-desktop-amd64.iso.zsync in 0.0 seconds" %
+            series.version,
+            "Made kubuntu-%s-desktop-i386.iso.zsync in 0.0 seconds" %
+            series.version,
             "Checksumming full tree ...",
             "No keys found; not signing images.",
             "Creating and publishing metalink files for the full tree ...",
@@ -2553,12 +3498,16 @@ class TestFullReleasePublisher(TestCase, TestReleasePublisherMixin):
         ])
         self.assertCountEqual([
             ".htaccess", "FOOTER.html", "HEADER.html",
-            "MD5SUMS", "SHA1SUMS", "SHA256SUMS",
+            "MD5SUMS", "MD5SUMS-metalink", "SHA1SUMS", "SHA256SUMS",
             "kubuntu-%s-desktop-amd64.iso" % series.version,
+            "kubuntu-%s-desktop-amd64.iso.meta4" % series.version,
+            "kubuntu-%s-desktop-amd64.iso.metalink" % series.version,
             "kubuntu-%s-desktop-amd64.iso.torrent" % series.version,
             "kubuntu-%s-desktop-amd64.iso.zsync" % series.version,
             "kubuntu-%s-desktop-amd64.manifest" % series.version,
             "kubuntu-%s-desktop-i386.iso" % series.version,
+            "kubuntu-%s-desktop-i386.iso.meta4" % series.version,
+            "kubuntu-%s-desktop-i386.iso.metalink" % series.version,
             "kubuntu-%s-desktop-i386.iso.torrent" % series.version,
             "kubuntu-%s-desktop-i386.iso.zsync" % series.version,
             "kubuntu-%s-desktop-i386.manifest" % series.version,
@@ -2657,8 +3606,9 @@ class TestSimpleReleasePublisher(TestCase, TestReleasePublisherMixin):
             self.get_publisher(official="poolonly").want_torrent("desktop"))
         self.assertFalse(self.get_publisher().want_torrent("src"))
 
+    @mock.patch("cdimage.osextras.find_on_path", return_value=True)
     @mock.patch("subprocess.check_call")
-    def test_make_torrents(self, mock_check_call):
+    def test_make_torrents(self, mock_check_call, *args):
         self.config["CAPPROJECT"] = "Ubuntu"
         paths = [
             os.path.join(
@@ -2680,6 +3630,26 @@ class TestSimpleReleasePublisher(TestCase, TestReleasePublisherMixin):
             mock.call(command_base + [path], stdout=mock.ANY)
             for path in paths])
 
+    @mock.patch("cdimage.osextras.find_on_path", return_value=False)
+    def test_make_torrent_native(self, *args):
+        self.config["CAPPROJECT"] = "Ubuntu"
+        path = os.path.join(self.temp_dir, "ubuntu-13.04-desktop-i386.iso")
+        with mkfile(path) as f:
+            f.write("image")
+        self.get_publisher(image_type="daily-live").make_torrent(path)
+        with open("%s.torrent" % path, "rb") as torrent:
+            metainfo = bdecode(torrent.read())
+        self.assertEqual(
+            b"https://torrent.ubuntu.com/announce", metainfo[b"announce"])
+        self.assertEqual([
+            [b"https://torrent.ubuntu.com/announce"],
+            [b"https://ipv6.torrent.ubuntu.com/announce"],
+        ], metainfo[b"announce-list"])
+        self.assertEqual(
+            b"Ubuntu CD releases.ubuntu.com", metainfo[b"comment"])
+        self.assertEqual(
+            b"ubuntu-13.04-desktop-i386.iso", metainfo[b"info"][b"name"])
+
     def test_publish_release_prefixes(self):
         self.config["PROJECT"] = "ubuntu"
         self.config["DIST"] = "raring"
@@ -2692,6 +3662,7 @@ class TestSimpleReleasePublisher(TestCase, TestReleasePublisherMixin):
             ("kubuntu-6.06.2", "kubuntu-6.06.2"),
             self.get_publisher().publish_release_prefixes())
 
+    @mock.patch("cdimage.tree.md4_is_native", return_value=False)
     @mock.patch("cdimage.osextras.find_on_path", return_value=True)
     @mock.patch("subprocess.call", side_effect=call_btmakemetafile_zsyncmake)
     def test_publish_release_arch_ubuntu_desktop_yes(self, mock_call, *args):
@@ -2714,11 +3685,13 @@ class TestSimpleReleasePublisher(TestCase, TestReleasePublisherMixin):
         publisher = self.get_publisher(official="yes", status="rc")
         publisher.publish_release_arch(
             "daily-live", "20130327", "desktop", "i386")
+        publisher.wait_for_zsync()
         self.assertLogEqual([
             "Copying desktop-i386 image ...",
             "Making i386 zsync metafile ...",
             "Creating torrent for %s/ubuntu-13.04-rc-desktop-i386.iso ..." %
             target_dir,
+            "Made ubuntu-13.04-rc-desktop-i386.iso.zsync in 0.0 seconds",
         ])
         self.assertCountEqual([
             "ubuntu-13.04-rc-desktop-i386.iso",
@@ -2743,20 +3716,19 @@ class TestSimpleReleasePublisher(TestCase, TestReleasePublisherMixin):
             "../.pool/ubuntu-13.04-rc-desktop-i386.manifest",
             os.readlink("%s.manifest" % target_base))
         self.assertFalse(os.path.islink("%s.iso.torrent" % target_base))
-        self.assertEqual(2, mock_call.call_count)
-        mock_call.assert_has_calls([
-            mock.call([
-                "zsyncmake", "-o", "%s.iso.zsync" % pool_base,
-                "-u", "ubuntu-13.04-rc-desktop-i386.iso",
-                "%s.iso" % pool_base,
-            ]),
-            mock.call([
-                "btmakemetafile", mock.ANY,
-                "--announce_list", mock.ANY,
-                "--comment", "Ubuntu CD releases.ubuntu.com",
-                "%s.iso" % target_base,
-            ], stdout=mock.ANY),
+        mock_call.assert_called_once_with([
+            "zsyncmake", "-b", "2048", "-o", "%s.iso.zsync" % pool_base,
+            "-u", "ubuntu-13.04-rc-desktop-i386.iso",
+            "%s.iso" % pool_base,
         ])
+        with open("%s.iso.torrent" % target_base, "rb") as torrent:
+            metainfo = bdecode(torrent.read())
+        self.assertEqual(
+            [[b"https://torrent.ubuntu.com/announce"],
+             [b"https://ipv6.torrent.ubuntu.com/announce"]],
+            metainfo[b"announce-list"])
+        self.assertEqual(
+            b"Ubuntu CD releases.ubuntu.com", metainfo[b"comment"])
         self.assertCountEqual([
             "ubuntu-13.04-rc-desktop-i386.iso",
             "ubuntu-13.04-rc-desktop-i386.iso.torrent",
@@ -2769,6 +3741,7 @@ class TestSimpleReleasePublisher(TestCase, TestReleasePublisherMixin):
             os.stat("%s.iso.torrent" % target_base),
             os.stat("%s.iso.torrent" % torrent_base))
 
+    @mock.patch("cdimage.tree.md4_is_native", return_value=False)
     @mock.patch("cdimage.osextras.find_on_path", return_value=True)
     @mock.patch("subprocess.call", side_effect=call_btmakemetafile_zsyncmake)
     def test_publish_release_arch_ubuntu_desktop_poolonly(self, mock_call,
@@ -2787,9 +3760,11 @@ class TestSimpleReleasePublisher(TestCase, TestReleasePublisherMixin):
         publisher = self.get_publisher(official="poolonly", status="rc")
         publisher.publish_release_arch(
             "daily-live", "20130327", "desktop", "i386")
+        publisher.wait_for_zsync()
         self.assertLogEqual([
             "Copying desktop-i386 image ...",
             "Making i386 zsync metafile ...",
+            "Made ubuntu-13.04-rc-desktop-i386.iso.zsync in 0.0 seconds",
         ])
         self.assertCountEqual([
             "ubuntu-13.04-rc-desktop-i386.iso",
@@ -2802,11 +3777,12 @@ class TestSimpleReleasePublisher(TestCase, TestReleasePublisherMixin):
             self.temp_dir, "www", "torrent", "simple", "trusty", "desktop")))
         pool_base = os.path.join(pool_dir, "ubuntu-13.04-rc-desktop-i386")
         mock_call.assert_called_once_with([
-            "zsyncmake", "-o", "%s.iso.zsync" % pool_base,
+            "zsyncmake", "-b", "2048", "-o", "%s.iso.zsync" % pool_base,
             "-u", "ubuntu-13.04-rc-desktop-i386.iso",
             "%s.iso" % pool_base,
         ])
 
+    @mock.patch("cdimage.tree.md4_is_native", return_value=False)
     @mock.patch("cdimage.osextras.find_on_path", return_value=True)
     @mock.patch("subprocess.call", side_effect=call_btmakemetafile_zsyncmake)
     def test_publish_release_kubuntu_desktop_yes(self, mock_call, *args):
@@ -2843,6 +3819,10 @@ class TestSimpleReleasePublisher(TestCase, TestReleasePublisherMixin):
             "Making i386 zsync metafile ...",
             "Creating torrent for %s/kubuntu-%s-desktop-i386.iso ..." % (
                 target_dir, series.version),
+            "Made kubuntu-%s-desktop-amd64.iso.zsync in 0.0 seconds" %
+            series.version,
+            "Made kubuntu-%s-desktop-i386.iso.zsync in 0.0 seconds" %
+            series.version,
             "Checksumming simple tree (pool) ...",
             "No keys found; not signing images.",
             "Checksumming simple tree (%s) ..." % series,
@@ -2864,12 +3844,16 @@ class TestSimpleReleasePublisher(TestCase, TestReleasePublisherMixin):
         ], os.listdir(pool_dir))
         self.assertCountEqual([
             ".htaccess", "FOOTER.html", "HEADER.html",
-            "MD5SUMS", "SHA1SUMS", "SHA256SUMS",
+            "MD5SUMS", "MD5SUMS-metalink", "SHA1SUMS", "SHA256SUMS",
             "kubuntu-%s-desktop-amd64.iso" % series.version,
+            "kubuntu-%s-desktop-amd64.iso.meta4" % series.version,
+            "kubuntu-%s-desktop-amd64.iso.metalink" % series.version,
             "kubuntu-%s-desktop-amd64.iso.torrent" % series.version,
             "kubuntu-%s-desktop-amd64.iso.zsync" % series.version,
             "kubuntu-%s-desktop-amd64.manifest" % series.version,
             "kubuntu-%s-desktop-i386.iso" % series.version,
+            "kubuntu-%s-desktop-i386.iso.meta4" % series.version,
+            "kubuntu-%s-desktop-i386.iso.metalink" % series.version,
             "kubuntu-%s-desktop-i386.iso.torrent" % series.version,
             "kubuntu-%s-desktop-i386.iso.zsync" % series.version,
             "kubuntu-%s-desktop-i386.manifest" % series.version,
@@ -2886,3 +3870,279 @@ class TestSimpleReleasePublisher(TestCase, TestReleasePublisherMixin):
             self.temp_dir, "www", "simple", ".manifest")))
         self.assertTrue(os.path.isdir(os.path.join(
             self.temp_dir, "www", "simple", ".trace")))
+
+    def make_kubuntu_daily(self):
+        self.config["PROJECT"] = "kubuntu"
+        self.config["CAPPROJECT"] = "Kubuntu"
+        series = Series.latest()
+        self.config["DIST"] = series
+        self.config["ARCHES"] = "amd64"
+        daily_dir = os.path.join(
+            self.temp_dir, "www", "full", "kubuntu", "daily-live", "20130327")
+        for ext in "iso", "manifest", "iso.zsync":
+            with mkfile(os.path.join(
+                    daily_dir, "%s-desktop-amd64.%s" % (series, ext))) as f:
+                f.write(ext)
+        return daily_dir
+
+    @mock.patch("cdimage.osextras.find_on_path", return_value=True)
+    @mock.patch("subprocess.call", side_effect=call_btmakemetafile_zsyncmake)
+    def test_prestage_release(self, mock_call, *args):
+        self.make_kubuntu_daily()
+        series = self.config["DIST"]
+        publisher = self.get_publisher(official="yes")
+        staging = publisher.staging_area("desktop")
+        self.capture_logging()
+        publisher.prestage_release("daily-live", "20130327", "desktop")
+        self.assertLogEqual([
+            "Staging desktop-amd64 image ...",
+            "Staged in %s; publish-release will use this if the daily build "
+            "is unchanged." % staging.directory,
+        ])
+        staged_base = "kubuntu-%s-desktop-amd64" % series.version
+        self.assertCountEqual([
+            ".index",
+            "%s.iso" % staged_base, "%s.iso.torrent" % staged_base,
+            "%s.iso.zsync" % staged_base, "%s.manifest" % staged_base,
+        ], os.listdir(staging.directory))
+        staged_stat = os.stat(os.path.join(
+            staging.directory, "%s.iso.torrent" % staged_base))
+
+        # Publishing links the staged files into place.
+        mock_call.reset_mock()
+        self.capture_logging()
+        publisher = self.get_publisher(official="yes")
+        publisher.publish_release("daily-live", "20130327", "desktop")
+        self.assertEqual([], [
+            call[0][0][0] for call in mock_call.call_args_list
+            if call[0][0][0] in ("zsyncmake", "btmakemetafile")])
+        self.assertEqual([], [
+            message for message in self.captured_log_messages()
+            if message.startswith(("Creating torrent", "Made "))])
+        target_dir = os.path.join(
+            self.temp_dir, "www", "simple", "kubuntu", series.name)
+        self.assertEqual(staged_stat.st_ino, os.stat(os.path.join(
+            target_dir, "%s.iso.torrent" % staged_base)).st_ino)
+        self.assertTrue(os.path.exists(os.path.join(
+            target_dir, "%s.iso.zsync" % staged_base)))
+        self.assertFalse(os.path.exists(staging.directory))
+
+    @mock.patch("cdimage.tree.md4_is_native", return_value=False)
+    @mock.patch("cdimage.osextras.find_on_path", return_value=True)
+    @mock.patch("subprocess.call", side_effect=call_btmakemetafile_zsyncmake)
+    def test_prestage_release_invalidated(self, mock_call, *args):
+        daily_dir = self.make_kubuntu_daily()
+        series = self.config["DIST"]
+        publisher = self.get_publisher(official="yes")
+        publisher.prestage_release("daily-live", "20130327", "desktop")
+
+        # The daily build is replaced after staging.
+        image = os.path.join(daily_dir, "%s-desktop-amd64.iso" % series)
+        os.unlink(image)
+        with mkfile(image) as f:
+            f.write("rebuilt")
+        mock_call.reset_mock()
+        self.capture_logging()
+        publisher = self.get_publisher(official="yes")
+        publisher.publish_release("daily-live", "20130327", "desktop")
+        self.assertIn(
+            "Making amd64 zsync metafile ...", self.captured_log_messages())
+        self.assertEqual(
+            ["zsyncmake"], [
+                call[0][0][0] for call in mock_call.call_args_list
+                if call[0][0][0] in ("zsyncmake", "btmakemetafile")])
+        pool_image = os.path.join(
+            self.temp_dir, "www", "simple", "kubuntu", ".pool",
+            "kubuntu-%s-desktop-amd64.iso" % series.version)
+        with open(pool_image) as f:
+            self.assertEqual("rebuilt", f.read())
+
+    def record_reads(self):
+        """Return a list of the images read to checksum or store them."""
+        reads = []
+        real_run = FanoutReader.run
+        real_open = open
+
+        def run(reader):
+            reads.append(reader.path)
+            return real_run(reader)
+
+        def digest_open(path, *args, **kwargs):
+            reads.append(path)
+            return real_open(path, *args, **kwargs)
+
+        for patcher in (
+                mock.patch.object(
+                    FanoutReader, "run", autospec=True, side_effect=run),
+                # Copying is not counted, as it is usually a reflink.
+                mock.patch(
+                    "cdimage.contentstore.clone_file",
+                    side_effect=shutil.copy2),
+                mock.patch(
+                    "cdimage.contentstore.open", create=True,
+                    side_effect=digest_open)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return reads
+
+    @mock.patch("cdimage.tree.md4_is_native", return_value=True)
+    @mock.patch("cdimage.osextras.find_on_path", return_value=True)
+    @mock.patch("subprocess.call", side_effect=call_btmakemetafile_zsyncmake)
+    def test_publish_release_reads_image_once(self, mock_call, *args):
+        daily_dir = self.make_kubuntu_daily()
+        series = self.config["DIST"]
+        image = os.path.join(daily_dir, "%s-desktop-amd64.iso" % series)
+        reads = self.record_reads()
+        self.capture_logging()
+        publisher = self.get_publisher(official="yes")
+        publisher.publish_release("daily-live", "20130327", "desktop")
+        self.assertEqual(
+            [image], [path for path in reads if path.endswith(".iso")])
+        self.assertEqual([], [
+            call[0][0][0] for call in mock_call.call_args_list
+            if call[0][0][0] in ("zsyncmake", "btmakemetafile")])
+        target_base = os.path.join(
+            self.temp_dir, "www", "simple", "kubuntu", series.name,
+            "kubuntu-%s-desktop-amd64" % series.version)
+        with open("%s.iso.zsync" % target_base, "rb") as metafile:
+            self.assertIn(
+                ("\nSHA-1: %s\n" % hashlib.sha1(b"iso").hexdigest()).encode(),
+                metafile.read())
+        with open("%s.iso.torrent" % target_base, "rb") as torrent:
+            self.assertEqual(
+                3, bdecode(torrent.read())[b"info"][b"length"])
+        with open(os.path.join(
+                os.path.dirname(target_base), "SHA256SUMS")) as sha256sums:
+            self.assertIn(
+                "%s *%s.iso" % (
+                    hashlib.sha256(b"iso").hexdigest(),
+                    os.path.basename(target_base)),
+                sha256sums.read())
+
+    @mock.patch("cdimage.tree.md4_is_native", return_value=True)
+    @mock.patch("cdimage.osextras.find_on_path", return_value=True)
+    @mock.patch("subprocess.call", side_effect=call_btmakemetafile_zsyncmake)
+    def test_prestage_release_reads_image_once(self, mock_call, *args):
+        daily_dir = self.make_kubuntu_daily()
+        series = self.config["DIST"]
+        image = os.path.join(daily_dir, "%s-desktop-amd64.iso" % series)
+        reads = self.record_reads()
+        self.capture_logging()
+        publisher = self.get_publisher(official="yes")
+        publisher.prestage_release("daily-live", "20130327", "desktop")
+        self.assertEqual(
+            [image], [path for path in reads if path.endswith(".iso")])
+        mock_call.assert_not_called()
+        staged_base = os.path.join(
+            publisher.staging_area("desktop").directory,
+            "kubuntu-%s-desktop-amd64" % series.version)
+        self.assertTrue(os.path.exists("%s.iso.zsync" % staged_base))
+        self.assertTrue(os.path.exists("%s.iso.torrent" % staged_base))
+
+    @mock.patch("cdimage.osextras.find_on_path", return_value=True)
+    @mock.patch("subprocess.call", side_effect=call_btmakemetafile_zsyncmake)
+    def test_publish_release_resume(self, mock_call, *args):
+        self.make_kubuntu_daily()
+        publisher = self.get_publisher(official="yes")
+        self.capture_logging()
+        with mock.patch.object(
+                publisher, "update_site_manifest",
+                side_effect=IOError("interrupted")):
+            self.assertRaises(
+                IOError, publisher.publish_release,
+                "daily-live", "20130327", "desktop")
+        journal_path = publisher.journal.path
+        self.assertTrue(journal_path.endswith(".publish-desktop"))
+        self.assertEqual(
+            os.path.join(self.temp_dir, "log", "publish-journal"),
+            os.path.dirname(journal_path))
+        self.assertTrue(os.path.exists(journal_path))
+
+        # Publishing again only repeats the unfinished steps.
+        mock_call.reset_mock()
+        publisher = self.get_publisher(official="yes")
+        self.capture_logging()
+        publisher.publish_release("daily-live", "20130327", "desktop")
+        log = self.captured_log_messages()
+        self.assertIn("Skipping publish desktop-amd64 (already done)", log)
+        self.assertNotIn("Skipping site manifest (already done)", log)
+        self.assertEqual([], [
+            call[0][0][0] for call in mock_call.call_args_list
+            if call[0][0][0] in ("zsyncmake", "btmakemetafile")])
+        self.assertFalse(os.path.exists(journal_path))
+
+    @mock.patch("cdimage.osextras.find_on_path", return_value=True)
+    @mock.patch("subprocess.call", side_effect=call_btmakemetafile_zsyncmake)
+    def test_publish_release_dry_run_shows_plan(self, *args):
+        self.config["PROJECT"] = "kubuntu"
+        self.config["CAPPROJECT"] = "Kubuntu"
+        series = Series.latest()
+        self.config["DIST"] = series
+        self.config["ARCHES"] = "amd64 i386"
+        daily_dir = os.path.join(
+            self.temp_dir, "www", "full", "kubuntu", "daily-live", "20130327")
+        for arch, size in (("amd64", 2 * 1024 * 1024), ("i386", 1024 * 1024)):
+            with mkfile(os.path.join(
+                    daily_dir, "%s-desktop-%s.iso" % (series, arch))) as f:
+                f.write("x" * size)
+            touch(os.path.join(
+                daily_dir, "%s-desktop-%s.manifest" % (series, arch)))
+        self.capture_logging()
+        publisher = self.get_publisher(official="yes", dry_run=True)
+        publisher.publish_release("daily-live", "20130327", "desktop")
+        log = self.captured_log_messages()
+        plan_start = log.index("Publication plan:")
+        self.assertEqual([
+            "  1. publish desktop-amd64 (2.0 MiB)",
+            "  2. publish desktop-i386 (1.0 MiB)",
+            "  3. purge superseded images [after 1, 2]",
+            "  4. zsync metafiles and web indices [after 3]",
+            "  5. checksum simple tree (pool) [after 3]",
+            "  6. checksum simple tree (%s) [after 3]" % series,
+            "  7. metalink simple tree (%s) [after 6, 4]" % series,
+            "  8. site manifest [after 4, 5, 6, 7]",
+            "Estimated 3.0 MiB to copy",
+        ], log[plan_start + 1:plan_start + 10])
+        self.assertEqual(
+            "Copying desktop-amd64 image ...", log[plan_start + 10])
+        self.assertFalse(os.path.exists(os.path.join(
+            self.temp_dir, "www", "simple")))
+        cost_start = log.index("Estimated cost:")
+        self.assertEqual([
+            "  3.0 MiB copied",
+            "  3.0 MiB linked",
+            "  3.0 MiB hashed",
+            "  0.0 MiB read for zsync metafiles",
+            "  3.0 MiB read for torrents",
+            "  0 files signed",
+            "No publication history to predict time from",
+        ], log[cost_start + 1:cost_start + 8])
+
+    @mock.patch("cdimage.osextras.find_on_path", return_value=True)
+    @mock.patch("subprocess.call", side_effect=call_btmakemetafile_zsyncmake)
+    def test_publish_release_records_cost(self, *args):
+        self.make_kubuntu_daily()
+        publisher = self.get_publisher(official="yes")
+        self.capture_logging()
+        publisher.publish_release("daily-live", "20130327", "desktop")
+        history = PublishHistory(publisher.history_path)
+        entries = history.entries()
+        self.assertEqual(1, len(entries))
+        # The image and manifest are each hashed and copied once; the
+        # image is also read to make its zsync metafile and torrent.
+        self.assertEqual(11, entries[0][1]["copied"])
+        self.assertEqual(11, entries[0][1]["hashed"])
+        self.assertEqual(3, entries[0][1]["zsync"])
+        self.assertEqual(3, entries[0][1]["torrent"])
+
+        # Publishing again would not need to copy anything.
+        self.capture_logging()
+        publisher = self.get_publisher(official="yes", dry_run=True)
+        publisher.publish_release("daily-live", "20130327", "desktop")
+        log = self.captured_log_messages()
+        cost_start = log.index("Estimated cost:")
+        self.assertEqual("  0.0 MiB copied", log[cost_start + 1])
+        self.assertRegex(
+            log[cost_start + 7],
+            r"^Predicted time: \d+:\d\d:\d\d \(from 1 recent publication\)$")
+        self.assertEqual(1, len(history.entries()))
@@ -0,0 +1,169 @@
+#! /usr/bin/python
+
+# Copyright (C) 2019 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for cdimage.zsync."""
+
+import binascii
+import hashlib
+import os
+import struct
+import subprocess
+from unittest import skipUnless
+
+from cdimage import osextras
+from cdimage.tests.helpers import TestCase, mkfile
+from cdimage.zsync import (
+    ZsyncMetafile,
+    _md4_digest,
+    hash_lengths,
+    make_zsync_metafile,
+    md4_digest,
+    rolling_sums,
+)
+
+__metaclass__ = type
+
+
+zsyncmake_available = osextras.find_on_path("zsyncmake")
+
+
+class TestZsync(TestCase):
+    def setUp(self):
+        super(TestZsync, self).setUp()
+        self.use_temp_dir()
+
+    def test_md4_digest(self):
+        # Test vectors from RFC 1320.
+        for data, digest in (
+            (b"", "31d6cfe0d16ae931b73c59d7e0c089c0"),
+            (b"abc", "a448017aaf21d8525fc10ae87aa6729d"),
+            (b"message digest", "d9130a8164549fe818874806e1c7014b"),
+            (b"1234567890" * 8, "e33b4ddc9c38f2199c3e7b164fcc0536"),
+        ):
+            self.assertEqual(
+                digest, binascii.hexlify(_md4_digest(data)).decode())
+            self.assertEqual(
+                digest, binascii.hexlify(md4_digest(data)).decode())
+
+    def test_hash_lengths(self):
+        self.assertEqual((1, 2, 3), hash_lengths(0, 2048))
+        self.assertEqual((1, 2, 4), hash_lengths(1000, 2048))
+        self.assertEqual((2, 2, 5), hash_lengths(50000000, 2048))
+        self.assertEqual((2, 3, 5), hash_lengths(3000000000, 4096))
+
+    def test_metafile(self):
+        data = bytearray(range(256)) * 9
+        metafile = ZsyncMetafile(blocksize=2048)
+        metafile.update(bytes(data))
+        value = metafile.getvalue("foo.iso", "foo.iso", mtime=0)
+        headers, block_sums = value.split(b"\n\n", 1)
+        self.assertEqual([
+            b"zsync: 0.6.2",
+            b"Filename: foo.iso",
+            b"MTime: Thu, 01 Jan 1970 00:00:00 +0000",
+            b"Blocksize: 2048",
+            b"Length: 2304",
+            b"Hash-Lengths: 2,2,3",
+            b"URL: foo.iso",
+            ("SHA-1: %s" % hashlib.sha1(data).hexdigest()).encode(),
+        ], headers.split(b"\n"))
+        expected = b""
+        for block in (data[:2048], data[2048:] + b"\0" * 1792):
+            b = sum((2048 - i) * c for i, c in enumerate(block)) & 0xffff
+            expected += struct.pack(">H", b) + md4_digest(bytes(block))[:3]
+        self.assertEqual(expected, block_sums)
+
+    def test_rolling_sums(self):
+        data = os.urandom(10000)
+        for blocksize in (1, 100, 2048, 4096):
+            expected = []
+            for offset in range(0, len(data) - blocksize + 1, blocksize):
+                block = bytearray(data[offset:offset + blocksize])
+                a = sum(block) & 0xffff
+                b = sum(
+                    (blocksize - i) * c for i, c in enumerate(block)) & 0xffff
+                expected.append(struct.pack(">HH", a, b))
+            self.assertEqual(expected, rolling_sums(data, blocksize))
+
+    def test_fixed_metafile(self):
+        # Expected "zsyncmake -b 2048 -Z -u fixture.iso" output for this input,
+        # so that the format is checked even where zsyncmake is unavailable.
+        path = os.path.join(self.temp_dir, "fixture.iso")
+        with mkfile(path, mode="wb") as image:
+            image.write(bytes(bytearray(
+                (i * i // 3) % 256 for i in range(5000))))
+        os.utime(path, (1000000000, 1000000000))
+        make_zsync_metafile(path, "%s.zsync" % path, "fixture.iso")
+        with open("%s.zsync" % path, "rb") as metafile:
+            self.assertEqual(
+                b"zsync: 0.6.2\n"
+                b"Filename: fixture.iso\n"
+                b"MTime: Sun, 09 Sep 2001 01:46:40 +0000\n"
+                b"Blocksize: 2048\n"
+                b"Length: 5000\n"
+                b"Hash-Lengths: 2,2,3\n"
+                b"URL: fixture.iso\n"
+                b"SHA-1: eeb6a6bb519979f6e39eef7f8f41a88440bba722\n"
+                b"\n" +
+                binascii.unhexlify("fb39e88ee538006dba8a6e48e4080b"),
+                metafile.read())
+
+    def test_update_is_incremental(self):
+        data = os.urandom(10000)
+        whole = ZsyncMetafile(blocksize=2048)
+        whole.update(data)
+        pieces = ZsyncMetafile(blocksize=2048)
+        for offset in range(0, len(data), 777):
+            pieces.update(data[offset:offset + 777])
+        self.assertEqual(
+            whole.getvalue("foo", "foo"), pieces.getvalue("foo", "foo"))
+
+    def test_make_zsync_metafile(self):
+        path = os.path.join(self.temp_dir, "foo.iso")
+        with mkfile(path, mode="wb") as image:
+            image.write(b"x" * 3000)
+        os.utime(path, (1000000000, 1000000000))
+        make_zsync_metafile(path, "%s.zsync" % path, "foo.iso")
+        with open("%s.zsync" % path, "rb") as metafile:
+            value = metafile.read()
+        self.assertTrue(value.startswith(
+            b"zsync: 0.6.2\nFilename: foo.iso\n"
+            b"MTime: Sun, 09 Sep 2001 01:46:40 +0000\n"))
+        self.assertFalse(os.path.exists("%s.zsync.new" % path))
+
+    @skipUnless(zsyncmake_available, "zsyncmake not available")
+    def test_matches_zsyncmake(self):
+        for size, blocksize, name in (
+            (0, 2048, "empty.iso"),
+            (2048 * 3, 2048, "exact.iso"),
+            (123457, 2048, "odd.iso"),
+            (300000, 4096, "image.tar.gz"),
+        ):
+            path = os.path.join(self.temp_dir, name)
+            with mkfile(path, mode="wb") as image:
+                image.write(os.urandom(size))
+            native = os.path.join(self.temp_dir, "native.zsync")
+            reference = os.path.join(self.temp_dir, "reference.zsync")
+            make_zsync_metafile(path, native, name, blocksize=blocksize)
+            with open(os.devnull, "w") as devnull:
+                subprocess.check_call([
+                    "zsyncmake", "-b", str(blocksize), "-Z",
+                    "-o", reference, "-u", name, path,
+                ], stdout=devnull, stderr=devnull)
+            with open(native, "rb") as native_file:
+                with open(reference, "rb") as reference_file:
+                    self.assertEqual(
+                        reference_file.read(), native_file.read(), name)
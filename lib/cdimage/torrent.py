@@ -0,0 +1,191 @@
+# Copyright (C) 2019 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Native generation of BitTorrent metainfo files.
+
+The output has the same contents as that of BitTornado's btmakemetafile
+for a single file with the default (automatic) piece size.
+"""
+
+import hashlib
+from numbers import Integral
+import os
+import time
+
+from cdimage.fanout import FanoutReader
+
+__metaclass__ = type
+
+
+text_type = type(u"")
+
+
+def bencode(value):
+    """Return the bencoding of value as bytes."""
+    if isinstance(value, bool):
+        raise TypeError("cannot bencode %r" % value)
+    if isinstance(value, Integral):
+        return b"i" + str(value).encode("ASCII") + b"e"
+    if isinstance(value, text_type):
+        value = value.encode("UTF-8")
+    if isinstance(value, (bytes, bytearray)):
+        return str(len(value)).encode("ASCII") + b":" + bytes(value)
+    if isinstance(value, (list, tuple)):
+        return b"l" + b"".join(bencode(item) for item in value) + b"e"
+    if isinstance(value, dict):
+        items = []
+        for key, item in value.items():
+            if isinstance(key, text_type):
+                key = key.encode("UTF-8")
+            items.append((key, item))
+        return b"d" + b"".join(
+            bencode(key) + bencode(item)
+            for key, item in sorted(items)) + b"e"
+    raise TypeError("cannot bencode %r" % value)
+
+
+def _bdecode(data, offset):
+    kind = data[offset:offset + 1]
+    if kind == b"i":
+        end = data.index(b"e", offset)
+        return int(data[offset + 1:end]), end + 1
+    if kind == b"l":
+        offset += 1
+        items = []
+        while data[offset:offset + 1] != b"e":
+            item, offset = _bdecode(data, offset)
+            items.append(item)
+        return items, offset + 1
+    if kind == b"d":
+        offset += 1
+        items = {}
+        while data[offset:offset + 1] != b"e":
+            key, offset = _bdecode(data, offset)
+            items[key], offset = _bdecode(data, offset)
+        return items, offset + 1
+    if kind.isdigit():
+        colon = data.index(b":", offset)
+        start = colon + 1
+        end = start + int(data[offset:colon])
+        if end > len(data):
+            raise ValueError("truncated string at offset %d" % offset)
+        return data[start:end], end
+    raise ValueError("invalid bencoding at offset %d" % offset)
+
+
+def bdecode(data):
+    """Decode bencoded bytes.  Strings (including keys) decode to bytes."""
+    value, offset = _bdecode(data, 0)
+    if offset != len(data):
+        raise ValueError("trailing data at offset %d" % offset)
+    return value
+
+
+def piece_length(length):
+    """Return the piece length btmakemetafile would choose for length."""
+    if length > 8 * 1024 * 1024 * 1024:
+        exponent = 21
+    elif length > 2 * 1024 * 1024 * 1024:
+        exponent = 20
+    elif length > 512 * 1024 * 1024:
+        exponent = 19
+    elif length > 64 * 1024 * 1024:
+        exponent = 18
+    elif length > 16 * 1024 * 1024:
+        exponent = 17
+    elif length > 4 * 1024 * 1024:
+        exponent = 16
+    else:
+        exponent = 15
+    return 2 ** exponent
+
+
+class TorrentMetafile:
+    """Incrementally compute a single-file torrent.
+
+    This has the same update interface as hashlib objects, so it can be fed
+    from a read loop that is also computing other checksums.  The piece
+    length must be chosen in advance; use piece_length(size) to match
+    btmakemetafile.
+    """
+
+    def __init__(self, piece_length):
+        self.piece_length = piece_length
+        self.length = 0
+        self.pieces = bytearray()
+        self.piece = hashlib.sha1()
+        self.piece_filled = 0
+
+    def update(self, data):
+        self.length += len(data)
+        offset = 0
+        while offset < len(data):
+            take = min(
+                len(data) - offset, self.piece_length - self.piece_filled)
+            self.piece.update(data[offset:offset + take])
+            self.piece_filled += take
+            offset += take
+            if self.piece_filled == self.piece_length:
+                self.pieces.extend(self.piece.digest())
+                self.piece = hashlib.sha1()
+                self.piece_filled = 0
+
+    def info(self, name):
+        """Return the torrent's info dictionary."""
+        pieces = self.pieces
+        if self.piece_filled:
+            pieces = pieces + self.piece.digest()
+        return {
+            "length": self.length,
+            "name": name,
+            "piece length": self.piece_length,
+            "pieces": bytes(pieces),
+        }
+
+    def getvalue(self, name, announce, announce_list=None, comment=None,
+                 creation_date=None):
+        """Return the complete metainfo file as bytes.
+
+        announce_list is a list of tiers, each a list of tracker URLs.
+        """
+        if creation_date is None:
+            creation_date = time.time()
+        metainfo = {
+            "announce": announce,
+            "creation date": int(creation_date),
+            "info": self.info(name),
+        }
+        if comment:
+            metainfo["comment"] = comment
+        if announce_list:
+            metainfo["announce-list"] = announce_list
+        return bencode(metainfo)
+
+    def write(self, path, name, announce, **kwargs):
+        """Atomically write the metainfo file to path."""
+        with open("%s.new" % path, "wb") as metafile:
+            metafile.write(self.getvalue(name, announce, **kwargs))
+        os.rename("%s.new" % path, path)
+
+
+def make_torrent_metafile(infile, outfile, announce, announce_list=None,
+                          comment=None):
+    """Make a torrent for infile, like btmakemetafile."""
+    reader = FanoutReader(infile)
+    metafile = reader.add(
+        "torrent", TorrentMetafile(piece_length(os.path.getsize(infile))))
+    reader.run()
+    metafile.write(
+        outfile, os.path.basename(infile), announce,
+        announce_list=announce_list, comment=comment)
@@ -0,0 +1,129 @@
+# Copyright (C) 2019 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Deferred deletion of large directory trees.
+
+Deleting a multi-gigabyte image directory can take minutes.  Instead, it
+is renamed into a trash directory on the same file system, which is
+instant, and a background reaper deletes it later at idle I/O priority.
+Anything left in the trash by a reaper that died is picked up by the next
+one.
+"""
+
+import errno
+from itertools import count
+import os
+import shutil
+import subprocess
+import time
+
+from cdimage import osextras
+
+__metaclass__ = type
+
+
+_trash_counter = count()
+
+_claim_prefix = ".reaping-"
+
+
+def trash_directory(config):
+    return os.path.join(config.root, "www", ".trash")
+
+
+def move_to_trash(config, path):
+    """Remove path from view, deferring deletion of its contents.
+
+    If path cannot be renamed into the trash directory (for instance
+    because it is on a different file system), it is deleted immediately.
+    Return True if path was moved to the trash.
+    """
+    if os.path.islink(path):
+        osextras.unlink_force(path)
+        return False
+    trash = trash_directory(config)
+    osextras.ensuredir(trash)
+    name = "%s.%d.%d.%s" % (
+        time.strftime("%Y%m%d%H%M%S"), os.getpid(), next(_trash_counter),
+        os.path.basename(path))
+    try:
+        os.rename(path, os.path.join(trash, name))
+        return True
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    shutil.rmtree(path)
+    return False
+
+
+def trash_is_empty(config):
+    return not osextras.listdir_force(trash_directory(config))
+
+
+def reap_trash(config):
+    """Delete everything in the trash directory.
+
+    Each item is first claimed by renaming it into a directory private to
+    this process, so that concurrent reapers never work on the same item.
+    Items claimed by a reaper that has since died are claimed again.
+    """
+    trash = trash_directory(config)
+    if not os.path.isdir(trash):
+        return
+    claim_name = "%s%d" % (_claim_prefix, os.getpid())
+    claim_dir = os.path.join(trash, claim_name)
+    osextras.ensuredir(claim_dir)
+    try:
+        for name in sorted(os.listdir(trash)):
+            if name == claim_name:
+                continue
+            if name.startswith(_claim_prefix):
+                try:
+                    pid = int(name[len(_claim_prefix):])
+                except ValueError:
+                    pid = None
+                if pid is not None and osextras.pid_exists(pid):
+                    continue
+            try:
+                os.rename(
+                    os.path.join(trash, name), os.path.join(claim_dir, name))
+            except OSError as e:
+                # Claimed by another reaper in the meantime.
+                if e.errno != errno.ENOENT:
+                    raise
+    finally:
+        shutil.rmtree(claim_dir)
+
+
+def start_reaper(config):
+    """Reap the trash in a detached background process.
+
+    The reaper runs at idle I/O priority if ionice is available.  If the
+    reap-trash program cannot be found, the trash is reaped synchronously.
+    """
+    if trash_is_empty(config):
+        return
+    if not osextras.find_on_path("reap-trash"):
+        reap_trash(config)
+        return
+    command = ["reap-trash"]
+    if osextras.find_on_path("ionice"):
+        command = ["ionice", "-c", "3"] + command
+    log_dir = os.path.join(config.root, "log")
+    osextras.ensuredir(log_dir)
+    with open(os.devnull) as devnull:
+        with open(os.path.join(log_dir, "reap-trash.log"), "a") as log:
+            subprocess.Popen(
+                command, stdin=devnull, stdout=log, stderr=subprocess.STDOUT,
+                preexec_fn=os.setsid)
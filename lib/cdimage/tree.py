@@ -19,8 +19,15 @@
 
 from __future__ import print_function
 
+import contextlib
 import errno
+import gzip
 from itertools import count
+try:
+    import lzma
+except ImportError:
+    lzma = None
+import multiprocessing
 from optparse import OptionParser
 import os
 import re
@@ -34,20 +41,50 @@ import stat
 import subprocess
 import sys
 from textwrap import dedent
+import threading
 import time
 import traceback
+try:
+    import xmlrpc.client as xmlrpc_client
+except ImportError:
+    import xmlrpclib as xmlrpc_client
+import zlib
 
+from cdimage.accounting import PublishCost, PublishHistory
 from cdimage.atomicfile import AtomicFile
 from cdimage.checksums import (
     ChecksumFileSet,
     checksum_directory,
+    file_key,
     metalink_checksum_directory,
+    update_checksum_directory,
 )
-from cdimage.config import Series, Touch
+from cdimage.config import (
+    Config,
+    Series,
+    Touch,
+    all_series,
+    core_series_starts,
+    current_triggers_rules,
+)
+from cdimage.contentstore import ContentStore, install_file, remember_digest
+from cdimage.fanout import FanoutReader
+from cdimage.filecache import load_cached
+from cdimage.jobs import BackgroundJobs, Plan, job_count, map_parallel
+from cdimage.journal import PublishJournal, journal_path
 from cdimage.log import logger, reset_logging
+from cdimage.metalink import write_metalinks
 from cdimage.mirror import trigger_mirrors
 from cdimage import osextras
-from cdimage.project import setenv_for_project
+from cdimage.project import project_map, setenv_for_project
+from cdimage.staging import StagingArea
+from cdimage.torrent import (
+    TorrentMetafile,
+    make_torrent_metafile,
+    piece_length,
+)
+from cdimage.trash import move_to_trash, start_reaper
+from cdimage.zsync import ZsyncMetafile, make_zsync_metafile, md4_is_native
 
 __metaclass__ = type
 
@@ -80,19 +117,231 @@ projects = [
 ]
 
 
+# Enough to include the ISO 9660 primary volume descriptor.
+sniff_length = 32768 + 6
+
+
+def sniff_image_type(head):
+    """Identify an image from its first sectors, or return None.
+
+    The result is one of "gz", "xz", "iso", "tar", or "img".
+    """
+    if head[:2] == b"\x1f\x8b":
+        return "gz"
+    elif head[:6] == b"\xfd7zXZ\x00":
+        return "xz"
+    elif head[32768:32774] == b"\x01CD001":
+        return "iso"
+    elif head[257:262] == b"ustar":
+        return "tar"
+    elif head[510:512] == b"\x55\xaa":
+        return "img"
+    else:
+        return None
+
+
+def read_image_head(path, compression=None):
+    """Read the first sectors of an image, decompressing if necessary.
+
+    Returns None if the image cannot be decompressed here.
+    """
+    if compression is None:
+        with open(path, "rb") as image:
+            return image.read(sniff_length)
+    elif compression == "gz":
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        decompress_error = zlib.error
+    elif compression == "xz" and lzma is not None:
+        decompressor = lzma.LZMADecompressor()
+        decompress_error = lzma.LZMAError
+    else:
+        return None
+    head = b""
+    try:
+        with open(path, "rb") as image:
+            # Small reads bound how much a highly-compressible image can
+            # expand to before we stop.
+            while len(head) < sniff_length:
+                buf = image.read(4096)
+                if not buf:
+                    break
+                head += decompressor.decompress(buf)
+    except (EOFError, decompress_error):
+        return None
+    return head[:sniff_length]
+
+
+# zsyncmake's default block size for large images fails on some of
+# them, so always ask for the size that is known to work rather than
+# finding out the hard way and reading the image again.
+ZSYNC_BLOCK_SIZE = 2048
+
+
 def zsyncmake(infile, outfile, url, dry_run=False):
-    command = ["zsyncmake"]
+    command = ["zsyncmake", "-b", str(ZSYNC_BLOCK_SIZE)]
     if infile.endswith(".gz"):
         command.append("-Z")
     command.extend(["-o", outfile, "-u", url, infile])
     if dry_run:
         logger.info(" ".join(command))
-    elif subprocess.call(command) != 0:
-        logger.info("Trying again with block size 2048 ...")
-        command[1:1] = ["-b", "2048"]
+    elif not osextras.find_on_path("zsyncmake"):
+        make_zsync_metafile(
+            infile, outfile, url, blocksize=ZSYNC_BLOCK_SIZE)
+    else:
         subprocess.check_call(command)
 
 
+def _replace_stream(chunks, old, new, write):
+    """Copy chunks to write, replacing old with new; return the count.
+
+    Matches spanning chunk boundaries are handled by holding back the last
+    len(old) - 1 bytes of each chunk until the next one arrives.
+    """
+    replaced = 0
+    pending = b""
+    for chunk in chunks:
+        data = pending + chunk
+        pos = 0
+        index = data.find(old)
+        while index != -1:
+            write(data[pos:index])
+            write(new)
+            replaced += 1
+            pos = index + len(old)
+            index = data.find(old, pos)
+        keep = max(pos, len(data) - len(old) + 1)
+        write(data[pos:keep])
+        pending = data[keep:]
+    write(pending)
+    return replaced
+
+
+def _stream_contains(chunks, needle):
+    """Return True if needle occurs in the concatenation of chunks."""
+    pending = b""
+    for chunk in chunks:
+        data = pending + chunk
+        if needle in data:
+            return True
+        pending = data[max(0, len(data) - len(needle) + 1):]
+    return False
+
+
+def rewrite_jigdo(source, target, old, new, chunk_size=1024 * 1024):
+    """Copy a .jigdo file from source to target, replacing old with new.
+
+    gzip-compressed .jigdo files (as written by jigdo-file by default) are
+    decompressed and recompressed transparently.  If old does not occur,
+    nothing is rewritten: target is hard-linked to source where possible;
+    source and target may be the same file.  Return the number of bytes
+    written to target, which is zero if nothing needed to change.
+    """
+    old = old.encode("UTF-8")
+    new = new.encode("UTF-8")
+    new_target = "%s.new" % target
+    with open(source, "rb") as raw_in:
+        compressed = raw_in.read(2) == b"\x1f\x8b"
+        raw_in.seek(0)
+        if compressed:
+            jigdo_in = gzip.GzipFile(fileobj=raw_in, mode="rb")
+        else:
+            jigdo_in = raw_in
+
+        def chunks():
+            return iter(lambda: jigdo_in.read(chunk_size), b"")
+
+        if not _stream_contains(chunks(), old):
+            if os.path.exists(target) and os.path.samefile(source, target):
+                return 0
+            osextras.unlink_force(target)
+            try:
+                os.link(source, target)
+                return 0
+            except OSError:
+                pass
+        jigdo_in.seek(0)
+        try:
+            with open(new_target, "wb") as raw_out:
+                if compressed:
+                    jigdo_out = gzip.GzipFile(
+                        filename="", fileobj=raw_out, mode="wb", mtime=0)
+                else:
+                    jigdo_out = raw_out
+                try:
+                    _replace_stream(chunks(), old, new, jigdo_out.write)
+                finally:
+                    if compressed:
+                        jigdo_out.close()
+                written = raw_out.tell()
+            os.rename(new_target, target)
+        finally:
+            osextras.unlink_force(new_target)
+    return written
+
+
+def _isotracker_class():
+    """Return isotracker.ISOTracker, or None if it is not installed."""
+    try:
+        from isotracker import ISOTracker
+    except ImportError:
+        return None
+    return ISOTracker
+
+
+class TimeoutTransport(xmlrpc_client.Transport):
+    """An XML-RPC transport whose connections time out."""
+
+    def __init__(self, timeout, *args, **kwargs):
+        xmlrpc_client.Transport.__init__(self, *args, **kwargs)
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        connection = xmlrpc_client.Transport.make_connection(self, host)
+        connection.timeout = self.timeout
+        return connection
+
+
+class TimeoutSafeTransport(xmlrpc_client.SafeTransport):
+    """An XML-RPC over HTTPS transport whose connections time out."""
+
+    def __init__(self, timeout, *args, **kwargs):
+        xmlrpc_client.SafeTransport.__init__(self, *args, **kwargs)
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        connection = xmlrpc_client.SafeTransport.make_connection(self, host)
+        connection.timeout = self.timeout
+        return connection
+
+
+@contextlib.contextmanager
+def xmlrpc_timeout(timeout):
+    """Make XML-RPC proxies created within this context time out.
+
+    ISOTracker creates its own proxy and offers no way to pass it a
+    transport, so give a TimeoutTransport to any ServerProxy created
+    without one.  Unlike socket.setdefaulttimeout, this leaves other
+    connections alone.
+    """
+    server_proxy = xmlrpc_client.ServerProxy
+
+    def timeout_server_proxy(uri, transport=None, *args, **kwargs):
+        if transport is None:
+            if uri.startswith("https:"):
+                transport_class = TimeoutSafeTransport
+            else:
+                transport_class = TimeoutTransport
+            transport = transport_class(
+                timeout, use_datetime=kwargs.get("use_datetime", False))
+        return server_proxy(uri, transport, *args, **kwargs)
+
+    xmlrpc_client.ServerProxy = xmlrpc_client.Server = timeout_server_proxy
+    try:
+        yield
+    finally:
+        xmlrpc_client.ServerProxy = xmlrpc_client.Server = server_proxy
+
+
 class Tree:
     """A publication tree."""
 
@@ -288,7 +537,11 @@ class Tree:
                         logger.warning(
                             "%s is not trigger-controlled; update "
                             "production/current-triggers" % arch)
+                start = time.time()
                 publisher.mark_current(date, arches)
+                logger.info(
+                    "Marked %s current in %.1f seconds" %
+                    (date, time.time() - start))
                 if options.log:
                     trigger_mirrors(config)
                 if not quiet:
@@ -306,6 +559,156 @@ class Tree:
             old_stdout.close()
 
 
+class DirectorySnapshot:
+    """An immutable listing of a directory, indexed for repeated queries.
+
+    Generating web indices asks thousands of questions about a single
+    directory; this answers them all from one os.listdir and one stat per
+    entry.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.names = frozenset(osextras.listdir_force(directory))
+        self._existing = None
+        # Map every prefix of an entry ending in "-" or ".", and every
+        # suffix starting with ".", to the entries that have it.
+        prefixes = {}
+        suffixes = {}
+        for name in self.names:
+            for i, c in enumerate(name):
+                if c in "-.":
+                    prefixes.setdefault(name[:i + 1], set()).add(name)
+                if c == ".":
+                    suffixes.setdefault(name[i:], set()).add(name)
+        self.prefixes = dict(
+            (prefix, frozenset(names)) for prefix, names in prefixes.items())
+        self.suffixes = dict(
+            (suffix, frozenset(names)) for suffix, names in suffixes.items())
+
+    @classmethod
+    def of(cls, directory):
+        """Return directory itself if it is a snapshot, else a new one."""
+        if isinstance(directory, cls):
+            return directory
+        return cls(directory)
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __iter__(self):
+        return iter(self.names)
+
+    @property
+    def existing(self):
+        """Entries that os.path.exists, which excludes dangling symlinks.
+
+        These are only checked the first time they are needed.
+        """
+        if self._existing is None:
+            self._existing = frozenset(
+                name for name in self.names
+                if os.path.exists(os.path.join(self.directory, name)))
+        return self._existing
+
+    def path_exists(self, path):
+        """Equivalent to os.path.exists(path) at snapshot time.
+
+        Paths outside the snapshot directory are checked directly.
+        """
+        name = os.path.basename(path)
+        if os.path.join(self.directory, name) == path:
+            return name in self.existing
+        return os.path.exists(path)
+
+    def with_prefix(self, prefix):
+        """Return entries starting with prefix, which must end with "-" or
+        ".".
+        """
+        return self.prefixes.get(prefix, frozenset())
+
+    def with_suffix(self, suffix):
+        """Return entries ending with suffix, which must start with "."."""
+        return self.suffixes.get(suffix, frozenset())
+
+
+class ArtifactIndex:
+    """The artifacts in a directory, indexed by name prefix.
+
+    Publishing an image probes for dozens of possible artifacts alongside
+    it.  This answers those probes from a DirectorySnapshot of the
+    directory.  Artifacts that are listed are checked with os.path.exists
+    as before, so a file that has since gone away (or is a dangling
+    symlink) still counts as missing; a probe for one that is not listed
+    refreshes the snapshot first, so a file created since still counts as
+    present.  A refresh costs a single stat unless the directory has
+    changed since it was last listed (or was changed very recently).
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.stamp = None
+        self.snapshot = None
+
+    def _stamp(self):
+        try:
+            st = os.stat(self.directory)
+        except OSError as e:
+            if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                return None
+            raise
+        # File system timestamps are coarser than they look, so an entry
+        # added just after a listing may leave the modification time
+        # unchanged.  Don't trust a stamp until it is safely in the past.
+        if time.time() - st.st_mtime < 2:
+            return None
+        return st.st_ino, getattr(st, "st_mtime_ns", st.st_mtime)
+
+    def refresh(self):
+        """List the directory again if entries may have come or gone."""
+        stamp = self._stamp()
+        with self.lock:
+            if (self.snapshot is not None and stamp is not None and
+                    stamp == self.stamp):
+                return self
+            self.snapshot = DirectorySnapshot(self.directory)
+            # Entries added between the stat and the listing make the next
+            # refresh list the directory again, which is harmless.
+            self.stamp = stamp
+        return self
+
+    def _snapshot(self):
+        snapshot = self.snapshot
+        if snapshot is None:
+            snapshot = self.refresh().snapshot
+        return snapshot
+
+    def suffixes(self, prefix):
+        """Return the suffixes of listed names starting with prefix.
+
+        Each suffix starts with the "." or "-" that follows prefix.
+        """
+        snapshot = self._snapshot()
+        names = (
+            snapshot.with_prefix("%s." % prefix) |
+            snapshot.with_prefix("%s-" % prefix))
+        return frozenset(name[len(prefix):] for name in names)
+
+    def exists(self, path):
+        """Equivalent to os.path.exists(path).
+
+        Paths outside the indexed directory are checked directly.
+        """
+        directory, name = os.path.split(path)
+        if directory != self.directory:
+            return os.path.exists(path)
+        if (name not in self._snapshot() and
+                name not in self.refresh().snapshot):
+            return False
+        return os.path.exists(path)
+
+
 class WebIndicesException(Exception):
     pass
 
@@ -366,6 +769,14 @@ class Publisher:
         self.project = self.config.project
         self.image_type = image_type
         self.prefmsg_emitted = False
+        # Rendered descriptions; see _memoised.
+        self._fragments = {}
+        self.zsync_jobs = BackgroundJobs(job_count(self.config))
+        self.artifact_indexes = {}
+        self.artifact_indexes_lock = threading.Lock()
+        # Set while publishing; see cdimage.journal.
+        self.journal = None
+        self.zsync_inputs = {}
 
     # Keep this in sync with _guess_image_type below.
     @property
@@ -446,278 +857,359 @@ class Publisher:
             return ["https://assets.ubuntu.com/v1/" +
                     "vanilla-framework-version-1.8.0.min.css"]
 
-    def cdtypestr(self, publish_type, image_format):
-        if image_format in ("tar.gz", "tar.xz", "custom.tar.gz"):
-            cd = "filesystem archive"
-        elif self.config["DIST"] < "trusty":
-            if image_format in ("img", "img.gz"):
-                cd = "image"
-            elif self.project == "ubuntustudio":
-                cd = "DVD"
-            else:
-                cd = "CD"
-        else:
-            cd = "image"
-
-        if publish_type == "live":
-            return "live %s" % cd
-        elif publish_type == "live-core":
-            return "Ubuntu Core %s" % cd
-        elif publish_type == "desktop":
-            return "desktop %s" % cd
-        elif publish_type == "install":
-            return "install %s" % cd
-        elif publish_type == "alternate":
-            return "alternate install %s" % cd
-        elif publish_type == "server" or publish_type == "live-server":
-            if self.project == "edubuntu":
-                return "classroom server %s" % cd
-            else:
-                return "server install %s" % cd
-        elif publish_type == "serveraddon":
-            # Edubuntu only
-            return "classroom server add-on %s" % cd
-        elif publish_type == "addon":
-            # Edubuntu only
-            return "Ubuntu educational add-on %s" % cd
-        elif publish_type == "dvd":
-            return "install/live DVD"
-        elif publish_type == "src":
-            return "source %s" % cd
-        elif publish_type == "netbook":
-            return "netbook live %s" % cd
-        elif publish_type == "active":
-            return "preview active image"
-        elif publish_type in ("server-uec", "uec"):
-            return "UEC image"
-        elif publish_type == "preinstalled-desktop":
-            return "preinstalled desktop %s" % cd
-        elif publish_type == "preinstalled-server":
-            return "preinstalled server %s" % cd
-        elif publish_type == "preinstalled-netbook":
-            return "preinstalled netbook %s" % cd
-        elif publish_type == "preinstalled-active":
-            return "preview preinstalled active image"
-        elif publish_type == "preinstalled-touch":
-            return "preinstalled touch image"
-        elif publish_type == "preinstalled-core":
-            return "preinstalled core image"
-        elif publish_type == "wubi":
-            return "Wubi %s" % cd
-        else:
-            raise WebIndicesException("Unknown image type %s!" % publish_type)
+    archive_formats = ("tar.gz", "tar.xz", "custom.tar.gz")
 
-    def cdtypedesc(self, publish_type, image_format):
-        capproject = self.config.capproject
+    def _series_key(self):
         series = self.config["DIST"]
+        return series.index if isinstance(series, Series) else series
 
-        if self.project == "xubuntu":
-            desktop_ram = 192
-        else:
-            if series <= "xenial":
-                desktop_ram = 384
-            else:
-                desktop_ram = 1024
-
-        if image_format in ("tar.gz", "tar.xz", "custom.tar.gz"):
-            cd = "filesystem archive"
-        elif self.config["DIST"] <= "precise":
-            if image_format in ("img", "img.gz"):
-                cd = "image"
-            elif self.project == "ubuntustudio":
-                cd = "dvd"
-            else:
-                cd = "cd"
+    def _memoised(self, key, render, *args):
+        """Return render(*args), reusing an earlier result for the same key.
+
+        The key must include everything that the result depends on,
+        including any configuration that might change during the life of
+        this publisher.
+        """
+        try:
+            return self._fragments[key]
+        except KeyError:
+            value = self._fragments[key] = render(*args)
+            return value
+
+    def _medium(self, image_format, disc_media):
+        """Return the name of the medium for an image format.
+
+        disc_media is true for series old enough to talk about CDs.
+        """
+        if image_format in self.archive_formats:
+            return "filesystem archive"
+        elif disc_media and image_format not in ("img", "img.gz"):
+            return "DVD" if self.project == "ubuntustudio" else "CD"
         else:
-            cd = "image"
+            return "image"
+
+    cdtype_strings = {
+        "live": "live %(cd)s",
+        "live-core": "Ubuntu Core %(cd)s",
+        "desktop": "desktop %(cd)s",
+        "install": "install %(cd)s",
+        "alternate": "alternate install %(cd)s",
+        "server": "server install %(cd)s",
+        "live-server": "server install %(cd)s",
+        # Edubuntu only
+        "serveraddon": "classroom server add-on %(cd)s",
+        # Edubuntu only
+        "addon": "Ubuntu educational add-on %(cd)s",
+        "dvd": "install/live DVD",
+        "src": "source %(cd)s",
+        "netbook": "netbook live %(cd)s",
+        "active": "preview active image",
+        "server-uec": "UEC image",
+        "uec": "UEC image",
+        "preinstalled-desktop": "preinstalled desktop %(cd)s",
+        "preinstalled-server": "preinstalled server %(cd)s",
+        "preinstalled-netbook": "preinstalled netbook %(cd)s",
+        "preinstalled-active": "preview preinstalled active image",
+        "preinstalled-touch": "preinstalled touch image",
+        "preinstalled-core": "preinstalled core image",
+        "wubi": "Wubi %(cd)s",
+    }
 
-        desktop_req = (
-            "You will need at least %sMiB of RAM to install from this %s." %
-            (desktop_ram, cd))
+    project_cdtype_strings = {
+        ("edubuntu", "server"): "classroom server %(cd)s",
+        ("edubuntu", "live-server"): "classroom server %(cd)s",
+    }
 
-        sentences = []
-        if publish_type == "live":
-            sentences.append(
-                "The live %s allows you to try %s without changing your "
-                "computer at all, and at your option to install it "
-                "permanently later.</p>" % (cd, capproject))
-        elif publish_type == "desktop":
-            sentences.append(
-                "The desktop %s allows you to try %s without changing your "
-                "computer at all, and at your option to install it "
-                "permanently later." % (cd, capproject))
-            if self.project != "edubuntu" and not self.prefmsg_emitted:
-                sentences.append(
-                    "This type of %s is what most people will want to use." %
-                    cd)
-                self.prefmsg_emitted = True
-            sentences.append(desktop_req)
-            if self.project == "edubuntu":
-                sentences.append(
-                    "You can install additional educational programs using "
-                    "the classroom server add-on %s." % cd)
-        elif publish_type == "install":
-            sentences.append(
-                "The install %s allows you to install %s permanently on a "
-                "computer." % (cd, capproject))
-        elif publish_type == "alternate":
-            sentences.append(
-                "The alternate install %s allows you to perform certain "
-                "specialist installations of %s." % (cd, capproject))
-            sentences.append("It provides for the following situations:")
-            yield Paragraph(sentences)
-            yield UnorderedList([
+    def cdtypestr(self, publish_type, image_format):
+        return self._memoised(
+            ("cdtypestr", publish_type, image_format, self.project,
+             self._series_key()),
+            self._render_cdtypestr, publish_type, image_format)
+
+    def _render_cdtypestr(self, publish_type, image_format):
+        cd = self._medium(image_format, self.config["DIST"] < "trusty")
+        template = self.project_cdtype_strings.get(
+            (self.project, publish_type),
+            self.cdtype_strings.get(publish_type))
+        if template is None:
+            raise WebIndicesException("Unknown image type %s!" % publish_type)
+        return template % {"cd": cd}
+
+    # Only emitted for the first desktop image type in each index.
+    preferred_sentence = (
+        "This type of %(cd)s is what most people will want to use.")
+
+    desktop_sentence = (
+        "The desktop %(cd)s allows you to try %(capproject)s without "
+        "changing your computer at all, and at your option to install it "
+        "permanently later.")
+
+    desktop_req_sentence = (
+        "You will need at least %(desktop_ram)sMiB of RAM to install from "
+        "this %(cd)s.")
+
+    description_links = {
+        "bug_link": str(Link(
+            "https://bugs.launchpad.net/ubuntu/+source/debian-installer/"
+            "+filebug",
+            "debian-installer")),
+        "uec_link": str(Link(
+            "http://www.ubuntu.com/products/whatisubuntu/serveredition/"
+            "cloud/uec",
+            "Ubuntu Enterprise Cloud", show_class=True)),
+        "gs_link": str(Link(
+            "https://help.ubuntu.com/community/Eucalyptus",
+            "Getting Started with Ubuntu Enterprise Cloud",
+            show_class=True)),
+        "core_link": str(Link(
+            "https://wiki.ubuntu.com/Core", "Ubuntu Core wiki page",
+            show_class=True)),
+    }
+
+    source_url = "https://launchpad.net/ubuntu/+source/SOURCE-PACKAGE-NAME"
+
+    # Each description is a sequence of (element class, templates) blocks.
+    # The "preinstalled" entry covers any preinstalled-* type without an
+    # entry of its own.
+    cdtype_descriptions = {
+        "live": [
+            (Paragraph, [
+                "The live %(cd)s allows you to try %(capproject)s without "
+                "changing your computer at all, and at your option to "
+                "install it permanently later.</p>",
+            ]),
+        ],
+        "desktop": [
+            (Paragraph, [
+                desktop_sentence, preferred_sentence, desktop_req_sentence,
+            ]),
+        ],
+        "install": [
+            (Paragraph, [
+                "The install %(cd)s allows you to install %(capproject)s "
+                "permanently on a computer.",
+            ]),
+        ],
+        "alternate": [
+            (Paragraph, [
+                "The alternate install %(cd)s allows you to perform certain "
+                "specialist installations of %(capproject)s.",
+                "It provides for the following situations:",
+            ]),
+            (UnorderedList, [
                 "setting up automated deployments;",
                 "upgrading from older installations without network access;",
                 "LVM and/or RAID partitioning;",
-                ("installs on systems with less than about %sMiB of RAM "
-                    "(although note that low-memory systems may not be able "
-                    "to run a full desktop environment reasonably)." %
-                    desktop_ram),
-            ])
-            bug_link = Link(
-                "https://bugs.launchpad.net/ubuntu/+source/debian-installer/"
-                "+filebug",
-                "debian-installer")
-            yield Paragraph([
+                "installs on systems with less than about %(desktop_ram)sMiB "
+                "of RAM (although note that low-memory systems may not be "
+                "able to run a full desktop environment reasonably).",
+            ]),
+            (Paragraph, [
                 "In the event that you encounter a bug using the alternate "
-                "installer, please file a bug on the %s package." % bug_link,
-            ])
-            return
-        elif publish_type == "server" or publish_type == "live-server":
-            if self.project == "edubuntu":
-                sentences.append(
-                    "The classroom server %s allows you to install %s "
-                    "permanently on a computer." % (cd, capproject))
-                sentences.append(
-                    "It includes LTSP (Linux Terminal Server Project) "
-                    "support, providing out-of-the-box thin client support.")
-                sentences.append(
-                    "After installation you can install additional "
-                    "educational programs using the classroom server add-on "
-                    "%s." % cd)
-            else:
-                sentences.append(
-                    "The server install %s allows you to install %s "
-                    "permanently on a computer for use as a server." %
-                    (cd, capproject))
-                sentences.append(
-                    "It will not install a graphical user interface.")
-        elif publish_type == "netbook":
-            if capproject.endswith("-Netbook"):
-                capproject = capproject[:-len("-Netbook")]
-            sentences.append(
-                "The live %s allows you to try %s Netbook Edition without "
-                "changing your computer at all, and at your option to install "
-                "it permanently later." % (cd, capproject))
-            sentences.append(
-                "This live %s is optimized for netbooks with screens up to "
-                "10\"." % cd)
-            sentences.append(desktop_req)
-        elif publish_type == "active":
-            # Kubuntu only
-            sentences.append(
+                "installer, please file a bug on the %(bug_link)s package.",
+            ]),
+        ],
+        "server": [
+            (Paragraph, [
+                "The server install %(cd)s allows you to install "
+                "%(capproject)s permanently on a computer for use as a "
+                "server.",
+                "It will not install a graphical user interface.",
+            ]),
+        ],
+        "netbook": [
+            (Paragraph, [
+                "The live %(cd)s allows you to try %(netbook_capproject)s "
+                "Netbook Edition without changing your computer at all, and "
+                "at your option to install it permanently later.",
+                "This live %(cd)s is optimized for netbooks with screens up "
+                "to 10\".",
+                desktop_req_sentence,
+            ]),
+        ],
+        # Kubuntu only
+        "active": [
+            (Paragraph, [
                 "The Active Image offers a preview of the Plasma Active "
-                "workspace to try or install.")
-        elif publish_type == "serveraddon":
-            # Edubuntu only
-            sentences.append(
-                "The classroom server add-on %s contains additional useful "
-                "packages, including many educational programs and all "
-                "available language packs." % cd)
-            sentences.append(
-                "It requires that an %s desktop be installed on the machine." %
-                capproject)
-        elif publish_type == "addon":
-            # Edubuntu only
-            sentences.append(
-                "The Ubuntu educational add-on %s contains additional useful "
-                "packages, including many educational programs." % cd)
-            sentences.append(
+                "workspace to try or install.",
+            ]),
+        ],
+        # Edubuntu only
+        "serveraddon": [
+            (Paragraph, [
+                "The classroom server add-on %(cd)s contains additional "
+                "useful packages, including many educational programs and "
+                "all available language packs.",
+                "It requires that an %(capproject)s desktop be installed on "
+                "the machine.",
+            ]),
+        ],
+        # Edubuntu only
+        "addon": [
+            (Paragraph, [
+                "The Ubuntu educational add-on %(cd)s contains additional "
+                "useful packages, including many educational programs.",
                 "It requires that an Ubuntu desktop system already be "
-                "installed.")
-        elif publish_type == "dvd":
-            if self.project == "edubuntu":
-                sentences.append(
-                    "The install DVD allows you to install %s permanently on "
-                    "a computer." % capproject)
-            else:
-                sentences.append(
-                    "The combined install/live DVD allows you either to "
-                    "install %s permanently on a computer, or (by entering "
-                    "'live' at the boot prompt) to try %s without changing "
-                    "your computer at all." % (capproject, capproject))
-        elif publish_type == "src":
-            yield Paragraph([
-                "The source %ss contain the source code used to build %s." %
-                (cd, capproject),
-            ])
-            sentences.append(
+                "installed.",
+            ]),
+        ],
+        "dvd": [
+            (Paragraph, [
+                "The combined install/live DVD allows you either to install "
+                "%(capproject)s permanently on a computer, or (by entering "
+                "'live' at the boot prompt) to try %(capproject)s without "
+                "changing your computer at all.",
+            ]),
+        ],
+        "src": [
+            (Paragraph, [
+                "The source %(cd)ss contain the source code used to build "
+                "%(capproject)s.",
+            ]),
+            (Paragraph, [
                 "Some source package versions on this image may not match "
-                "related binary images, depending on exactly when the images "
-                "were built.")
-            sentences.append(
-                "You can always find every version of Ubuntu source packages "
-                "on Launchpad, using URLs of the following form:")
-            yield Paragraph(sentences)
-            prefix = "https://launchpad.net/ubuntu/+source/SOURCE-PACKAGE-NAME"
-            yield UnorderedList([
-                "<code>%s/+publishinghistory</code> (index)" % prefix,
-                "<code>%s/VERSION</code> (specific version)" % prefix,
-            ])
-            return
-        elif publish_type in ("server-uec", "uec"):
-            uec_link = Link(
-                "http://www.ubuntu.com/products/whatisubuntu/serveredition/"
-                "cloud/uec",
-                "Ubuntu Enterprise Cloud", show_class=True)
-            sentences.append(
+                "related binary images, depending on exactly when the "
+                "images were built.",
+                "You can always find every version of Ubuntu source "
+                "packages on Launchpad, using URLs of the following form:",
+            ]),
+            (UnorderedList, [
+                "<code>%s/+publishinghistory</code> (index)" % source_url,
+                "<code>%s/VERSION</code> (specific version)" % source_url,
+            ]),
+        ],
+        "uec": [
+            (Paragraph, [
                 "The Ubuntu Enterprise Cloud image can be run on your "
-                "personal %s, or modified, rebundled and uploaded to Amazon "
-                "EC2." % uec_link)
-            gs_link = Link(
-                "https://help.ubuntu.com/community/Eucalyptus",
-                "Getting Started with Ubuntu Enterprise Cloud",
-                show_class=True)
-            sentences.append(
+                "personal %(uec_link)s, or modified, rebundled and uploaded "
+                "to Amazon EC2.",
                 "For further instruction on setting up a personal Ubuntu "
-                "Enterprise Cloud, see %s." % gs_link)
-        elif publish_type == "preinstalled-active":
-            sentences.append(
-                "The Active Image allows you to unpack a preinstalled preview "
-                "of the Plasma Active workspace onto an SD card.")
-        elif publish_type == "preinstalled-touch":
-            sentences.append(
+                "Enterprise Cloud, see %(gs_link)s.",
+            ]),
+        ],
+        "preinstalled-active": [
+            (Paragraph, [
+                "The Active Image allows you to unpack a preinstalled "
+                "preview of the Plasma Active workspace onto an SD card.",
+            ]),
+        ],
+        "preinstalled-touch": [
+            (Paragraph, [
                 "The Preinstalled Touch Image allows you to install a "
-                "preinstalled preview of Ubuntu Touch onto a target device.")
-        elif publish_type.startswith("preinstalled-"):
-            sentences.append(
-                "The %s %s allows you to unpack a preinstalled version of %s "
-                "onto a target device." % (publish_type, cd, capproject))
-        elif publish_type in ("ubuntu-core", "preinstalled-core"):
-            sentences.append(
+                "preinstalled preview of Ubuntu Touch onto a target device.",
+            ]),
+        ],
+        "preinstalled": [
+            (Paragraph, [
+                "The %(publish_type)s %(cd)s allows you to unpack a "
+                "preinstalled version of %(capproject)s onto a target "
+                "device.",
+            ]),
+        ],
+        "ubuntu-core": [
+            (Paragraph, [
                 "Ubuntu Core is a minimal rootfs for use in the creation of "
-                "custom images for specific needs.")
-            sentences.append(
-                "Ubuntu Core strives to create a suitable minimal environment "
-                "for use in Board Support Packages, constrained or integrated "
-                "environments, or as the basis for application demonstration "
-                "images.")
-            link = Link(
-                "https://wiki.ubuntu.com/Core", "Ubuntu Core wiki page",
-                show_class=True)
-            sentences.append("See the %s for more information." % link)
-        elif publish_type == "wubi":
-            sentences.append(
+                "custom images for specific needs.",
+                "Ubuntu Core strives to create a suitable minimal "
+                "environment for use in Board Support Packages, constrained "
+                "or integrated environments, or as the basis for application "
+                "demonstration images.",
+                "See the %(core_link)s for more information.",
+            ]),
+        ],
+        "wubi": [
+            (Paragraph, [
                 "This is a filesystem image downloaded by Wubi (a system "
                 "which installs Ubuntu into disk image files on a Windows "
                 "filesystem).  You should not normally need to download it "
-                "separately.")
+                "separately.",
+            ]),
+        ],
+    }
+    cdtype_descriptions["live-server"] = cdtype_descriptions["server"]
+    cdtype_descriptions["server-uec"] = cdtype_descriptions["uec"]
+
+    project_cdtype_descriptions = {
+        ("edubuntu", "desktop"): [
+            (Paragraph, [
+                desktop_sentence, desktop_req_sentence,
+                "You can install additional educational programs using the "
+                "classroom server add-on %(cd)s.",
+            ]),
+        ],
+        ("edubuntu", "server"): [
+            (Paragraph, [
+                "The classroom server %(cd)s allows you to install "
+                "%(capproject)s permanently on a computer.",
+                "It includes LTSP (Linux Terminal Server Project) support, "
+                "providing out-of-the-box thin client support.",
+                "After installation you can install additional educational "
+                "programs using the classroom server add-on %(cd)s.",
+            ]),
+        ],
+        ("edubuntu", "dvd"): [
+            (Paragraph, [
+                "The install DVD allows you to install %(capproject)s "
+                "permanently on a computer.",
+            ]),
+        ],
+    }
+    project_cdtype_descriptions[("edubuntu", "live-server")] = (
+        project_cdtype_descriptions[("edubuntu", "server")])
+
+    def cdtypedesc(self, publish_type, image_format):
+        """Return a sequence of HTML fragments describing an image type."""
+        fragments, preferred = self._memoised(
+            ("cdtypedesc", publish_type, image_format, self.project,
+             self._series_key(), self.config.capproject,
+             self.prefmsg_emitted),
+            self._render_cdtypedesc, publish_type, image_format)
+        if preferred:
+            self.prefmsg_emitted = True
+        return fragments
+
+    def _render_cdtypedesc(self, publish_type, image_format):
+        capproject = self.config.capproject
+        series = self.config["DIST"]
+
+        if self.project == "xubuntu":
+            desktop_ram = 192
+        elif series <= "xenial":
+            desktop_ram = 384
         else:
+            desktop_ram = 1024
+
+        cd = self._medium(
+            image_format, self.config["DIST"] <= "precise").lower()
+
+        blocks = self.project_cdtype_descriptions.get(
+            (self.project, publish_type),
+            self.cdtype_descriptions.get(publish_type))
+        if blocks is None and publish_type.startswith("preinstalled-"):
+            blocks = self.cdtype_descriptions["preinstalled"]
+        if blocks is None:
             raise WebIndicesException("Unknown image type %s!" % publish_type)
 
-        if sentences:
-            yield Paragraph(sentences)
+        netbook_capproject = capproject
+        if netbook_capproject.endswith("-Netbook"):
+            netbook_capproject = netbook_capproject[:-len("-Netbook")]
+        values = dict(
+            self.description_links, cd=cd, capproject=capproject,
+            netbook_capproject=netbook_capproject, desktop_ram=desktop_ram,
+            publish_type=publish_type)
+
+        fragments = []
+        preferred = False
+        for cls, templates in blocks:
+            items = []
+            for template in templates:
+                if template == self.preferred_sentence:
+                    if self.prefmsg_emitted:
+                        continue
+                    preferred = True
+                items.append(template % values)
+            fragments.append(str(cls(items)))
+        return tuple(fragments), preferred
 
     uec_arch_strings = {
         "amd64": "64-bit",
@@ -754,107 +1246,109 @@ class Publisher:
         "sparc": "SPARC",
     }
 
+    amd64_sentence = (
+        "Choose this if you have a computer based on the AMD64 or EM64T "
+        "architecture (e.g., Athlon64, Opteron, EM64T Xeon, Core 2).")
+
+    arch_descriptions = {
+        "amd64": [amd64_sentence, "Choose this if you are at all unsure."],
+        "amd64+mac": [
+            amd64_sentence,
+            "This image is adjusted to work properly on Mac systems.",
+        ],
+        "arm64": ["For 64-bit ARMv8 processors and above."],
+        "armhf+raspi2": ["For Raspberry Pi 2 boards."],
+        "arm64+raspi3": ["For Raspberry Pi 3 boards."],
+        "armhf+raspi3": ["For Raspberry Pi 3 boards."],
+        "armel": ["For ARMv7 processors and above."],
+        "armel+dove": ["For Dove boards."],
+        "armel+imx51": ["For i.MX51 boards."],
+        "armel+mx5": [
+            "For Freescale i.MX5x boards.",
+            "See %s for detailed installation information." %
+            Link("https://wiki.ubuntu.com/ARM/MX5", "ARM/MX5"),
+        ],
+        "armel+omap": [
+            "For OMAP3 boards.",
+            "See %s for detailed installation information." %
+            Link("https://wiki.ubuntu.com/ARM/OMAP", "ARM/OMAP"),
+        ],
+        "armel+omap4": [
+            "For OMAP4 boards.",
+            "See %s for detailed installation information." %
+            Link("https://wiki.ubuntu.com/ARM/OMAP", "ARM/OMAP"),
+        ],
+        "armel+ac100": [
+            "For Toshiba AC100 / Dynabook AZ netbooks.",
+            "See %s for detailed installation information (please make "
+            "sure to download the .bootimg file alongside with the "
+            "filesystem archive)." %
+            Link("https://wiki.ubuntu.com/ARM/TEGRA/AC100",
+                 "ARM/TEGRA/AC100"),
+        ],
+        "armhf+nexus7": [
+            "For the Asus/Google Nexus7 tablet.",
+            "See %s for detailed installation information." %
+            Link("https://wiki.ubuntu.com/Nexus7", "the Nexus7 wiki pages"),
+        ],
+        "armhf": ["For ARMv7 processors and above (Hard-Float)."],
+        "hppa": ["For HP PA-RISC computers."],
+        "i386": [
+            "For almost all PCs.",
+            "This includes most machines with Intel/AMD/etc type processors "
+            "and almost all computers that run Microsoft Windows, as well "
+            "as newer Apple Macintosh systems based on Intel processors.",
+        ],
+        "ia64": ["For Intel Itanium and Itanium 2 computers."],
+        "powerpc": [
+            "For Apple Macintosh G3, G4, and G5 computers, including iBooks "
+            "and PowerBooks as well as older IBM OpenPower 7xx machines.",
+        ],
+        "powerpc+ps3": ["For Sony PlayStation 3 systems."],
+        "ppc64el": [
+            "For POWER8 Little-Endian computers, such as Power Systems "
+            "S8xxL/LC Linux-only servers.",
+        ],
+        "s390x": [
+            "For IBM System z series mainframes, such as IBM LinuxONE.",
+        ],
+        "sparc": [
+            "For Sun UltraSPARC computers, including those based on the "
+            "multicore UltraSPARC T1 (\"Niagara\") processors.",
+        ],
+    }
+    for _arch in ("mx5", "omap", "omap4", "ac100"):
+        arch_descriptions["armhf+%s" % _arch] = (
+            arch_descriptions["armel+%s" % _arch])
+    del _arch
+
     def archdesc(self, arch, publish_type):
-        sentences = []
-        if arch in ("amd64", "amd64+mac"):
-            sentences.append(
-                "Choose this if you have a computer based on the AMD64 or "
-                "EM64T architecture (e.g., Athlon64, Opteron, EM64T "
-                "Xeon, Core 2).")
-            if 'i386' in self.config.arches:
-                sentences.append(
-                    "If you have a non-64-bit processor made by AMD, or if "
-                    "you need full support for 32-bit code, use the i386 "
-                    "images instead.")
-            if arch == "amd64+mac":
-                sentences.append(
-                    "This image is adjusted to work properly on Mac systems.")
-            else:
-                sentences.append("Choose this if you are at all unsure.")
-        elif arch == "arm64":
-            sentences.append("For 64-bit ARMv8 processors and above.")
-        elif arch == "armhf+raspi2":
-            sentences.append("For Raspberry Pi 2 boards.")
-        elif arch in ("arm64+raspi3", "armhf+raspi3"):
-            sentences.append("For Raspberry Pi 3 boards.")
-        elif arch == "armel":
-            sentences.append("For ARMv7 processors and above.")
-        elif arch == "armel+dove":
-            sentences.append("For Dove boards.")
-        elif arch == "armel+imx51":
-            sentences.append("For i.MX51 boards.")
-        elif arch in ("armel+mx5", "armhf+mx5"):
-            sentences.append("For Freescale i.MX5x boards.")
-            link = Link("https://wiki.ubuntu.com/ARM/MX5", "ARM/MX5")
-            sentences.append(
-                "See %s for detailed installation information." % link)
-        elif arch in ("armel+omap", "armhf+omap"):
-            sentences.append("For OMAP3 boards.")
-            link = Link("https://wiki.ubuntu.com/ARM/OMAP", "ARM/OMAP")
-            sentences.append(
-                "See %s for detailed installation information." % link)
-        elif arch in ("armel+omap4", "armhf+omap4"):
-            sentences.append("For OMAP4 boards.")
-            link = Link("https://wiki.ubuntu.com/ARM/OMAP", "ARM/OMAP")
-            sentences.append(
-                "See %s for detailed installation information." % link)
-        elif arch in ("armel+ac100", "armhf+ac100"):
-            sentences.append("For Toshiba AC100 / Dynabook AZ netbooks.")
-            link = Link(
-                "https://wiki.ubuntu.com/ARM/TEGRA/AC100", "ARM/TEGRA/AC100")
-            sentences.append(
-                "See %s for detailed installation information (please make "
-                "sure to download the .bootimg file alongside with the "
-                "filesystem archive)." % link)
-        elif arch == "armhf+nexus7":
-            sentences.append("For the Asus/Google Nexus7 tablet.")
-            link = Link(
-                "https://wiki.ubuntu.com/Nexus7", "the Nexus7 wiki pages")
-            sentences.append(
-                "See %s for detailed installation information." % link)
-        elif arch == "armhf":
-            sentences.append("For ARMv7 processors and above (Hard-Float).")
-        elif arch == "hppa":
-            sentences.append("For HP PA-RISC computers.")
-        elif arch == "i386":
-            sentences.append("For almost all PCs.")
-            sentences.append(
-                "This includes most machines with Intel/AMD/etc type "
-                "processors and almost all computers that run Microsoft "
-                "Windows, as well as newer Apple Macintosh systems based on "
-                "Intel processors.")
-        elif arch == "ia64":
-            sentences.append("For Intel Itanium and Itanium 2 computers.")
-        elif arch == "powerpc":
-            sentences.append(
-                "For Apple Macintosh G3, G4, and G5 computers, including "
-                "iBooks and PowerBooks as well as older IBM OpenPower 7xx "
-                "machines.")
-        elif arch == "powerpc+ps3":
-            sentences.append("For Sony PlayStation 3 systems.")
-            if publish_type == "desktop":
-                capproject = self.config.capproject
-                sentences.append(
-                    "(This defaults to installing %s permanently, since there "
-                    "is usually not enough memory to try out the full desktop "
-                    "system and run the installer at the same time." %
-                    capproject)
-                sentences.append(
-                    "An alternative boot option to try %s without changing "
-                    "your computer is available.)" % capproject)
-        elif arch == "ppc64el":
-            sentences.append(
-                "For POWER8 Little-Endian computers, such as Power Systems "
-                "S8xxL/LC Linux-only servers.")
-        elif arch == "s390x":
+        has_i386 = "i386" in self.config.arches
+        return self._memoised(
+            ("archdesc", arch, publish_type, has_i386,
+             self.config.capproject),
+            self._render_archdesc, arch, publish_type, has_i386)
+
+    def _render_archdesc(self, arch, publish_type, has_i386):
+        try:
+            sentences = list(self.arch_descriptions[arch])
+        except KeyError:
+            raise WebIndicesException("Unknown architecture %s!" % arch)
+        if arch in ("amd64", "amd64+mac") and has_i386:
+            sentences.insert(
+                1,
+                "If you have a non-64-bit processor made by AMD, or if you "
+                "need full support for 32-bit code, use the i386 images "
+                "instead.")
+        elif arch == "powerpc+ps3" and publish_type == "desktop":
+            capproject = self.config.capproject
             sentences.append(
-                "For IBM System z series mainframes, such as IBM LinuxONE.")
-        elif arch == "sparc":
+                "(This defaults to installing %s permanently, since there is "
+                "usually not enough memory to try out the full desktop "
+                "system and run the installer at the same time." % capproject)
             sentences.append(
-                "For Sun UltraSPARC computers, including those based on the "
-                "multicore UltraSPARC T1 (\"Niagara\") processors.")
-        else:
-            raise WebIndicesException("Unknown architecture %s!" % arch)
+                "An alternative boot option to try %s without changing your "
+                "computer is available.)" % capproject)
         return "  ".join(sentences)
 
     def maybe_oversized(self, status, path, publish_type):
@@ -905,61 +1399,70 @@ class Publisher:
                 "a virtual machine.")
         yield Span("urgent", sentences)
 
+    # Some MIME types aren't configured by default.
+    mimetype_strings = {
+        "img": "application/octet-stream",
+    }
+
     def mimetypestr(self, extension):
-        # Some MIME types aren't configured by default.
-        if extension == "img":
-            return "application/octet-stream"
-        else:
-            return None
+        return self.mimetype_strings.get(extension)
+
+    extension_strings = {
+        "img": "USB image",
+        "img.gz": "preinstalled SD Card image",
+        "img.xz": "preinstalled SD Card image",
+        "iso": "standard download",
+        "jigdo": "%s download" % Link("http://atterer.org/jigdo", "jigdo"),
+        "list": "file listing",
+        "manifest": "contents of live filesystem",
+        "manifest-desktop": "contents of desktop part of live filesystem",
+        "manifest-remove":
+            "packages to remove from live filesystem on installation",
+        "manifest-minimal-remove":
+            "packages to remove from live filesystem on " +
+            " installation when performing a minimal install",
+        "template": "%s template" % Link("http://atterer.org/jigdo", "jigdo"),
+        "vmlinuz-ec2": "EC2 kernel image",
+        "vmlinuz-virtual": "UEC kernel image",
+        "initrd-ec2": "EC2 initramfs image",
+        "initrd-virtual": "UEC initramfs image",
+        "img.tar.gz": "UEC/EC2 filesystem image",
+        "tar.gz": "filesystem archive",
+        "custom.tar.gz": "filesystem archive",
+        "bootimg": "combined Android bootimage",
+        "tar.xz": "Wubi filesystem archive",
+    }
+
+    # Descriptions of any extension ending with the given suffix.
+    extension_suffix_strings = (
+        (".torrent", "%s download" % Link(
+            "https://help.ubuntu.com/community/BitTorrent", "BitTorrent")),
+        (".zsync", "%s metafile" % Link(
+            "http://zsync.moria.org.uk/", "zsync")),
+    )
+
+    project_extension_strings = {
+        ("server-uec", "tar.gz"): "Cloud Images tarball",
+        ("server-uec", "custom.tar.gz"): "Cloud Images tarball",
+        ("uec", "tar.gz"): "Cloud Images tarball",
+        ("uec", "custom.tar.gz"): "Cloud Images tarball",
+    }
 
     def extensionstr(self, extension):
-        if extension == "img":
-            return "USB image"
-        elif extension in ("img.gz", "img.xz"):
-            return "preinstalled SD Card image"
-        elif extension == "iso":
-            return "standard download"
-        elif extension.endswith(".torrent"):
-            return "%s download" % Link(
-                "https://help.ubuntu.com/community/BitTorrent", "BitTorrent")
-        elif extension == "jigdo":
-            return "%s download" % Link("http://atterer.org/jigdo", "jigdo")
-        elif extension == "list":
-            return "file listing"
-        elif extension == "manifest":
-            return "contents of live filesystem"
-        elif extension == "manifest-desktop":
-            return "contents of desktop part of live filesystem"
-        elif extension == "manifest-remove":
-            return "packages to remove from live filesystem on installation"
-        elif extension == "manifest-minimal-remove":
-            return "packages to remove from live filesystem on " + \
-                   " installation when performing a minimal install"
-        elif extension == "template":
-            return "%s template" % Link("http://atterer.org/jigdo", "jigdo")
-        elif extension.endswith(".zsync"):
-            return "%s metafile" % Link("http://zsync.moria.org.uk/", "zsync")
-        elif extension == "vmlinuz-ec2":
-            return "EC2 kernel image"
-        elif extension == "vmlinuz-virtual":
-            return "UEC kernel image"
-        elif extension == "initrd-ec2":
-            return "EC2 initramfs image"
-        elif extension == "initrd-virtual":
-            return "UEC initramfs image"
-        elif extension == "img.tar.gz":
-            return "UEC/EC2 filesystem image"
-        elif extension in ("tar.gz", "custom.tar.gz"):
-            if self.project in ("server-uec", "uec"):
-                return "Cloud Images tarball"
-            else:
-                return "filesystem archive"
-        elif extension == "bootimg":
-            return "combined Android bootimage"
-        elif extension == "tar.xz":
-            return "Wubi filesystem archive"
-        else:
-            raise WebIndicesException("Unknown extension %s!" % extension)
+        return self._memoised(
+            ("extensionstr", extension, self.project),
+            self._render_extensionstr, extension)
+
+    def _render_extensionstr(self, extension):
+        description = self.project_extension_strings.get(
+            (self.project, extension),
+            self.extension_strings.get(extension))
+        if description is not None:
+            return description
+        for suffix, description in self.extension_suffix_strings:
+            if extension.endswith(suffix):
+                return description
+        raise WebIndicesException("Unknown extension %s!" % extension)
 
     def web_heading(self, prefix):
         full_project_bits = [self.project]
@@ -1021,36 +1524,46 @@ class Publisher:
         ])
 
     def find_images(self, directory, prefix, publish_type):
+        snapshot = DirectorySnapshot.of(directory)
         images = []
         prefix_type = "%s-%s" % (prefix, publish_type)
-        for entry in os.listdir(directory):
-            if entry in ("%s.img" % prefix_type, "%s.img.xz" % prefix_type):
+        for entry in ("%s.img" % prefix_type, "%s.img.xz" % prefix_type):
+            if entry in snapshot:
                 images.append(entry)
-            elif publish_type == "wubi" and entry.endswith(".tar.xz"):
-                # Wubi images are just "ARCH.tar.xz", with no prefix.
+        if publish_type == "wubi":
+            # Wubi images are just "ARCH.tar.xz", with no prefix.
+            images.extend(
+                entry for entry in snapshot.with_suffix(".tar.xz")
+                if entry not in images)
+        for entry in snapshot.with_prefix("%s-" % prefix_type):
+            if entry in images:
+                continue
+            if (entry.endswith(".list") or
+                    entry.endswith(".img.gz") or
+                    entry.endswith(".tar.gz") or
+                    entry.endswith(".img.xz")):
                 images.append(entry)
-            elif entry.startswith("%s-" % prefix_type):
-                if (entry.endswith(".list") or
-                        entry.endswith(".img.gz") or
-                        entry.endswith(".tar.gz") or
-                        entry.endswith(".img.xz")):
-                    images.append(entry)
         return images
 
     def find_source_images(self, directory, prefix):
+        snapshot = DirectorySnapshot.of(directory)
         numbers = []
-        for entry in osextras.listdir_force(directory):
-            match = re.match(r"^%s-src-([0-9]+)\.iso$" % prefix, entry)
+        source_re = re.compile(r"^%s-src-([0-9]+)\.iso$" % prefix)
+        for entry in snapshot:
+            match = source_re.match(entry)
             if match is not None:
                 numbers.append(int(match.group(1)))
         return sorted(numbers)
 
     def find_any_with_extension(self, directory, extension):
-        return bool([
-            entry for entry in os.listdir(directory)
-            if entry.endswith(".%s" % extension)])
+        snapshot = DirectorySnapshot.of(directory)
+        return bool(snapshot.with_suffix(".%s" % extension))
 
     def make_web_indices(self, directory, base_prefix, status="release"):
+        """Write HTML indices for directory.
+
+        Return True if any of the index files changed.
+        """
         series = self.config["DIST"]
 
         prefixes = [base_prefix]
@@ -1093,13 +1606,18 @@ class Publisher:
 
         self.prefmsg_emitted = False
 
+        snapshot = DirectorySnapshot(directory)
+
         header_path = os.path.join(directory, "HEADER.html")
         footer_path = os.path.join(directory, "FOOTER.html")
         htaccess_path = os.path.join(directory, ".htaccess")
 
-        with AtomicFile(header_path) as header, \
-                AtomicFile(footer_path) as footer, \
-                AtomicFile(htaccess_path) as htaccess:
+        # Rewriting unchanged files would make mirrors transfer them again.
+        outputs = [
+            AtomicFile(path, only_if_changed=True)
+            for path in (header_path, footer_path, htaccess_path)]
+        with outputs[0] as header, outputs[1] as footer, \
+                outputs[2] as htaccess:
             heading = self.web_heading(base_prefix)
             print(
                 dedent("""\
@@ -1252,7 +1770,7 @@ class Publisher:
             cdtypecount = 0
             for prefix in prefixes:
                 for publish_type in all_publish_types:
-                    if self.find_images(directory, prefix, publish_type):
+                    if self.find_images(snapshot, prefix, publish_type):
                         cdtypecount += 1
 
             if cdtypecount > 1:
@@ -1269,12 +1787,12 @@ class Publisher:
 
             for prefix in prefixes:
                 for publish_type in all_publish_types:
-                    if not self.find_images(directory, prefix, publish_type):
+                    if not self.find_images(snapshot, prefix, publish_type):
                         continue
 
                     if publish_type == "src":
                         # Perverse, but works.
-                        arches = self.find_source_images(directory, prefix)
+                        arches = self.find_source_images(snapshot, prefix)
                     else:
                         arches = all_arches
                     for image_format in (
@@ -1287,7 +1805,7 @@ class Publisher:
                                 directory,
                                 "%s-%s" % (prefix, publish_type))
                             path = "%s.%s" % (base, image_format)
-                            if os.path.exists(path):
+                            if snapshot.path_exists(path):
                                 paths.append((path, None, base))
                         elif (image_format == "tar.xz" and
                               # skip source images explicitly, which are
@@ -1296,14 +1814,14 @@ class Publisher:
                             for arch in arches:
                                 base = os.path.join(directory, arch)
                                 path = "%s.%s" % (base, image_format)
-                                if os.path.exists(path):
+                                if snapshot.path_exists(path):
                                     paths.append((path, arch, base))
                         for arch in arches:
                             base = os.path.join(
                                 directory,
                                 "%s-%s-%s" % (prefix, publish_type, arch))
                             path = "%s.%s" % (base, image_format)
-                            if os.path.exists(path):
+                            if snapshot.path_exists(path):
                                 paths.append((path, arch, base))
                         if not paths:
                             continue
@@ -1347,12 +1865,12 @@ class Publisher:
                                     self.titlecase(cdtypestr), archstr)
                                 archdesc = self.archdesc(arch, publish_type)
 
-                            if os.path.exists(path):
+                            if snapshot.path_exists(path):
                                 print(
                                     "<a href=\"%s\">%s</a>" %
                                     (os.path.basename(path), imagestr),
                                     file=header)
-                            elif os.path.exists("%s.torrent" % path):
+                            elif snapshot.path_exists("%s.torrent" % path):
                                 print(
                                     "<a href=\"%s.torrent\">%s</a> "
                                     "(%s only)" % (
@@ -1362,7 +1880,7 @@ class Publisher:
                             else:
                                 continue
 
-                            if os.path.exists("%s.torrent" % path):
+                            if snapshot.path_exists("%s.torrent" % path):
                                 foundtorrent = True
 
                             if publish_type != "src":
@@ -1391,7 +1909,7 @@ class Publisher:
                                 )
                             for extension in htaccess_extensions:
                                 extpath = "%s.%s" % (base, extension)
-                                if not os.path.exists(extpath):
+                                if not snapshot.path_exists(extpath):
                                     continue
                                 extstr = self.extensionstr(extension)
                                 extstr = extstr.replace('"', '\\"')
@@ -1405,7 +1923,7 @@ class Publisher:
                                 "vmlinuz-ec2", "vmlinuz-virtual",
                             ):
                                 extpath = "%s-%s" % (base, extension)
-                                if not os.path.exists(extpath):
+                                if not snapshot.path_exists(extpath):
                                     continue
                                 extstr = self.extensionstr(extension)
                                 extstr = extstr.replace('"', '\\"')
@@ -1419,7 +1937,7 @@ class Publisher:
 
             published_ec2_path = os.path.join(
                 directory, "published-ec2-%s.txt" % status)
-            if os.path.exists(published_ec2_path):
+            if snapshot.path_exists(published_ec2_path):
                 print("<h3>Amazon EC2 Published AMIs</h3>", file=header)
                 print(file=header)
                 features_link = Link(
@@ -1486,8 +2004,7 @@ class Publisher:
                 print("</tbody></table>", file=header)
 
             if (series >= "precise" and
-                    [entry for entry in os.listdir(directory)
-                     if "-arm" in entry]):
+                    [entry for entry in snapshot if "-arm" in entry]):
                 link = Link(
                     "https://wiki.ubuntu.com/ARM/Server/Install",
                     "ARM/Server/Install")
@@ -1507,8 +2024,8 @@ class Publisher:
                     "below.</p>", file=header)
             print(file=header)
 
-            got_iso = self.find_any_with_extension(directory, "iso")
-            got_img = self.find_any_with_extension(directory, "img")
+            got_iso = self.find_any_with_extension(snapshot, "iso")
+            got_img = self.find_any_with_extension(snapshot, "img")
             iso_link = Link(
                 "https://help.ubuntu.com/community/BurningIsoHowto",
                 "Image Burning Guide")
@@ -1617,39 +2134,291 @@ class Publisher:
             ):
                 mimetype = self.mimetypestr(extension)
                 if (mimetype and
-                        self.find_any_with_extension(directory, extension)):
+                        self.find_any_with_extension(snapshot, extension)):
                     print(
                         "AddType %s .%s" % (mimetype, extension),
                         file=htaccess)
 
+        return any(output.changed for output in outputs)
+
+    def artifact_index(self, directory):
+        """Return an up-to-date ArtifactIndex of directory.
+
+        Each directory is indexed once per publisher, and only listed again
+        if it changes.
+        """
+        with self.artifact_indexes_lock:
+            index = self.artifact_indexes.get(directory)
+            if index is None:
+                index = ArtifactIndex(directory)
+                self.artifact_indexes[directory] = index
+        return index.refresh()
+
+    def can_make_zsync(self):
+        """Return True if zsync metafiles can be made.
+
+        The native writer in cdimage.zsync is far slower than zsyncmake
+        where hashlib lacks MD4, so without zsyncmake it is only used if
+        CDIMAGE_NATIVE_ZSYNC is set.
+        """
+        return bool(
+            osextras.find_on_path("zsyncmake") or
+            self.config["CDIMAGE_NATIVE_ZSYNC"])
+
+    def make_zsync(self, infile, outfile, url, dry_run=False):
+        """Start making a zsync metafile in the background.
+
+        The metafile is only guaranteed to exist once wait_for_zsync has
+        returned.
+        """
+        if dry_run:
+            zsyncmake(infile, outfile, url, dry_run=True)
+        else:
+            self.zsync_inputs[outfile] = infile
+            self.zsync_jobs.submit(outfile, zsyncmake, infile, outfile, url)
+
+    def wait_for_zsync(self):
+        """Wait for all zsync metafiles started by make_zsync."""
+        # Metafiles may be started from several threads at once, so report
+        # them in a stable order.
+        for outfile, _, elapsed in sorted(
+                self.zsync_jobs.join(), key=lambda job: job[0]):
+            logger.info(
+                "Made %s in %.1f seconds" %
+                (os.path.basename(outfile), elapsed))
+            if self.journal is not None:
+                self.journal.record(
+                    "zsync %s" % outfile,
+                    outputs=[self.zsync_inputs[outfile], outfile])
+
+    def zsync_completed(self, outfile):
+        """Return True if an interrupted publication made outfile already."""
+        return (
+            self.journal is not None and
+            self.journal.completed("zsync %s" % outfile))
+
+    def journal_run(self, key, func, *args, **kwargs):
+        """Call func(*args), unless the journal shows it already done.
+
+        If outputs is given, it is called once func has finished, and
+        returns the files that func produced; the step is only skipped
+        while they are still in place.
+        """
+        outputs = kwargs.pop("outputs", None)
+        if self.journal is None:
+            func(*args)
+        else:
+            self.journal.run(key, func, *args, outputs=outputs)
+
+    @staticmethod
+    def directory_outputs(directory):
+        """Return the paths of all the files in directory."""
+        return [
+            os.path.join(directory, name)
+            for name in sorted(osextras.listdir_force(directory))]
+
     def make_metalink(self, directory, version, dry_run=False):
         """Create and publish metalink files."""
         osextras.unlink_force(os.path.join(directory, "MD5SUMS-metalink"))
         osextras.unlink_force(os.path.join(directory, "MD5SUMS-metalink.gpg"))
 
         reldir = os.path.relpath(directory, self.tree.directory)
-        metalink_builder = os.path.join(
-            self.config.root, "MirrorMetalink", "build.py")
-        command = [
-            metalink_builder, self.tree.directory, version, reldir,
-            self.tree.site_name,
-        ]
+        if self.config["CDIMAGE_EXTERNAL_METALINK"]:
+            metalink_builder = os.path.join(
+                self.config.root, "MirrorMetalink", "build.py")
+            command = [
+                metalink_builder, self.tree.directory, version, reldir,
+                self.tree.site_name,
+            ]
+            if dry_run:
+                logger.info(" ".join(shell_quote(arg) for arg in command))
+                return
+            if subprocess.call(command) == 0:
+                metalink_checksum_directory(self.config, directory)
+            return
+
         if dry_run:
-            logger.info(" ".join(shell_quote(arg) for arg in command))
+            logger.info("Would write metalink files for %s" % reldir)
+            return
+        # Build metalinks from the checksums we already have, rather than
+        # reading every image again.
+        write_metalinks(
+            self.config, directory, self.metalink_urls(reldir),
+            identity=self.config.capproject, version=version)
+        metalink_checksum_directory(self.config, directory)
+
+    def metalink_urls(self, reldir):
+        """Return the base URLs at which reldir is published.
+
+        These are taken from $CDIMAGE_METALINK_MIRRORS, a space-separated
+        list of URLs for copies of the whole tree, defaulting to this tree's
+        own site.
+        """
+        mirrors = self.config["CDIMAGE_METALINK_MIRRORS"].split()
+        if not mirrors:
+            mirrors = ["https://%s" % self.tree.site_name]
+        return [
+            "%s/%s" % (mirror.rstrip("/"), reldir) for mirror in mirrors]
+
+
+web_index_extensions = (
+    ".iso", ".img", ".img.gz", ".img.xz", ".img.tar.gz", ".tar.gz",
+    ".tar.xz", ".jigdo", ".list", ".iso.torrent", ".img.torrent",
+)
+
+release_prefix_re = re.compile(
+    r"^(?P<project>[a-z][a-z0-9_-]*?)-"
+    r"(?P<version>[0-9]+\.[0-9]+(?:\.[0-9]+)?)"
+    r"(?:-(?:(?:alpha|beta)[0-9]*|rc|preview))?-")
+
+
+def web_index_prefix(name):
+    """Work out the index prefix implied by an image file name.
+
+    Daily images are named after their series, and release images after
+    their project, version, and (for pre-releases) status.  Return a tuple
+    of (project, series name, prefix), where project is None if the name
+    does not say, or None if name is not an image.
+    """
+    if not name.endswith(web_index_extensions):
+        return None
+    first = name.split("-", 1)[0]
+    if "-" in name and first in [series.name for series in all_series]:
+        return None, first, first
+    match = release_prefix_re.match(name)
+    if match is None:
+        return None
+    version = match.group("version")
+    try:
+        series = Series.find_by_version(".".join(version.split(".")[:2]))
+    except ValueError:
+        return None
+    return match.group("project"), series.name, match.group(0)[:-1]
+
+
+def web_index_status(config, directory):
+    """Return the make_web_indices status for a publish directory."""
+    simple = os.path.join(config.root, "www", "simple")
+    realpath = os.path.realpath(directory)
+    if (realpath + "/").startswith(simple + "/"):
+        return "release"
+    elif "releases" in realpath.split("/"):
+        return "release"
+    else:
+        return "daily"
+
+
+def find_web_index_directories(config, top):
+    """Find every publish directory under top.
+
+    Yield a (directory, project, capproject, series name, prefix, status)
+    tuple for each directory containing images, with everything derived
+    from its path and the names of the images in it.  Where a directory
+    contains images with more than one prefix, the most common one wins.
+    Hidden directories (such as the simple tree's .pool) are skipped.
+    """
+    for dirpath, dirnames, filenames in os.walk(top):
+        dirnames[:] = sorted(
+            dirname for dirname in dirnames if not dirname.startswith("."))
+        counts = {}
+        for filename in filenames:
+            derived = web_index_prefix(filename)
+            if derived is not None:
+                counts[derived] = counts.get(derived, 0) + 1
+        if not counts:
+            continue
+        project, series, prefix = max(
+            counts, key=lambda derived: (
+                counts[derived], len(derived[2]), derived[2]))
+        status = web_index_status(config, dirpath)
+        tree = Tree.get_for_directory(config, dirpath, status)
+        if isinstance(tree, ChinaDailyTree):
+            project, full_project = "ubuntu", "ubuntu-zh_CN"
         else:
-            try:
-                if subprocess.call(command) == 0:
-                    metalink_checksum_directory(self.config, directory)
-                    return
-            except OSError as e:
-                if e.errno != errno.ENOENT:
-                    raise
+            if project not in project_map:
+                relative = os.path.relpath(
+                    os.path.realpath(dirpath),
+                    os.path.realpath(tree.directory))
+                project = tree.path_to_project(relative)
+            full_project = project
+        yield (
+            dirpath, project, project_map.get(full_project, project), series,
+            prefix, status)
+
+
+_web_indices_config = None
+
+
+def _init_web_indices_worker(config):
+    global _web_indices_config
+    _web_indices_config = config
+
+
+def _make_web_indices_job(target):
+    directory, project, capproject, series, prefix, status = target
+    # Setting a configuration item also exports it, so put the
+    # environment back afterwards as well.
+    saved_environ = dict(
+        (key, os.environ.get(key))
+        for key in ("PROJECT", "CAPPROJECT", "DIST"))
+    config = Config(read=False)
+    config.root = _web_indices_config.root
+    config.update(_web_indices_config)
+    try:
+        config["PROJECT"] = project
+        config["CAPPROJECT"] = capproject
+        config["DIST"] = series
+        tree = Tree.get_for_directory(config, directory, status)
+        publisher = Publisher(tree, "daily")  # image_type unused
+        changed = publisher.make_web_indices(directory, prefix, status=status)
+        return directory, changed, None
+    except Exception as e:
+        return directory, False, str(e)
+    finally:
+        for key, value in saved_environ.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
 
-        if not dry_run:
-            # Metalink creation failed.  Remove any stale .metalink files.
-            for name in os.listdir(directory):
-                if name.endswith(".metalink"):
-                    osextras.unlink_force(os.path.join(directory, name))
+
+def make_web_indices_recursive(config, top, jobs=None):
+    """Make HTML indices for every publish directory under top.
+
+    Directories are rendered by a pool of worker processes forked from
+    this one, so the configuration is only loaded once.  Each directory is
+    rendered with its own copy of config, with PROJECT, CAPPROJECT, and
+    DIST set for that directory; config itself is left unchanged.  Return
+    a list of (directory, changed, error) tuples.
+    """
+    if jobs is None:
+        jobs = job_count(config)
+    targets = list(find_web_index_directories(config, top))
+    if jobs <= 1 or len(targets) <= 1:
+        _init_web_indices_worker(config)
+        results = [_make_web_indices_job(target) for target in targets]
+    else:
+        pool = multiprocessing.Pool(
+            min(jobs, len(targets)), _init_web_indices_worker, (config,))
+        try:
+            results = pool.map(_make_web_indices_job, targets)
+            pool.close()
+            pool.join()
+        finally:
+            pool.terminate()
+
+    changed = [directory for directory, dir_changed, _ in results
+               if dir_changed]
+    logger.info(
+        "Web indices changed in %d of %d directories" %
+        (len(changed), len(results)))
+    for directory in changed:
+        logger.info("  %s" % directory)
+    for directory, _, error in results:
+        if error is not None:
+            logger.error("Failed to make web indices for %s: %s" %
+                         (directory, error))
+    return results
 
 
 class DailyTree(Tree):
@@ -1695,17 +2464,338 @@ class DailyTree(Tree):
             if not dirnames:
                 seen_inodes.pop()
 
+    def split_publish_base(self, relative_path):
+        """Split a tree-relative publish base into its components.
 
-class DailyTreePublisher(Publisher):
-    """An object that can publish daily builds."""
+        Return (project, image_type_dir, image_type).  Series directories
+        are left in image_type_dir but excluded from image_type.
+        """
+        parts = relative_path.split("/")
+        series_names = set(
+            series.name for series in all_series
+            if series.distribution == "ubuntu")
+        distributions = set(
+            series.distribution for series in all_series
+            if series.distribution != "ubuntu")
+        if (len(parts) > 1 and parts[0] not in series_names and
+                parts[0] not in distributions):
+            project = parts.pop(0)
+        else:
+            project = "ubuntu"
+        image_type_dir = "/".join(parts)
+        image_type = DailyTreePublisher.image_type_for_dir(
+            project, image_type_dir)
+        if self.config["UBUNTU_DEFAULTS_LOCALE"]:
+            project = "-".join(
+                [project, self.config["UBUNTU_DEFAULTS_LOCALE"]])
+        return project, image_type_dir, image_type
 
-    def __init__(self, tree, image_type):
-        super(DailyTreePublisher, self).__init__(tree, image_type)
-        self.checksum_dirs = []
+    def publish_bases(self):
+        """Yield tree-relative paths of directories of dated images.
 
-    def image_output(self, arch):
-        return os.path.join(
-            self.config.root, "scratch", self.project, self.config.full_series,
+        The tree is walked once, without descending into image directories
+        or following symlinks.
+        """
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            dated = [
+                dirname for dirname in dirnames
+                if dated_entry_re.match(dirname)]
+            if dated:
+                yield os.path.relpath(dirpath, self.directory)
+                dirnames[:] = [
+                    dirname for dirname in dirnames
+                    if dirname not in dated and
+                    dirname not in ("current", "pending")]
+            dirnames.sort()
+
+    def plan_purge(self, days=None, count=None):
+        """Plan purging of old images for every project in this tree.
+
+        Purge policy is resolved separately for each project and image
+        type, as DailyTreePublisher.purge does.  Return a PurgePlan.
+        """
+        plan = PurgePlan(self.config)
+        for relative_path in self.publish_bases():
+            project, image_type_dir, image_type = self.split_publish_base(
+                relative_path)
+            project_image_type = "%s/%s" % (project, image_type)
+            base_days, base_count = get_purge_policy(
+                self.config, project, image_type, days=days, count=count)
+            if not base_days and not base_count:
+                logger.info("Not purging images for %s" % project_image_type)
+                continue
+            elif base_days and base_count:
+                logger.error(
+                    "Both purge-days and purge-count are defined for %s. "
+                    "Such scenario is currently unsupported." %
+                    project_image_type)
+                continue
+            publish_base = os.path.join(self.directory, relative_path)
+            for entry, entry_path in purge_candidates(
+                    publish_base, days=base_days, count=base_count):
+                plan.add(
+                    "%s/%s/%s" % (project, image_type_dir, entry),
+                    entry_path)
+        return plan
+
+    def purge(self, days=None, count=None, dry_run=False):
+        """Purge old images for every project in this tree."""
+        plan = self.plan_purge(days=days, count=count)
+        dry_run = bool(
+            dry_run or self.config["DEBUG"] or self.config["CDIMAGE_NOPURGE"])
+        logger.info(
+            "%s %d %s, freeing %.1f MiB" %
+            ("Would purge" if dry_run else "Purging", len(plan),
+             "image" if len(plan) == 1 else "images",
+             plan.size() / (1024.0 * 1024.0)))
+        plan.execute(dry_run=dry_run)
+
+
+class QAProducts:
+    """The table of QA tracker products from etc/qa-products.
+
+    Each entry maps a project, image type, publish type, and architecture
+    to a QA tracker product and target instance.  Lookups are indexed for
+    every combination of wildcarded fields, and return the first matching
+    entry in file order.
+    """
+
+    fields = ("project", "image_type", "publish_type", "arch")
+
+    def __init__(self, entries):
+        # entries is a list of (qaproduct, project, image_type,
+        # publish_type, arch, qatarget) tuples.
+        self.index = {}
+        self.reverse_index = {}
+        masks = [
+            tuple(bool(i & (1 << bit)) for bit in range(len(self.fields)))
+            for i in range(1 << len(self.fields))]
+        for entry in entries:
+            qaproduct, project, image_type, publish_type, arch, qatarget = (
+                entry)
+            key = (project.split("/", 1)[0], image_type, publish_type, arch)
+            for mask in masks:
+                masked_key = (mask, tuple(
+                    value for value, wanted in zip(key, mask) if wanted))
+                self.index.setdefault(masked_key, (qaproduct, qatarget))
+            self.reverse_index.setdefault(
+                (qaproduct, qatarget),
+                (project, image_type, publish_type, arch))
+
+    @classmethod
+    def from_file(cls, path):
+        entries = []
+        with open(path) as qaproducts:
+            for line in qaproducts:
+                if line.startswith("#"):
+                    continue
+                entry = re.sub("\t+", "\t", line).strip().split("\t")
+                if len(entry) == 6:
+                    entries.append(tuple(entry))
+        return cls(entries)
+
+    def lookup(self, project, image_type, publish_type, arch):
+        """Return (qaproduct, qatarget) for an image, or None.
+
+        Empty or None arguments match any value.
+        """
+        key = (project, image_type, publish_type, arch)
+        mask = tuple(bool(value) for value in key)
+        return self.index.get(
+            (mask, tuple(value for value in key if value)))
+
+    def reverse_lookup(self, qaproduct, qatarget):
+        """Return (project, image_type, publish_type, arch), or None."""
+        return self.reverse_index.get((qaproduct, qatarget))
+
+
+def read_purge_data(path):
+    """Parse etc/purge-days or etc/purge-count into a dictionary.
+
+    Values are left as strings; the first line for each key wins.
+    """
+    data = {}
+    with open(path) as purge_data:
+        for line in purge_data:
+            if line.startswith("#"):
+                continue
+            line = line.rstrip("\n")
+            words = line.split(None, 1)
+            if len(words) != 2:
+                continue
+            data.setdefault(words[0], words[1])
+    return data
+
+
+def get_purge_data(config, key, purge_type):
+    """Look up key in etc/purge-days or etc/purge-count."""
+    path = os.path.join(config.root, "etc", purge_type)
+    try:
+        data = load_cached(path, read_purge_data)
+    except (IOError, OSError) as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    if key not in data:
+        return None
+    return int(data[key])
+
+
+def get_purge_policy(config, project, image_type, days=None, count=None):
+    """Return (days, count) for purging project/image_type.
+
+    Explicit days or count arguments take precedence.  Otherwise each is
+    looked up by project, then by project/image_type, then by image_type.
+    """
+    keys = (project, "%s/%s" % (project, image_type), image_type)
+    for key in keys:
+        if days is not None:
+            break
+        days = get_purge_data(config, key, "purge-days")
+    for key in keys:
+        if count is not None:
+            break
+        count = get_purge_data(config, key, "purge-count")
+    return days, count
+
+
+dated_entry_re = re.compile(r"^[0-9]{8}(\.[0-9]+)?$")
+
+
+def purge_protected_entries(publish_base):
+    """Return the set of entries in publish_base that must not be purged.
+
+    These are the targets of the "pending" and "current" symlinks, or of
+    the per-image symlinks in a "current" directory.
+    """
+    protected = set()
+    publish_pending = os.path.join(publish_base, "pending")
+    publish_current = os.path.join(publish_base, "current")
+    if os.path.islink(publish_pending):
+        protected.add(os.readlink(publish_pending))
+    if os.path.islink(publish_current):
+        protected.add(os.readlink(publish_current))
+    elif os.path.isdir(publish_current):
+        for current_entry in os.listdir(publish_current):
+            current_entry_path = os.path.join(publish_current, current_entry)
+            if os.path.islink(current_entry_path):
+                target_bits = os.readlink(current_entry_path).split(os.sep)
+                if (len(target_bits) == 3 and
+                        target_bits[0] == os.pardir and
+                        target_bits[2] == current_entry):
+                    protected.add(target_bits[1])
+    return protected
+
+
+def purge_candidates(publish_base, days=None, count=None):
+    """Yield (entry, path) for each image directory that should be purged.
+
+    Entries are considered newest first.  An entry is purged if it is older
+    than days days or if count newer entries have already been kept, unless
+    it is protected by a "pending" or "current" link.
+    """
+    oldest = 0
+    if days:
+        oldest = int(time.strftime(
+            "%Y%m%d", time.gmtime(time.time() - 60 * 60 * 24 * days)))
+    protected = purge_protected_entries(publish_base)
+    image_count = 0
+
+    for entry in sorted(
+            osextras.listdir_force(publish_base), reverse=True):
+        entry_path = os.path.join(publish_base, entry)
+
+        # Directory?
+        if not os.path.isdir(entry_path):
+            continue
+
+        # Numeric directory?
+        if not entry[0].isdigit():
+            continue
+
+        image_count += 1
+
+        # Older than cut-off date?
+        # Did we leave enough images already?
+        # In the case where both cut-off date and image count have been
+        # defined, we purge anything that doesn't satisfy both of the above
+        # conditions at once
+        if ((not days or oldest <= int(entry.split(".", 1)[0])) and
+                (not count or image_count <= count)):
+            continue
+
+        # Pointed to by "pending" or "current" symlink?
+        if entry in protected:
+            continue
+
+        yield entry, entry_path
+
+
+class PurgePlan:
+    """A list of old image directories to delete, possibly across projects.
+
+    Directories are moved to the trash, and deleted by a background reaper.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        # List of (description, path) pairs.
+        self.entries = []
+
+    def add(self, description, path):
+        self.entries.append((description, path))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def size(self):
+        """Return the number of bytes that executing this plan would free.
+
+        Each inode is counted once, but files that are also linked from
+        outside the plan are still counted.
+        """
+        seen = set()
+        total = 0
+        for _, path in self.entries:
+            if os.path.islink(path):
+                continue
+            for dirpath, _, filenames in os.walk(path):
+                for filename in filenames:
+                    try:
+                        st = os.lstat(os.path.join(dirpath, filename))
+                    except OSError:
+                        continue
+                    if (st.st_dev, st.st_ino) not in seen:
+                        seen.add((st.st_dev, st.st_ino))
+                        total += st.st_size
+        return total
+
+    def execute(self, dry_run=False):
+        for description, path in self.entries:
+            if dry_run:
+                logger.info("Would purge %s" % description)
+            else:
+                logger.info("Purging %s" % description)
+                move_to_trash(self.config, path)
+        if not dry_run:
+            # This also picks up anything left behind by an earlier reaper
+            # that died.
+            start_reaper(self.config)
+
+
+class DailyTreePublisher(Publisher):
+    """An object that can publish daily builds."""
+
+    def __init__(self, tree, image_type):
+        super(DailyTreePublisher, self).__init__(tree, image_type)
+        self.checksum_dirs = []
+        # Serialises updates to state shared between architectures that
+        # are being published in parallel.
+        self.publish_lock = threading.Lock()
+
+    def image_output(self, arch):
+        return os.path.join(
+            self.config.root, "scratch", self.project, self.config.full_series,
             self.image_type, "debian-cd", arch)
 
     @property
@@ -1731,6 +2821,30 @@ class DailyTreePublisher(Publisher):
                 self.config.full_series, image_type_dir)
         return image_type_dir
 
+    @staticmethod
+    def image_type_for_dir(project, image_type_dir):
+        """Return the image type published to image_type_dir.
+
+        This is the inverse of image_type_dir, for a directory relative to
+        the project's base directory.
+        """
+        parts = image_type_dir.split("/")
+        if (project == "ubuntu-core" and len(parts) == 2 and
+                parts[0] in [name for name, _ in core_series_starts]):
+            # core_series/channel
+            return "daily-live"
+        series_names = set(
+            series.name for series in all_series
+            if series.distribution == "ubuntu")
+        distributions = set(
+            series.distribution for series in all_series
+            if series.distribution != "ubuntu")
+        if len(parts) > 1 and parts[0] in series_names:
+            parts = parts[1:]
+        elif len(parts) > 2 and parts[0] in distributions:
+            parts = parts[2:]
+        return "_".join(parts)
+
     @property
     def publish_base(self):
         return os.path.join(self.tree.project_base, self.image_type_dir)
@@ -1847,8 +2961,19 @@ class DailyTreePublisher(Publisher):
                 break
 
     def detect_image_extension(self, source_prefix):
+        path = "%s.%s" % (source_prefix, self.source_extension)
+        image_type = sniff_image_type(read_image_head(path))
+        if image_type in ("iso", "img"):
+            return image_type
+        elif image_type in ("gz", "xz"):
+            real_type = sniff_image_type(
+                read_image_head(path, compression=image_type))
+            if real_type in ("iso", "img", "tar"):
+                return "%s.%s" % (real_type, image_type)
+
+        # Fall back to file(1) for anything we don't recognise ourselves.
         subp = subprocess.Popen(
-            ["file", "-b", "%s.%s" % (source_prefix, self.source_extension)],
+            ["file", "-b", path],
             stdout=subprocess.PIPE, universal_newlines=True)
         output = subp.communicate()[0].rstrip("\n")
         if output.startswith("# "):
@@ -1898,12 +3023,22 @@ class DailyTreePublisher(Publisher):
         return False
 
     def replace_jigdo_mirror(self, path, from_mirror, to_mirror):
-        with open(path) as jigdo_in:
-            with AtomicFile(path) as jigdo_out:
-                from_line = "Debian=%s" % from_mirror
-                to_line = "Debian=%s" % to_mirror
-                for line in jigdo_in:
-                    jigdo_out.write(line.replace(from_line, to_line))
+        return rewrite_jigdo(
+            path, path, "Debian=%s" % from_mirror, "Debian=%s" % to_mirror)
+
+    def move(self, source, target):
+        """Move source to target, recording this in the journal."""
+        if self.journal is None:
+            shutil.move(source, target)
+        else:
+            self.journal.move(source, target)
+
+    def moved(self, source):
+        """Return where an interrupted publication moved source to, if
+        anywhere."""
+        if self.journal is None:
+            return None
+        return self.journal.moved(source)
 
     def publish_binary(self, publish_type, arch, date):
         in_prefix = "%s-%s-%s" % (self.config.series, publish_type, arch)
@@ -1915,8 +3050,13 @@ class DailyTreePublisher(Publisher):
         source_prefix = os.path.join(source_dir, in_prefix)
         target_dir = os.path.join(self.publish_base, date)
         target_prefix = os.path.join(target_dir, out_prefix)
+        source = self.artifact_index(source_dir)
 
-        if not os.path.exists(
+        def present(path):
+            # Files moved by an interrupted attempt count as present.
+            return source.exists(path) or self.moved(path) is not None
+
+        if not present(
                 "%s.%s" % (source_prefix, self.source_extension)):
             logger.warning("No %s image for %s!" % (publish_type, arch))
             for name in osextras.listdir_force(target_dir):
@@ -1926,22 +3066,27 @@ class DailyTreePublisher(Publisher):
 
         logger.info("Publishing %s ..." % arch)
         osextras.ensuredir(target_dir)
-        extension = self.detect_image_extension(source_prefix)
-        shutil.move(
+        moved = self.moved("%s.%s" % (source_prefix, self.source_extension))
+        if moved is not None:
+            extension = moved[len(target_prefix) + 1:]
+        else:
+            extension = self.detect_image_extension(source_prefix)
+        self.move(
             "%s.%s" % (source_prefix, self.source_extension),
             "%s.%s" % (target_prefix, extension))
-        if os.path.exists("%s.list" % source_prefix):
-            shutil.move("%s.list" % source_prefix, "%s.list" % target_prefix)
-        self.checksum_dirs.append(source_dir)
-        with ChecksumFileSet(
-                self.config, target_dir, sign=False) as checksum_files:
-            checksum_files.remove("%s.%s" % (out_prefix, extension))
+        if present("%s.list" % source_prefix):
+            self.move("%s.list" % source_prefix, "%s.list" % target_prefix)
+        with self.publish_lock:
+            self.checksum_dirs.append(source_dir)
+            with ChecksumFileSet(
+                    self.config, target_dir, sign=False) as checksum_files:
+                checksum_files.remove("%s.%s" % (out_prefix, extension))
 
         # Jigdo integration
-        if os.path.exists("%s.jigdo" % source_prefix):
+        if present("%s.jigdo" % source_prefix):
             logger.info("Publishing %s jigdo ..." % arch)
-            shutil.move("%s.jigdo" % source_prefix, "%s.jigdo" % target_prefix)
-            shutil.move(
+            self.move("%s.jigdo" % source_prefix, "%s.jigdo" % target_prefix)
+            self.move(
                 "%s.template" % source_prefix, "%s.template" % target_prefix)
             if self.jigdo_ports(arch):
                 self.replace_jigdo_mirror(
@@ -1953,25 +3098,25 @@ class DailyTreePublisher(Publisher):
             osextras.unlink_force("%s.template" % target_prefix)
 
         # Live filesystem manifests
-        if os.path.exists("%s.manifest" % source_prefix):
+        if present("%s.manifest" % source_prefix):
             logger.info("Publishing %s live manifest ..." % arch)
-            shutil.move(
+            self.move(
                 "%s.manifest" % source_prefix, "%s.manifest" % target_prefix)
         else:
             osextras.unlink_force("%s.manifest" % target_prefix)
 
         if (self.config["CDIMAGE_SQUASHFS_BASE"] and
-                os.path.exists("%s.squashfs" % source_prefix)):
+                present("%s.squashfs" % source_prefix)):
             logger.info("Publishing %s squashfs ..." % arch)
-            shutil.move(
+            self.move(
                 "%s.squashfs" % source_prefix, "%s.squashfs" % target_prefix)
         else:
             osextras.unlink_force("%s.squashfs" % target_prefix)
 
         # Flashable Android boot images
-        if os.path.exists("%s.bootimg" % source_prefix):
+        if present("%s.bootimg" % source_prefix):
             logger.info("Publishing %s abootimg images ..." % arch)
-            shutil.move(
+            self.move(
                 "%s.bootimg" % source_prefix, "%s.bootimg" % target_prefix)
 
         for touch_target in Touch.list_targets_by_ubuntu_arch(arch):
@@ -1986,68 +3131,69 @@ class DailyTreePublisher(Publisher):
                 touch_target.subarch)
 
             for image in boot_img, system_img, recovery_img:
-                if os.path.exists(os.path.join(source_dir, image)):
+                if present(os.path.join(source_dir, image)):
                     logger.info("Publishing %s ..." % image)
-                    shutil.move(
+                    self.move(
                         os.path.join(source_dir, image),
                         os.path.join(target_dir, image))
 
-        if os.path.exists("%s.custom.tar.gz" % source_prefix):
+        if present("%s.custom.tar.gz" % source_prefix):
             logger.info("Publishing %s custom tarball ..." % arch)
-            shutil.move(
+            self.move(
                 "%s.custom.tar.gz" % source_prefix,
                 "%s.custom.tar.gz" % target_prefix)
 
-        if os.path.exists("%s.device.tar.gz" % source_prefix):
+        if present("%s.device.tar.gz" % source_prefix):
             logger.info("Publishing %s device tarball ..." % arch)
-            shutil.move(
+            self.move(
                 "%s.device.tar.gz" % source_prefix,
                 "%s.device.tar.gz" % target_prefix)
 
             for devarch in ("azure", "plano", "raspi2"):
-                if os.path.exists("%s.%s.device.tar.gz" % (source_prefix,
-                                                           devarch)):
+                if present("%s.%s.device.tar.gz" % (source_prefix,
+                                                    devarch)):
                     logger.info("Publishing %s %s device tarball ..." %
                                 (arch, devarch))
-                    shutil.move(
+                    self.move(
                         "%s.%s.device.tar.gz" % (source_prefix, devarch),
                         "%s.%s.device.tar.gz" % (target_prefix, devarch))
 
         # os snap packages
-        if os.path.exists("%s.os.snap" % source_prefix):
+        if present("%s.os.snap" % source_prefix):
             logger.info("Publishing %s os snap package ..." % arch)
-            shutil.move(
+            self.move(
                 "%s.os.snap" % source_prefix,
                 "%s.os.snap" % target_prefix)
 
         # kernel snap packages
-        if os.path.exists("%s.kernel.snap" % source_prefix):
+        if present("%s.kernel.snap" % source_prefix):
             logger.info("Publishing %s kernel snap package ..." % arch)
-            shutil.move(
+            self.move(
                 "%s.kernel.snap" % source_prefix,
                 "%s.kernel.snap" % target_prefix)
 
             for devarch in ("dragonboard", "raspi2"):
-                if os.path.exists("%s.%s.kernel.snap" % (source_prefix,
-                                                         devarch)):
+                if present("%s.%s.kernel.snap" % (source_prefix,
+                                                  devarch)):
                     logger.info("Publishing %s %s kernel snap package ..." %
                                 (arch, devarch))
-                    shutil.move(
+                    self.move(
                         "%s.%s.kernel.snap" % (source_prefix, devarch),
                         "%s.%s.kernel.snap" % (target_prefix, devarch))
 
         # snappy model assertions
-        if os.path.exists("%s.model-assertion" % source_prefix):
+        if present("%s.model-assertion" % source_prefix):
             logger.info("Publishing %s model assertion ..." % arch)
-            shutil.move(
+            self.move(
                 "%s.model-assertion" % source_prefix,
                 "%s.model-assertion" % target_prefix)
 
         # zsync metafiles
-        if osextras.find_on_path("zsyncmake"):
+        if self.can_make_zsync() and not self.zsync_completed(
+                "%s.%s.zsync" % (target_prefix, extension)):
             logger.info("Making %s zsync metafile ..." % arch)
             osextras.unlink_force("%s.%s.zsync" % (target_prefix, extension))
-            zsyncmake(
+            self.make_zsync(
                 "%s.%s" % (target_prefix, extension),
                 "%s.%s.zsync" % (target_prefix, extension),
                 "%s.%s" % (out_prefix, extension))
@@ -2065,6 +3211,24 @@ class DailyTreePublisher(Publisher):
                 [qa_project, self.config["UBUNTU_DEFAULTS_LOCALE"]])
         yield os.path.join(qa_project, self.image_type_dir, in_prefix)
 
+    def publish_binaries(self, publish_type, date):
+        """Publish binary images for all architectures.
+
+        Architectures are published in parallel, bounded by
+        $CDIMAGE_PUBLISH_JOBS.  The returned list of published images is in
+        the same order as the architecture list, however long each
+        architecture takes.
+        """
+        def publish_arch(arch):
+            return list(self.publish_binary(publish_type, arch, date))
+
+        published = []
+        for arch_published in map_parallel(
+                publish_arch, [(arch,) for arch in self.config.arches],
+                jobs=job_count(self.config)):
+            published.extend(arch_published)
+        return published
+
     def publish_livecd_base(self, arch, date):
         source_dir = os.path.join(
             self.config.root, "scratch", self.project, self.config.full_series,
@@ -2138,26 +3302,27 @@ class DailyTreePublisher(Publisher):
             source_prefix = os.path.join(source_dir, in_prefix)
             target_dir = os.path.join(self.publish_base, date, "source")
             target_prefix = os.path.join(target_dir, out_prefix)
-            if not os.path.exists(
-                    "%s.%s" % (source_prefix, self.source_extension)):
+            image = "%s.%s" % (source_prefix, self.source_extension)
+            if not os.path.exists(image) and self.moved(image) is None:
                 break
 
             logger.info("Publishing source %d ..." % i)
             osextras.ensuredir(target_dir)
-            shutil.move(
+            self.move(
                 "%s.%s" % (source_prefix, self.source_extension),
                 "%s.iso" % target_prefix)
-            shutil.move("%s.list" % source_prefix, "%s.list" % target_prefix)
+            self.move("%s.list" % source_prefix, "%s.list" % target_prefix)
             with ChecksumFileSet(
                     self.config, target_dir, sign=False) as checksum_files:
                 checksum_files.remove("%s.iso" % out_prefix)
 
             # Jigdo integration
-            if os.path.exists("%s.jigdo" % source_prefix):
+            if (os.path.exists("%s.jigdo" % source_prefix) or
+                    self.moved("%s.jigdo" % source_prefix) is not None):
                 logger.info("Publishing source %d jigdo ..." % i)
-                shutil.move(
+                self.move(
                     "%s.jigdo" % source_prefix, "%s.jigdo" % target_prefix)
-                shutil.move(
+                self.move(
                     "%s.template" % source_prefix,
                     "%s.template" % target_prefix)
             else:
@@ -2166,10 +3331,11 @@ class DailyTreePublisher(Publisher):
                 osextras.unlink_force("%s.template" % target_prefix)
 
             # zsync metafiles
-            if osextras.find_on_path("zsyncmake"):
+            if (self.can_make_zsync() and
+                    not self.zsync_completed("%s.iso.zsync" % target_prefix)):
                 logger.info("Making source %d zsync metafile ..." % i)
                 osextras.unlink_force("%s.iso.zsync" % target_prefix)
-                zsyncmake(
+                self.make_zsync(
                     "%s.iso" % target_prefix, "%s.iso.zsync" % target_prefix,
                     "%s.iso" % out_prefix)
 
@@ -2200,14 +3366,26 @@ class DailyTreePublisher(Publisher):
                 for entry, d in publish_dates.items():
                     fd.write("%s %s\n" % (entry, d))
 
-    def polish_directory(self, date):
-        """Apply various bits of polish to a published directory."""
+    def polish_directory(self, date, checksum_sources=None):
+        """Apply various bits of polish to a published directory.
+
+        If checksum_sources is given, then only the entries it names have
+        changed, and their checksums are copied from the directories it
+        maps them to rather than being recomputed.
+        """
         target_dir = os.path.join(self.publish_base, date)
 
-        if not self.config["CDIMAGE_ONLYSOURCE"]:
+        if (not self.config["CDIMAGE_ONLYSOURCE"] and
+                checksum_sources is not None):
+            update_checksum_directory(
+                self.config, target_dir, checksum_sources)
+        elif not self.config["CDIMAGE_ONLYSOURCE"]:
             checksum_directory(
                 self.config, target_dir, old_directories=self.checksum_dirs,
                 map_expr=r"s/\.\(img\|img\.gz\|iso\|iso\.gz\|tar\.gz\)$/.raw/")
+        # zsync metafiles are made in the background while we checksum, but
+        # the indices need to describe them.
+        self.wait_for_zsync()
         if (self.config.project != "livecd-base" and
                 not self.config["CDIMAGE_ONLYSOURCE"]):
             self.make_web_indices(
@@ -2328,6 +3506,7 @@ class DailyTreePublisher(Publisher):
             if not os.path.exists(publish_current):
                 os.mkdir(publish_current)
                 changed = set(existing)
+            checksum_sources = {}
             for image in changed:
                 date = existing[image]
                 publish_date = os.path.join(self.publish_base, date)
@@ -2336,42 +3515,24 @@ class DailyTreePublisher(Publisher):
                         source = os.path.join(os.pardir, date, entry)
                         target = os.path.join(publish_current, entry)
                         osextras.symlink_force(source, target)
+                        checksum_sources[entry] = publish_date
             for date in existing.values():
                 publish_date = os.path.join(self.publish_base, date)
                 if publish_date not in self.checksum_dirs:
                     self.checksum_dirs.append(publish_date)
-            self.polish_directory("current")
+            # Only the entries we just linked need their checksums updated.
+            self.polish_directory(
+                "current", checksum_sources=checksum_sources)
 
     def current_uses_trigger(self, arch):
         """Find out whether the "current" symlink is trigger-controlled."""
         current_triggers_path = os.path.join(
             self.config.root, "production", "current-triggers")
-        if not os.path.exists(current_triggers_path):
-            return False
-        want_project_bits = [self.project]
-        if self.config.subproject:
-            want_project_bits.append(self.config.subproject)
-        if self.config["UBUNTU_DEFAULTS_LOCALE"]:
-            want_project_bits.append(self.config["UBUNTU_DEFAULTS_LOCALE"])
-        want_project = "-".join(want_project_bits)
-        with open(current_triggers_path) as current_triggers:
-            for line in current_triggers:
-                line = line.strip()
-                if not line or line.startswith("#"):
-                    continue
-                try:
-                    project, image_type, series, arches = line.split(None, 3)
-                    arches = arches.split()
-                except ValueError:
-                    continue
-                if want_project != project:
-                    continue
-                if self.image_type != image_type:
-                    continue
-                if not self.config.match_series(series):
-                    continue
-                if arch in arches:
-                    return True
+        for arches in current_triggers_rules.matches(
+                current_triggers_path, self.config.want_project(),
+                self.image_type, self.config):
+            if arch in arches.split():
+                return True
         return False
 
     def set_link_descriptions(self):
@@ -2391,6 +3552,11 @@ class DailyTreePublisher(Publisher):
                           file=htaccess)
                 print("IndexOptions FancyIndexing", file=htaccess)
 
+    @property
+    def qa_products(self):
+        product_list = os.path.join(self.config.root, "etc", "qa-products")
+        return load_cached(product_list, QAProducts.from_file)
+
     def qa_product(self, project, image_type, publish_type, arch):
         """Return a tuple of the QA tracker product for an image and the
         tracker target instance to use, or None.
@@ -2400,32 +3566,8 @@ class DailyTreePublisher(Publisher):
         there and they are not necessarily consistently named.
         """
 
-        product_list = os.path.join(self.config.root, "etc", "qa-products")
-        with open(product_list, "r") as qaproducts:
-            for line in qaproducts:
-                if line.startswith("#"):
-                    continue
-
-                try:
-                    entry_qaproduct, entry_project, entry_image_type, \
-                        entry_publish_type, entry_arch, entry_qatarget = \
-                        re.sub("\t+", "\t", line).strip().split("\t")
-                except ValueError:
-                    continue
-
-                if project and entry_project.split("/", 1)[0] != project:
-                    continue
-
-                if image_type and entry_image_type != image_type:
-                    continue
-
-                if publish_type and entry_publish_type != publish_type:
-                    continue
-
-                if arch and entry_arch != arch:
-                    continue
-
-                return (entry_qaproduct, entry_qatarget)
+        return self.qa_products.lookup(
+            project, image_type, publish_type, arch)
 
     def cdimage_project(self, qaproduct, qatarget):
         """Return a tuple of project, image_type, publish_type and arch
@@ -2434,32 +3576,12 @@ class DailyTreePublisher(Publisher):
 
         This is the opposite of qa_product.
         """
+        return self.qa_products.reverse_lookup(qaproduct, qatarget)
 
-        product_list = os.path.join(self.config.root, "etc", "qa-products")
-        with open(product_list, "r") as qaproducts:
-            for line in qaproducts:
-                if line.startswith("#"):
-                    continue
-
-                try:
-                    entry_qaproduct, entry_project, entry_image_type, \
-                        entry_publish_type, entry_arch, entry_qatarget = \
-                        re.sub("\t+", "\t", line).strip().split("\t")
-                except ValueError:
-                    continue
-
-                if entry_qaproduct == qaproduct and entry_qatarget == qatarget:
-                    return (entry_project, entry_image_type,
-                            entry_publish_type, entry_arch)
-
-    def post_qa(self, date, images):
-        """Post a list of images to the QA tracker."""
-        try:
-            from isotracker import ISOTracker
-        except ImportError:
-            return
-
-        tracker = None
+    def qa_posts(self, date, images):
+        """Return (target, product, date, note) QA tracker posts for images.
+        """
+        posts = []
 
         for image in images:
             image_bits = image.split("/")
@@ -2505,15 +3627,152 @@ class DailyTreePublisher(Publisher):
                     "<strong>WARNING: This image is OVERSIZED. This should "
                     "never happen during milestone testing.</strong>")
 
+            posts.append((target, product[0], date, note))
+
+        return posts
+
+    def post_qa(self, date, images):
+        """Post a list of images to the QA tracker."""
+        tracker_class = _isotracker_class()
+        if tracker_class is None:
+            return
+        self.send_qa_posts(tracker_class, self.qa_posts(date, images))
+
+    def queue_qa_posts(self, date, images):
+        """Post a list of images to the QA tracker in the background.
+
+        The posts are spooled, and a detached "post-qa --retry" process
+        sends them, so publication never waits for the tracker.
+        """
+        if _isotracker_class() is None:
+            return
+        for post in self.qa_posts(date, images):
+            self.spool_qa_post(post)
+        if not osextras.find_on_path("post-qa"):
+            logger.warning(
+                "post-qa not found; QA tracker posts left in %s." %
+                self.qa_spool)
+            return
+        log_dir = os.path.join(self.config.root, "log")
+        osextras.ensuredir(log_dir)
+        with open(os.devnull) as devnull:
+            with open(os.path.join(log_dir, "post-qa.log"), "a") as log:
+                subprocess.Popen(
+                    ["post-qa", "--retry"], stdin=devnull, stdout=log,
+                    stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+
+    def retry_qa_posts(self):
+        """Retry any QA tracker posts spooled after earlier failures."""
+        tracker_class = _isotracker_class()
+        if tracker_class is None:
+            return
+        self.send_qa_posts(tracker_class, [])
+
+    @property
+    def qa_spool(self):
+        return os.path.join(self.config.root, "spool", "post-qa")
+
+    def qa_spool_path(self, post):
+        name = re.sub(r"[^A-Za-z0-9.+-]", "_", "_".join(post[:3]))
+        return os.path.join(self.qa_spool, name)
+
+    def spool_qa_post(self, post):
+        """Save a QA tracker post so that it can be sent later."""
+        osextras.ensuredir(self.qa_spool)
+        with AtomicFile(self.qa_spool_path(post)) as spooled:
+            print("\t".join(post), file=spooled)
+
+    def spooled_qa_posts(self):
+        """Return any QA tracker posts spooled by earlier runs.
+
+        Spooled posts are only removed once they have been sent.
+        """
+        posts = []
+        for name in sorted(osextras.listdir_force(self.qa_spool)):
+            if name.endswith(".new"):
+                continue
+            try:
+                with open(os.path.join(self.qa_spool, name)) as spooled:
+                    post = tuple(spooled.read().rstrip("\n").split("\t"))
+            except (IOError, OSError):
+                continue
+            if len(post) == 4:
+                posts.append(post)
+        return posts
+
+    def send_qa_posts(self, tracker_class, posts):
+        """Send (target, product, date, note) posts to the QA tracker.
+
+        Posts are grouped by target, using one tracker connection per
+        target, and different targets are posted to concurrently.  Posts
+        time out after CDIMAGE_QA_TIMEOUT seconds.  Any posts that fail are
+        spooled, and retried by the next call.
+        """
+        qa_lock = os.path.join(self.config.root, "etc", ".lock-post-qa")
+        try:
+            subprocess.check_call(["lockfile", "-r", "4", qa_lock])
+        except subprocess.CalledProcessError:
+            logger.warning(
+                "Couldn't acquire post-qa lock; spooling QA tracker posts.")
+            for post in posts:
+                self.spool_qa_post(post)
+            return
+        try:
+            self._send_qa_posts(tracker_class, posts)
+        finally:
+            osextras.unlink_force(qa_lock)
+
+    def _send_qa_posts(self, tracker_class, posts):
+        targets = []
+        by_target = {}
+        for post in self.spooled_qa_posts() + list(posts):
+            if post[0] not in by_target:
+                targets.append(post[0])
+                by_target[post[0]] = []
+            if post not in by_target[post[0]]:
+                by_target[post[0]].append(post)
+
+        try:
+            timeout = float(self.config["CDIMAGE_QA_TIMEOUT"])
+        except ValueError:
+            timeout = 60
+
+        def post_target(target):
+            failed = []
             try:
-                if tracker is None or tracker.target != target:
-                    tracker = ISOTracker(target=target)
-                tracker.post_build(product[0], date, note=note)
+                tracker = tracker_class(target=target)
             except Exception:
                 traceback.print_exc()
+                return by_target[target]
+            for post in by_target[target]:
+                try:
+                    tracker.post_build(post[1], post[2], note=post[3])
+                except Exception:
+                    traceback.print_exc()
+                    failed.append(post)
+                else:
+                    osextras.unlink_force(self.qa_spool_path(post))
+            return failed
+
+        with xmlrpc_timeout(timeout):
+            failed = map_parallel(
+                post_target, [(target,) for target in targets],
+                jobs=job_count(self.config))
+        for post in [post for target_failed in failed
+                     for post in target_failed]:
+            logger.warning(
+                "Failed to post %s %s to %s; spooled for retry." %
+                (post[1], post[2], post[0]))
+            self.spool_qa_post(post)
 
     def publish(self, date):
-        self.new_publish_dir(date)
+        target_dir = os.path.join(self.publish_base, date)
+        self.journal = PublishJournal(journal_path(self.config, target_dir))
+        if self.journal.resuming:
+            logger.info("Resuming interrupted publication of %s ..." % date)
+        self.journal_run(
+            "new publish directory", self.new_publish_dir, date,
+            outputs=lambda: [target_dir])
         published = []
         self.checksum_dirs = []
         if self.config.project == "livecd-base":
@@ -2523,17 +3782,15 @@ class DailyTreePublisher(Publisher):
             for arch in self.config.arches:
                 published.extend(list(self.publish_wubi(arch, date)))
         elif not self.config["CDIMAGE_ONLYSOURCE"]:
-            for arch in self.config.arches:
-                published.extend(
-                    list(self.publish_binary(self.publish_type, arch, date)))
+            published.extend(self.publish_binaries(self.publish_type, date))
             if self.project == "edubuntu" and self.publish_type == "server":
-                for arch in self.config.arches:
-                    published.extend(
-                        list(self.publish_binary("serveraddon", arch, date)))
+                published.extend(self.publish_binaries("serveraddon", date))
         published.extend(list(self.publish_source(date)))
 
         if not published:
             logger.warning("No images produced!")
+            self.journal.remove()
+            self.journal = None
             return
 
         source_report = os.path.join(
@@ -2545,7 +3802,13 @@ class DailyTreePublisher(Publisher):
         else:
             osextras.unlink_force(target_report)
 
-        self.polish_directory(date)
+        # Polishing writes checksums, indices, and the like for everything
+        # in the directory, so it must be redone if anything has changed.
+        self.journal_run(
+            "polish", self.polish_directory, date,
+            outputs=lambda: (
+                self.directory_outputs(target_dir) +
+                self.directory_outputs(os.path.join(target_dir, "source"))))
         self.link(date, "pending")
         current_arches = [
             arch for arch in self.config.arches
@@ -2564,9 +3827,9 @@ class DailyTreePublisher(Publisher):
         try:
             manifest_daily = os.path.join(
                 self.tree.directory, ".manifest-daily")
-            with AtomicFile(manifest_daily) as manifest_daily_file:
+            with AtomicFile(manifest_daily, only_if_changed=True) as output:
                 for line in self.tree.manifest():
-                    print(line, file=manifest_daily_file)
+                    print(line, file=output)
             os.chmod(
                 manifest_daily, os.stat(manifest_daily).st_mode | stat.S_IWGRP)
 
@@ -2579,25 +3842,13 @@ class DailyTreePublisher(Publisher):
         finally:
             osextras.unlink_force(manifest_lock)
 
-        self.post_qa(date, published)
+        # This leaves nothing behind to check, so is always repeated.
+        self.queue_qa_posts(date, published)
+        self.journal.remove()
+        self.journal = None
 
     def get_purge_data(self, key, purge_type):
-        path = os.path.join(self.config.root, "etc", purge_type)
-        try:
-            with open(path) as purge_days:
-                for line in purge_days:
-                    if line.startswith("#"):
-                        continue
-                    line = line.rstrip("\n")
-                    words = line.split(None, 1)
-                    if len(words) != 2:
-                        continue
-                    if words[0] == key:
-                        return int(words[1])
-        except IOError as e:
-            if e.errno != errno.ENOENT:
-                raise
-        return None
+        return get_purge_data(self.config, key, purge_type)
 
     def purge(self, days=None, count=None):
         project = self.project
@@ -2606,19 +3857,8 @@ class DailyTreePublisher(Publisher):
                 [project, self.config["UBUNTU_DEFAULTS_LOCALE"]])
         project_image_type = "%s/%s" % (project, self.image_type)
 
-        if days is None:
-            days = self.get_purge_data(project, "purge-days")
-        if days is None:
-            days = self.get_purge_data(project_image_type, "purge-days")
-        if days is None:
-            days = self.get_purge_data(self.image_type, "purge-days")
-
-        if count is None:
-            count = self.get_purge_data(project, "purge-count")
-        if count is None:
-            count = self.get_purge_data(project_image_type, "purge-count")
-        if count is None:
-            count = self.get_purge_data(self.image_type, "purge-count")
+        days, count = get_purge_policy(
+            self.config, project, self.image_type, days=days, count=count)
 
         if not days and not count:
             logger.info("Not purging images for %s" % project_image_type)
@@ -2628,86 +3868,25 @@ class DailyTreePublisher(Publisher):
                             "%s. Such scenario is currently unsupported." %
                             project_image_type)
 
-        image_count = 0
-        oldest = 0
-
         if days:
             logger.info(
                 "Purging %s images older than %d %s ..." %
                 (project_image_type, days, "day" if days == 1 else "days"))
-            oldest = int(time.strftime(
-                "%Y%m%d", time.gmtime(time.time() - 60 * 60 * 24 * days)))
         elif count:
             logger.info(
                 "Purging %s images to leave only the latest %d %s ..." %
                 (project_image_type, count,
                  "image" if count == 1 else "images"))
 
-        to_purge = []
-        publish_pending = os.path.join(self.publish_base, "pending")
-        publish_current = os.path.join(self.publish_base, "current")
-
-        for entry in sorted(
-                osextras.listdir_force(self.publish_base), reverse=True):
-            entry_path = os.path.join(self.publish_base, entry)
-
-            # Directory?
-            if not os.path.isdir(entry_path):
-                continue
-
-            # Numeric directory?
-            if not entry[0].isdigit():
-                continue
-
-            image_count += 1
-
-            # Older than cut-off date?
-            # Did we leave enough images already?
-            # In the case where both cut-off date and image count have been
-            # defined, we purge anything that doesn't satisfy both of the above
-            # conditions at once
-            if ((not days or oldest <= int(entry.split(".", 1)[0])) and
-                    (not count or image_count <= count)):
-                continue
-
-            # Pointed to by "pending" or "current" symlink?
-            if (os.path.islink(publish_pending) and
-                    os.readlink(publish_pending) == entry):
-                continue
-            if os.path.islink(publish_current):
-                if os.readlink(publish_current) == entry:
-                    continue
-            elif os.path.isdir(publish_current):
-                found_current = False
-                for current_entry in os.listdir(publish_current):
-                    current_entry_path = os.path.join(
-                        publish_current, current_entry)
-                    if os.path.islink(current_entry_path):
-                        target_bits = os.readlink(
-                            current_entry_path).split(os.sep)
-                        if (len(target_bits) == 3 and
-                                target_bits[0] == os.pardir and
-                                target_bits[1] == entry and
-                                target_bits[2] == current_entry):
-                            found_current = True
-                            break
-                if found_current:
-                    continue
-
-            to_purge.append((entry, entry_path))
-
-        for entry, entry_path in to_purge:
-            if self.config["DEBUG"] or self.config["CDIMAGE_NOPURGE"]:
-                logger.info(
-                    "Would purge %s/%s/%s" %
-                    (project, self.image_type_dir, entry))
-            else:
-                logger.info(
-                    "Purging %s/%s/%s" % (project, self.image_type_dir, entry))
-                if os.path.islink(entry_path):
-                    osextras.unlink_force(entry_path)
-                else:
-                    shutil.rmtree(entry_path)
+        plan = PurgePlan(self.config)
+        for entry, entry_path in purge_candidates(
+                self.publish_base, days=days, count=count):
+            plan.add(
+                "%s/%s/%s" % (project, self.image_type_dir, entry),
+                entry_path)
+        plan.execute(
+            dry_run=bool(
+                self.config["DEBUG"] or self.config["CDIMAGE_NOPURGE"]))
 
 
 class ChinaDailyTree(DailyTree):
@@ -2731,6 +3910,11 @@ class ChinaDailyTree(DailyTree):
     def site_name(self):
         return "china-images.ubuntu.com"
 
+    def split_publish_base(self, relative_path):
+        # Everything here is under a series directory.
+        image_type = "_".join(relative_path.split("/")[1:])
+        return "ubuntu-zh_CN", relative_path, image_type
+
 
 class ChinaDailyTreePublisher(DailyTreePublisher):
     """An object that can publish daily builds of the Chinese edition."""
@@ -2878,6 +4062,40 @@ class PublishReleaseException(Exception):
     pass
 
 
+class ReleaseImageScan:
+    """Everything that publishing a release image needs to read it for.
+
+    A single FanoutReader pass over the daily image computes its checksums,
+    including the SHA-256 digest that the content store files it under,
+    and, if wanted, its zsync metafile and torrent.  Every published copy
+    has the same contents, so the results serve for all of them.
+    """
+
+    def __init__(self, path, zsync=False, torrent=False):
+        self.path = path
+        self.reader = FanoutReader(path)
+        self.hashes = [
+            (name, self.reader.add(name, hash_method()))
+            for name, hash_method in sorted(
+                ChecksumFileSet.checksum_file_methods.items())]
+        self.zsync = None
+        if zsync:
+            self.zsync = self.reader.add(
+                "zsync", ZsyncMetafile(blocksize=ZSYNC_BLOCK_SIZE))
+        self.torrent = None
+        if torrent:
+            self.torrent = self.reader.add(
+                "torrent",
+                TorrentMetafile(piece_length(os.path.getsize(path))))
+        self.checksums = {}
+
+    def run(self):
+        self.reader.run()
+        self.checksums = dict(
+            (name, hash_obj.hexdigest()) for name, hash_obj in self.hashes)
+        remember_digest(self.path, self.checksums["SHA256SUMS"])
+
+
 class ReleasePublisher(Publisher):
     """An object that can publish releases of images.
 
@@ -2887,11 +4105,33 @@ class ReleasePublisher(Publisher):
     torrent_tracker = "https://torrent.ubuntu.com/announce"
     ipv6_torrent_tracker = "https://ipv6.torrent.ubuntu.com/announce"
 
+    release_artifacts = (
+        "iso", "list", "img", "img.gz", "img.xz", "tar.gz", "img.tar.gz",
+        "tar.xz", "bootimg", "custom.tar.gz", "device.tar.gz",
+        "azure.device.tar.gz",
+    )
+    release_kernel_artifacts = (
+        "initrd-ec2", "initrd-virtual", "vmlinuz-ec2", "vmlinuz-virtual",
+    )
+
     def __init__(self, tree, image_type, official, status=None, dry_run=False):
         super(ReleasePublisher, self).__init__(tree, image_type)
         self.official = official
         self.status = status if status else "release"
         self.dry_run = dry_run
+        self.content_store = ContentStore(self.config)
+        # Architectures are published in parallel, and may share checksum
+        # files.
+        self.checksum_lock = threading.Lock()
+        # Set by publish_release if anything was prestaged.
+        self.staging = None
+        # What this publisher has done, or in a dry run would have done.
+        self.cost = PublishCost()
+        # The outputs of the publish_release step running in each thread.
+        self.journal_step = threading.local()
+        # Checksums of published images, keyed by file_key, from the
+        # ReleaseImageScan that read them.
+        self.image_checksums = {}
 
     def daily_dir(self, source, date, publish_type):
         daily_tree = Tree.get_daily(self.config)
@@ -2923,29 +4163,71 @@ class ReleasePublisher(Publisher):
     def torrent_dir(self, source, publish_type):
         raise NotImplementedError
 
-    def make_torrent(self, path):
-        if not self.dry_run:
-            logger.info("Creating torrent for %s ..." % path)
-        osextras.unlink_force("%s.torrent" % path)
-        command = ["btmakemetafile", self.torrent_tracker]
+    @property
+    def torrent_announce_list(self):
         if isinstance(self.tree, SimpleReleaseTree):
+            return [[self.torrent_tracker], [self.ipv6_torrent_tracker]]
+        else:
+            return None
+
+    @property
+    def torrent_comment(self):
+        return "%s CD %s" % (self.config.capproject, self.tree.site_name)
+
+    def torrent_command(self, path):
+        command = ["btmakemetafile", self.torrent_tracker]
+        if self.torrent_announce_list:
             # N.B.: Only the bittornado version of btmakemetafile has
             # the --announce_list flag.
             command.extend([
                 "--announce_list",
-                "%s|%s" % (
-                    self.torrent_tracker, self.ipv6_torrent_tracker),
+                "|".join(
+                    ",".join(tier) for tier in self.torrent_announce_list),
             ])
-        command.extend([
-            "--comment",
-            "%s CD %s" % (self.config.capproject, self.tree.site_name),
-            path,
-        ])
+        command.extend(["--comment", self.torrent_comment, path])
+        return command
+
+    def write_torrent(self, path, metafile=None):
+        """Write path.torrent.
+
+        If metafile is given, it is a TorrentMetafile that has already read
+        path.  Otherwise, use btmakemetafile if it is installed.
+        """
+        if metafile is not None:
+            metafile.write(
+                "%s.torrent" % path, os.path.basename(path),
+                self.torrent_tracker,
+                announce_list=self.torrent_announce_list,
+                comment=self.torrent_comment)
+        elif osextras.find_on_path("btmakemetafile"):
+            with open("/dev/null", "w") as devnull:
+                subprocess.check_call(
+                    self.torrent_command(path), stdout=devnull)
+        else:
+            make_torrent_metafile(
+                path, "%s.torrent" % path, self.torrent_tracker,
+                announce_list=self.torrent_announce_list,
+                comment=self.torrent_comment)
+
+    def make_torrent(self, path, metafile=None):
+        torrent = "%s.torrent" % path
+        staged = self.lookup_staged(os.path.basename(torrent), path)
+        if staged is not None:
+            self.do(
+                "ln -f %s %s" % (staged, torrent),
+                install_file, staged, torrent)
+            self.add_output(torrent)
+            return
+        self.cost.add("torrent", self.cost.size(path))
+        if not self.dry_run:
+            logger.info("Creating torrent for %s ..." % path)
+        osextras.unlink_force(torrent)
         if self.dry_run:
-            logger.info(" ".join(shell_quote(arg) for arg in command))
+            logger.info(" ".join(
+                shell_quote(arg) for arg in self.torrent_command(path)))
         else:
-            with open("/dev/null", "w") as devnull:
-                subprocess.check_call(command, stdout=devnull)
+            self.write_torrent(path, metafile=metafile)
+            self.add_output(torrent)
 
     def make_torrents(self, directory, prefix):
         images = []
@@ -3006,29 +4288,92 @@ class ReleasePublisher(Publisher):
         else:
             func(*args, **kwargs)
 
+    def journaled(self, key, func, args):
+        """Run a step of publish_release, recording it in the journal.
+
+        The files that the step publishes are noted as it goes, so that a
+        later attempt can tell whether they are still in place.
+        """
+        if self.journal.completed(key):
+            logger.info("Skipping %s (already done)" % key)
+            return
+        self.journal_step.outputs = []
+        self.journal_step.requires = []
+        try:
+            func(*args)
+            self.journal.record(
+                key, outputs=self.journal_step.outputs,
+                requires=self.journal_step.requires)
+        finally:
+            self.journal_step.outputs = None
+            self.journal_step.requires = None
+
+    def add_output(self, path):
+        outputs = getattr(self.journal_step, "outputs", None)
+        if outputs is not None:
+            outputs.append(path)
+
+    def add_requirement(self, key):
+        requires = getattr(self.journal_step, "requires", None)
+        if requires is not None:
+            requires.append(key)
+
     def remove_checksum(self, directory, name):
         if self.dry_run:
             logger.info("checksum-remove --no-sign %s %s" % (directory, name))
         else:
-            with ChecksumFileSet(self.config, directory, sign=False) as files:
-                files.remove(name)
+            with self.checksum_lock:
+                with ChecksumFileSet(
+                        self.config, directory, sign=False) as files:
+                    files.remove(name)
 
     def copy(self, source, target):
-        self.do("cp -a %s %s" % (source, target), shutil.copy2, source, target)
+        size = self.cost.size(source)
+        self.cost.record_size(target, size)
+        staged = self.lookup_staged(os.path.basename(target), source)
+        if staged is not None:
+            self.cost.add("linked", size)
+            self.do(
+                "ln -f %s %s" % (staged, target), install_file, staged, target)
+            self.add_output(target)
+            self.remove_checksum(
+                os.path.dirname(target), os.path.basename(target))
+            return
+        # Every published copy of the same contents shares one inode, so
+        # only the first copy of each source is hashed and written, and
+        # then only if it was not already published.
+        if not self.cost.first_digest(source):
+            self.cost.add("linked", size)
+        else:
+            self.cost.add("hashed", size)
+            if os.path.isfile(target) and os.path.getsize(target) == size:
+                self.cost.add("linked", size)
+            else:
+                self.cost.add("copied", size)
+        self.do(
+            "cp -a %s %s" % (source, target),
+            self.content_store.link, source, target)
+        self.add_output(target)
         self.remove_checksum(os.path.dirname(target), os.path.basename(target))
 
     def symlink(self, source, link_name):
+        self.cost.record_size(link_name, self.cost.size(source))
         relpath = os.path.relpath(source, os.path.dirname(link_name))
         self.do(
             "ln -sf %s %s" % (relpath, link_name),
             osextras.symlink_force, relpath, link_name)
+        self.add_output(link_name)
         self.remove_checksum(
             os.path.dirname(link_name), os.path.basename(link_name))
 
     def hardlink(self, source, link_name):
+        size = self.cost.size(source)
+        self.cost.record_size(link_name, size)
+        self.cost.add("linked", size)
         self.do(
             "ln -f %s %s" % (source, link_name),
             osextras.link_force, source, link_name)
+        self.add_output(link_name)
 
     def remove(self, path):
         self.do("rm -f %s" % path, osextras.unlink_force, path)
@@ -3042,9 +4387,9 @@ class ReleasePublisher(Publisher):
             return
         source_pat = "=%s" % os.path.basename(source).rsplit(".", 1)[0]
         target_pat = "=%s" % os.path.basename(target).rsplit(".", 1)[0]
-        with open(source) as sf, open(target, "w") as tf:
-            for line in sf:
-                tf.write(line.replace(source_pat, target_pat))
+        replaced = rewrite_jigdo(source, target, source_pat, target_pat)
+        self.add_output(target)
+        return replaced
 
     def mkemptydir(self, path):
         if self.dry_run:
@@ -3053,15 +4398,49 @@ class ReleasePublisher(Publisher):
         else:
             osextras.mkemptydir(path)
 
+    def make_zsync(self, infile, outfile, url, dry_run=False, metafile=None):
+        """Make a zsync metafile for infile.
+
+        If metafile is given, it is a ZsyncMetafile that has already read
+        infile, so it is written out now; otherwise, the metafile is made
+        in the background.
+        """
+        staged = self.lookup_staged(os.path.basename(outfile), infile)
+        if staged is not None:
+            self.do(
+                "ln -f %s %s" % (staged, outfile),
+                install_file, staged, outfile)
+            self.add_output(outfile)
+        elif metafile is not None:
+            self.cost.add("zsync", self.cost.size(infile))
+            metafile.write(
+                outfile, os.path.basename(infile), url,
+                mtime=int(os.stat(infile).st_mtime))
+            self.add_output(outfile)
+        else:
+            self.add_requirement("zsync %s" % outfile)
+            self.cost.add("zsync", self.cost.size(infile))
+            super(ReleasePublisher, self).make_zsync(
+                infile, outfile, url, dry_run=dry_run)
+
+    def count_signatures(self, count):
+        # Don't call can_sign here; it warns if there are no keys, and the
+        # checksum code will do that anyway.
+        if self.config["SIGNING_KEYID"]:
+            self.cost.add("signed", count)
+
     def checksum_directory(self, dirs, map_expr=None):
+        self.count_signatures(len(ChecksumFileSet.checksum_file_methods))
         self.do(
             "checksum-directory %s%s" % (
                 "--map %s " % map_expr if map_expr else "",
                 " ".join(dirs)),
             checksum_directory,
-            self.config, dirs[0], old_directories=dirs, map_expr=map_expr)
+            self.config, dirs[0], old_directories=dirs, map_expr=map_expr,
+            known=self.image_checksums)
 
     def metalink_checksum_directory(self, dirs):
+        self.count_signatures(1)
         self.do(
             "checksum-directory --metalink %s" % " ".join(dirs),
             metalink_checksum_directory,
@@ -3096,11 +4475,28 @@ class ReleasePublisher(Publisher):
         else:
             return True
 
+    def share_zsync_read(self):
+        """Return true if zsync metafiles can be made in a ReleaseImageScan.
+
+        Only the native writer can share a read with the checksums, and
+        without MD4 from hashlib it is too slow to prefer over zsyncmake,
+        which then reads the image separately.
+        """
+        return self.can_make_zsync() and (
+            md4_is_native() or not osextras.find_on_path("zsyncmake"))
+
+    def scan_release_image(self, path, zsync=False, torrent=False):
+        """Read path once for its checksums, zsync metafile, and torrent."""
+        scan = ReleaseImageScan(path, zsync=zsync, torrent=torrent)
+        scan.run()
+        return scan
+
     def publish_release_arch(self, source, date, publish_type, arch):
         """Publish release images for a single architecture."""
         logger.info("Copying %s-%s image ..." % (publish_type, arch))
 
         base = self.daily_base(source, date, publish_type, arch)
+        daily_index = self.artifact_index(os.path.dirname(base))
         prefix, prefix_status = self.publish_release_prefixes()
         base_plain = "%s-%s-%s" % (prefix, publish_type, arch)
         base_status = "%s-%s-%s" % (prefix_status, publish_type, arch)
@@ -3134,17 +4530,35 @@ class ReleasePublisher(Publisher):
 
         for ext in ("iso", "img", "img.gz", "img.xz", "tar.gz", "img.tar.gz",
                     "tar.xz"):
-            if os.path.exists(daily(ext)):
+            if daily_index.exists(daily(ext)):
                 break
         else:
             return
 
+        # Read each image that was not prestaged just once, for its
+        # checksums and for the zsync metafile and torrent made from it.
+        zsync_scanned = self.share_zsync_read() and (
+            self.want_pool or (self.want_full and self.official == "named"))
+        scans = {}
+        for ext in "iso", "img", "img.gz", "img.xz", "tar.gz":
+            if self.dry_run or not daily_index.exists(daily(ext)):
+                continue
+            published = pool(ext) if self.want_pool else full(ext)
+            if self.lookup_staged(
+                    os.path.basename(published), daily(ext)) is not None:
+                continue
+            scans[ext] = self.scan_release_image(
+                daily(ext),
+                zsync=(
+                    zsync_scanned and
+                    daily_index.exists(daily("%s.zsync" % ext))),
+                torrent=(
+                    self.want_torrent(publish_type) and
+                    ext in ("iso", "img")))
+
         # Copy, to make sure we have a canonical version of this.
-        artifacts = ["iso", "list", "img", "img.gz", "img.xz", "tar.gz",
-                     "img.tar.gz", "tar.xz", "bootimg", "custom.tar.gz",
-                     "device.tar.gz", "azure.device.tar.gz"]
-        for ext in artifacts:
-            if not os.path.exists(daily(ext)):
+        for ext in self.release_artifacts:
+            if not daily_index.exists(daily(ext)):
                 continue
             if self.want_pool:
                 self.copy(daily(ext), pool(ext))
@@ -3152,11 +4566,16 @@ class ReleasePublisher(Publisher):
                 self.symlink(pool(ext), dist(ext))
             if self.want_full:
                 self.copy(daily(ext), full(ext))
-
-        for ext in (
-            "initrd-ec2", "initrd-virtual", "vmlinuz-ec2", "vmlinuz-virtual",
-        ):
-            if not os.path.exists(daily(ext, "-")):
+            if ext in scans:
+                for published in (
+                        pool(ext) if self.want_pool else None,
+                        full(ext) if self.want_full else None):
+                    if published is not None:
+                        self.image_checksums[file_key(published)] = (
+                            scans[ext].checksums)
+
+        for ext in self.release_kernel_artifacts:
+            if not daily_index.exists(daily(ext, "-")):
                 continue
             if self.want_pool:
                 self.copy(daily(ext, "-"), pool(ext, "-"))
@@ -3166,7 +4585,7 @@ class ReleasePublisher(Publisher):
                 self.copy(daily(ext, "-"), full(ext, "-"))
 
         for ext in ("kernel-info.txt", ):
-            if not os.path.exists(daily(ext, "-")):
+            if not daily_index.exists(daily(ext, "-")):
                 continue
             if self.want_dist:
                 self.copy(daily(ext, "-"), dist(ext, "-"))
@@ -3176,8 +4595,8 @@ class ReleasePublisher(Publisher):
         if publish_type in (
             "install", "alternate", "server", "serveraddon", "addon", "src",
         ):
-            if (os.path.exists(daily("jigdo")) and
-                    os.path.exists(daily("template"))):
+            if (daily_index.exists(daily("jigdo")) and
+                    daily_index.exists(daily("template"))):
                 if self.want_pool:
                     self.copy(daily("template"), pool("template"))
                     self.copy_jigdo(daily("jigdo"), pool("jigdo"))
@@ -3209,22 +4628,23 @@ class ReleasePublisher(Publisher):
 
         for ext in "iso", "img", "img.gz", "img.xz", "tar.gz":
             zsyncext = "%s.zsync" % ext
-            if not os.path.exists(daily(zsyncext)):
+            if not daily_index.exists(daily(zsyncext)):
                 continue
+            metafile = getattr(scans.get(ext), "zsync", None)
             if self.want_pool:
-                if osextras.find_on_path("zsyncmake"):
+                if self.can_make_zsync():
                     logger.info("Making %s zsync metafile ..." % arch)
                     self.remove(pool(zsyncext))
-                    zsyncmake(
+                    self.make_zsync(
                         pool(ext), pool(zsyncext), os.path.basename(pool(ext)),
-                        dry_run=self.dry_run)
+                        dry_run=self.dry_run, metafile=metafile)
             elif self.want_full and self.official == "named":
-                if osextras.find_on_path("zsyncmake"):
+                if self.can_make_zsync():
                     logger.info("Making %s zsync metafile ..." % arch)
                     self.remove(full(zsyncext))
-                    zsyncmake(
+                    self.make_zsync(
                         full(ext), full(zsyncext), os.path.basename(full(ext)),
-                        dry_run=self.dry_run)
+                        dry_run=self.dry_run, metafile=metafile)
             elif self.want_full:
                 self.copy(daily(zsyncext), full(zsyncext))
             if self.want_dist:
@@ -3235,24 +4655,291 @@ class ReleasePublisher(Publisher):
             assert self.want_dist != self.want_full
             for ext in "iso", "img":
                 torrentext = "%s.torrent" % ext
+                metafile = getattr(scans.get(ext), "torrent", None)
                 if self.want_dist:
-                    if os.path.exists(dist(ext)):
-                        self.make_torrent(dist(ext))
-                    if os.path.exists(pool(ext)):
+                    if self.cost.exists(dist(ext)):
+                        self.make_torrent(dist(ext), metafile=metafile)
+                    if self.cost.exists(pool(ext)):
                         self.hardlink(pool(ext), torrent(ext))
                         self.hardlink(dist(torrentext), torrent(torrentext))
                 else:
-                    if os.path.exists(full(ext)):
-                        self.make_torrent(full(ext))
-                    if os.path.exists(full(ext)):
+                    if self.cost.exists(full(ext)):
+                        self.make_torrent(full(ext), metafile=metafile)
+                    if self.cost.exists(full(ext)):
                         self.hardlink(full(ext), torrent(ext))
                         self.hardlink(full(torrentext), torrent(torrentext))
 
-    def publish_release(self, source, date, publish_type):
-        """Publish a daily build as a release."""
-        series = self.config["DIST"]
-        arches = self.config.arches
+    def release_arch_files(self, source, date, publish_type, arch):
+        """Yield (ext, separator) for each large file published for arch.
+
+        Only files that exist in the daily build are included.
+        """
+        base = self.daily_base(source, date, publish_type, arch)
+        daily_index = self.artifact_index(os.path.dirname(base))
+        available = daily_index.suffixes(os.path.basename(base))
+        exts = [(ext, ".") for ext in self.release_artifacts]
+        exts.extend((ext, "-") for ext in self.release_kernel_artifacts)
+        exts.extend((ext, ".") for ext in ("template", "manifest"))
+        for ext, sep in exts:
+            if ("%s%s" % (sep, ext) in available and
+                    daily_index.exists("%s%s%s" % (base, sep, ext))):
+                yield ext, sep
+
+    def release_arch_size(self, source, date, publish_type, arch):
+        """Estimate the bytes publish_release_arch will copy for arch."""
+        base = self.daily_base(source, date, publish_type, arch)
+        return sum(
+            os.path.getsize("%s%s%s" % (base, sep, ext))
+            for ext, sep in self.release_arch_files(
+                source, date, publish_type, arch))
+
+    @property
+    def history_path(self):
+        return os.path.join(
+            self.config.root, "log", "publish-release.history")
+
+    def staging_area(self, publish_type):
+        return StagingArea(os.path.join(
+            self.config.root, "www", ".staging", self.project,
+            self.config.series, publish_type, self.official, self.status))
+
+    def lookup_staged(self, name, source):
+        """Return a prestaged copy of name made from source, if any."""
+        if self.staging is None:
+            return None
+        return self.staging.lookup(name, source)
+
+    def stage_copy(self, staging, source, name):
+        install_file(self.content_store.add(source), staging.path(name))
+        staging.record(name, source)
+
+    def stage_zsync(self, staging, name, url, metafile=None):
+        image = staging.path(name)
+        if metafile is not None:
+            metafile.write(
+                "%s.zsync" % image, name, url,
+                mtime=int(os.stat(image).st_mtime))
+        else:
+            zsyncmake(image, "%s.zsync" % image, url)
+        staging.record("%s.zsync" % name, image)
+
+    def stage_torrent(self, staging, name, metafile=None):
+        image = staging.path(name)
+        osextras.unlink_force("%s.torrent" % image)
+        self.write_torrent(image, metafile=metafile)
+        staging.record("%s.torrent" % name, image)
+
+    def prestage_release_arch(self, staging, source, date, publish_type,
+                              arch):
+        """Stage release images for a single architecture."""
+        logger.info("Staging %s-%s image ..." % (publish_type, arch))
+
+        base = self.daily_base(source, date, publish_type, arch)
+        daily_index = self.artifact_index(os.path.dirname(base))
         prefix, prefix_status = self.publish_release_prefixes()
+        if self.want_pool:
+            staged_base = "%s-%s-%s" % (prefix_status, publish_type, arch)
+        else:
+            staged_base = "%s-%s-%s" % (prefix, publish_type, arch)
+
+        def daily(ext, sep="."):
+            return "%s%s%s" % (base, sep, ext)
+
+        def staged(ext, sep="."):
+            return "%s%s%s" % (staged_base, sep, ext)
+
+        want_zsync = self.can_make_zsync() and (
+            self.want_pool or (self.want_full and self.official == "named"))
+
+        # Read each image that needs staging just once, as
+        # publish_release_arch does.
+        scans = {}
+        for ext in "iso", "img", "img.gz", "img.xz", "tar.gz":
+            if (self.dry_run or
+                    not daily_index.exists(daily(ext)) or
+                    staging.lookup(staged(ext), daily(ext)) is not None):
+                continue
+            scans[ext] = self.scan_release_image(
+                daily(ext),
+                zsync=(
+                    want_zsync and self.share_zsync_read() and
+                    daily_index.exists(daily("%s.zsync" % ext))),
+                torrent=(
+                    self.want_torrent(publish_type) and
+                    ext in ("iso", "img")))
+
+        for ext, sep in self.release_arch_files(
+                source, date, publish_type, arch):
+            if staging.lookup(staged(ext, sep), daily(ext, sep)) is None:
+                self.do(
+                    "cp -a %s %s" % (
+                        daily(ext, sep), staging.path(staged(ext, sep))),
+                    self.stage_copy,
+                    staging, daily(ext, sep), staged(ext, sep))
+
+        if want_zsync:
+            for ext in "iso", "img", "img.gz", "img.xz", "tar.gz":
+                zsyncext = "%s.zsync" % ext
+                if (daily_index.exists(daily(zsyncext)) and
+                        daily_index.exists(daily(ext)) and
+                        staging.lookup(
+                            staged(zsyncext),
+                            staging.path(staged(ext))) is None):
+                    self.do(
+                        "zsyncmake -o %s -u %s %s" % (
+                            staging.path(staged(zsyncext)), staged(ext),
+                            staging.path(staged(ext))),
+                        self.stage_zsync, staging, staged(ext), staged(ext),
+                        metafile=getattr(scans.get(ext), "zsync", None))
+
+        if self.want_torrent(publish_type):
+            for ext in "iso", "img":
+                torrentext = "%s.torrent" % ext
+                if (daily_index.exists(daily(ext)) and
+                        staging.lookup(
+                            staged(torrentext),
+                            staging.path(staged(ext))) is None):
+                    self.do(
+                        " ".join(
+                            shell_quote(arg) for arg in self.torrent_command(
+                                staging.path(staged(ext)))),
+                        self.stage_torrent, staging, staged(ext),
+                        metafile=getattr(scans.get(ext), "torrent", None))
+
+    def purge_superseded(self, purge_dirs, prefix, prefix_status):
+        """Remove images for earlier milestones of this release."""
+        for purge_dir in purge_dirs:
+            for entry in osextras.listdir_force(purge_dir):
+                if not entry.startswith("%s-" % prefix):
+                    continue
+                # TODO: This test is wrong, but cumbersome to fix.  For
+                # example, consider the existence of
+                # ubuntu-13.04-beta2-preinstalled-desktop-armhf+omap4.img
+                # while publishing ubuntu-13.04.
+                if entry.startswith("%s-" % prefix_status):
+                    continue
+                entry_path = os.path.join(purge_dir, entry)
+                logger.info("Purging %s" % entry_path)
+                self.remove(entry_path)
+
+    def copy_build_information(self, daily_dir, target_dir):
+        for name in (
+            "published-ec2-release.txt", "tool-version-info.txt",
+            "build-info.txt",
+        ):
+            path = os.path.join(daily_dir, name)
+            if not os.path.exists(path):
+                continue
+            if self.want_dist or self.want_full:
+                self.copy(path, os.path.join(target_dir, name))
+
+    def add_outputs(self, directory, names):
+        """Note those of names in directory as outputs of this step."""
+        for name in names:
+            path = os.path.join(directory, name)
+            if os.path.lexists(path):
+                self.add_output(path)
+
+    def publish_web_indices(self, target_dir, prefix, prefix_status):
+        self.wait_for_zsync()
+        if self.want_dist:
+            self.do(
+                "make-web-indices %s %s" % (target_dir, prefix_status),
+                self.make_web_indices, target_dir, prefix_status)
+        if self.want_full:
+            self.do(
+                "make-web-indices %s %s" % (target_dir, prefix),
+                self.make_web_indices, target_dir, prefix)
+        self.add_outputs(
+            target_dir, ["HEADER.html", "FOOTER.html", ".htaccess"])
+
+    def checksum_tree(self, message, dirs, map_expr):
+        logger.info(message)
+        self.checksum_directory(dirs, map_expr=map_expr)
+        self.add_outputs(dirs[0], [
+            "%s%s" % (name, suffix)
+            for name in sorted(ChecksumFileSet.checksum_file_methods)
+            for suffix in ("", ".gpg")])
+
+    def publish_metalink(self, message, directory, version):
+        logger.info(message)
+        self.make_metalink(directory, version, dry_run=self.dry_run)
+        self.add_outputs(directory, [
+            name for name in sorted(osextras.listdir_force(directory))
+            if name.startswith("MD5SUMS-metalink") or
+            name.endswith(".metalink") or name.endswith(".meta4")])
+
+    def update_site_manifest(self):
+        if self.dry_run:
+            logger.info("site-manifest %s .manifest" % self.tree.directory)
+            return
+        manifest_path = os.path.join(self.tree.directory, ".manifest")
+        with AtomicFile(manifest_path, only_if_changed=True) as manifest:
+            for line in self.tree.manifest():
+                print(line, file=manifest)
+        os.chmod(
+            manifest_path, os.stat(manifest_path).st_mode | stat.S_IWGRP)
+        self.add_output(manifest_path)
+
+        # Create timestamps for this run.
+        trace_dir = os.path.join(self.tree.directory, ".trace")
+        osextras.ensuredir(trace_dir)
+        fqdn = socket.getfqdn()
+        with open(os.path.join(trace_dir, fqdn), "w") as trace:
+            subprocess.check_call(["date", "-u"], stdout=trace)
+
+    def release_trees(self, source, publish_type, target_dir):
+        """Return the directories that prepare_release_trees creates."""
+        trees = []
+        if self.want_pool:
+            trees.append(self.pool_dir(source))
+        if self.want_dist or self.want_full:
+            trees.append(target_dir)
+        if self.want_torrent(publish_type):
+            trees.append(self.torrent_dir(source, publish_type))
+        return trees
+
+    def prepare_release_trees(self, source, publish_type, target_dir, prefix):
+        """Create the release trees, clearing out what is to be replaced."""
+        series = self.config["DIST"]
+        if self.want_pool:
+            pool_dir = self.pool_dir(source)
+            self.do("mkdir -p %s" % pool_dir, osextras.ensuredir, pool_dir)
+        if self.want_dist or self.want_full:
+            self.do("mkdir -p %s" % target_dir, osextras.ensuredir, target_dir)
+            if series.name != series.version:
+                version_link = self.version_link(source)
+                if not os.path.islink(version_link):
+                    self.do(
+                        "ln -ns %s %s" % (series, version_link),
+                        os.symlink, series.name, version_link)
+        if self.want_dist and not self.config["CDIMAGE_NO_PURGE"]:
+            entries = osextras.listdir_force(target_dir)
+            for entry in entries:
+                if not entry.startswith("%s-%s-" % (prefix, publish_type)):
+                    continue
+                entry_path = os.path.join(target_dir, entry)
+                if os.path.islink(entry_path):
+                    self.remove(entry_path)
+
+        if self.want_torrent(publish_type):
+            # Prepare torrent trees for publication.
+            torrent_dir = self.torrent_dir(source, publish_type)
+            if self.want_dist:
+                if not self.config["CDIMAGE_NO_PURGE"]:
+                    self.mkemptydir(torrent_dir)
+            if self.want_full:
+                torrent_releases_dir = os.path.dirname(
+                    os.path.dirname(torrent_dir))
+                for entry in osextras.listdir_force(torrent_releases_dir):
+                    entry_path = os.path.join(torrent_releases_dir, entry)
+                    if entry != self.status and os.path.isdir(entry_path):
+                        self.remove_tree(entry_path)
+                self.mkemptydir(torrent_dir)
+
+    def release_source(self, source):
+        """Return the daily tree path to publish source from."""
+        series = self.config["DIST"]
 
         # Do what I mean.
         if source.endswith("/source"):
@@ -3271,10 +4958,12 @@ class ReleasePublisher(Publisher):
             else:
                 source = os.path.join(series.full_name, source)
 
-        daily_dir = self.daily_dir(source, date, publish_type)
-        target_dir = self.target_dir(source, date, publish_type)
-        if not self.want_full:
-            pool_dir = self.pool_dir(source)
+        return source
+
+    def release_arches(self, daily_dir, date, publish_type):
+        """Return the architectures to publish from daily_dir."""
+        series = self.config["DIST"]
+        arches = self.config.arches
 
         if publish_type == "src":
             # Perverse, but works.
@@ -3290,8 +4979,63 @@ class ReleasePublisher(Publisher):
                 not [arch for arch in arches if arch.startswith("armel")]):
             arches = ["i386"]
 
+        return arches
+
+    def prestage_release(self, source, date, publish_type):
+        """Prepare a daily build for publication as a release.
+
+        The images, zsync metafiles, and torrents that publish_release
+        would make are made now in a staging area, so that publishing the
+        same daily build later on only needs to link them into place.
+        """
+        source = self.release_source(source)
+        daily_dir = self.daily_dir(source, date, publish_type)
+        arches = self.release_arches(daily_dir, date, publish_type)
+        staging = self.staging_area(publish_type)
+
+        plan = Plan()
+        for arch in arches:
+            plan.add(
+                "stage %s-%s" % (publish_type, arch),
+                self.prestage_release_arch,
+                (staging, source, date, publish_type, arch),
+                size=self.release_arch_size(source, date, publish_type, arch))
+
+        if self.dry_run:
+            logger.info("mkdir -p %s" % staging.directory)
+            logger.info(
+                "Estimated %.1f MiB to copy" % (plan.size / 1024.0 / 1024.0))
+            plan.run(jobs=1)
+        else:
+            osextras.ensuredir(staging.directory)
+            try:
+                plan.run(jobs=job_count(self.config))
+            finally:
+                staging.write()
+
+        logger.info(
+            "Staged in %s; publish-release will use this if the daily build "
+            "is unchanged." % staging.directory)
+
+    def publish_release(self, source, date, publish_type):
+        """Publish a daily build as a release."""
+        series = self.config["DIST"]
+        prefix, prefix_status = self.publish_release_prefixes()
+        source = self.release_source(source)
+
+        daily_dir = self.daily_dir(source, date, publish_type)
+        target_dir = self.target_dir(source, date, publish_type)
+        if not self.want_full:
+            pool_dir = self.pool_dir(source)
+        arches = self.release_arches(daily_dir, date, publish_type)
+
+        staging = self.staging_area(publish_type)
+        if os.path.isdir(staging.directory):
+            self.staging = staging
+
         # Sanity-check.
         if publish_type not in ("netbook", "src"):
+            daily_index = self.artifact_index(daily_dir)
             for arch in arches:
                 paths = []
                 for ext in ("iso", "img", "img.gz", "img.xz", "img.tar.gz",
@@ -3301,7 +5045,7 @@ class ReleasePublisher(Publisher):
                         "%s-%s-%s.%s" % (series, publish_type, arch, ext)))
                 paths.append(os.path.join(daily_dir, "%s.tar.xz" % arch))
                 for path in paths:
-                    if os.path.exists(path):
+                    if daily_index.exists(path):
                         break
                 else:
                     raise PublishReleaseException(
@@ -3310,144 +5054,145 @@ class ReleasePublisher(Publisher):
                 oversized_path = os.path.join(
                     daily_dir,
                     "%s-%s-%s.OVERSIZED" % (series, publish_type, arch))
-                if os.path.exists(oversized_path):
+                if daily_index.exists(oversized_path):
                     yesno = input(
                         "Daily for %s %s on %s is oversized!  "
                         "Continue? [yN] " % (series, arch, date))
                     if not yesno.lower().startswith("y"):
                         sys.exit(1)
 
-        if self.want_pool:
-            self.do("mkdir -p %s" % pool_dir, osextras.ensuredir, pool_dir)
-        if self.want_dist or self.want_full:
-            self.do("mkdir -p %s" % target_dir, osextras.ensuredir, target_dir)
-            if series.name != series.version:
-                version_link = self.version_link(source)
-                if not os.path.islink(version_link):
-                    self.do(
-                        "ln -ns %s %s" % (series, version_link),
-                        os.symlink, series.name, version_link)
-        if self.want_dist and not self.config["CDIMAGE_NO_PURGE"]:
-            entries = osextras.listdir_force(target_dir)
-            for entry in entries:
-                if not entry.startswith("%s-%s-" % (prefix, publish_type)):
-                    continue
-                entry_path = os.path.join(target_dir, entry)
-                if os.path.islink(entry_path):
-                    self.remove(entry_path)
-
-        if self.want_torrent(publish_type):
-            # Prepare torrent trees for publication.
-            torrent_dir = self.torrent_dir(source, publish_type)
-            if self.want_dist:
-                if not self.config["CDIMAGE_NO_PURGE"]:
-                    self.mkemptydir(torrent_dir)
-            if self.want_full:
-                torrent_releases_dir = os.path.dirname(
-                    os.path.dirname(torrent_dir))
-                for entry in osextras.listdir_force(torrent_releases_dir):
-                    entry_path = os.path.join(torrent_releases_dir, entry)
-                    if entry != self.status and os.path.isdir(entry_path):
-                        self.remove_tree(entry_path)
-                self.mkemptydir(torrent_dir)
+        if self.dry_run:
+            self.journal = None
+        else:
+            self.journal = PublishJournal(journal_path(
+                self.config,
+                target_dir if self.want_dist or self.want_full else pool_dir,
+                name="publish-%s" % publish_type))
+            if self.journal.resuming:
+                logger.info(
+                    "Resuming interrupted publication of %s-%s ..." %
+                    (prefix_status, publish_type))
+        self.journal_run(
+            "prepare release trees", self.prepare_release_trees,
+            source, publish_type, target_dir, prefix,
+            outputs=lambda: self.release_trees(
+                source, publish_type, target_dir))
 
         logger.info("Constructing release trees ...")
-        for arch in arches:
-            self.publish_release_arch(source, date, publish_type, arch)
+        plan = Plan()
+        published = [
+            plan.add(
+                "publish %s-%s" % (publish_type, arch),
+                self.publish_release_arch,
+                (source, date, publish_type, arch),
+                size=self.release_arch_size(source, date, publish_type, arch))
+            for arch in arches]
+        last = published
 
         # There can only be one set of images per release in the per-release
         # tree, so if we're publishing there then we can now safely clean up
         # previous images for that release.
         if self.want_dist and not self.config["CDIMAGE_NO_PURGE"]:
-            for purge_dir in target_dir, pool_dir:
-                for entry in os.listdir(purge_dir):
-                    if not entry.startswith("%s-" % prefix):
-                        continue
-                    # TODO: This test is wrong, but cumbersome to fix.  For
-                    # example, consider the existence of
-                    # ubuntu-13.04-beta2-preinstalled-desktop-armhf+omap4.img
-                    # while publishing ubuntu-13.04.
-                    if entry.startswith("%s-" % prefix_status):
-                        continue
-                    entry_path = os.path.join(purge_dir, entry)
-                    logger.info("Purging %s" % entry_path)
-                    self.remove(entry_path)
+            last = [plan.add(
+                "purge superseded images", self.purge_superseded,
+                ([target_dir, pool_dir], prefix, prefix_status), after=last)]
 
         if publish_type in ("uec", "server-uec"):
-            for name in (
-                "published-ec2-release.txt", "tool-version-info.txt",
-                "build-info.txt",
-            ):
-                path = os.path.join(daily_dir, name)
-                if not os.path.exists(path):
-                    continue
-                if self.want_dist or self.want_full:
-                    self.copy(path, os.path.join(target_dir, name))
+            last = [plan.add(
+                "copy build information", self.copy_build_information,
+                (daily_dir, target_dir), after=last)]
 
-        if self.want_dist:
-            self.do(
-                "make-web-indices %s %s" % (target_dir, prefix_status),
-                self.make_web_indices, target_dir, prefix_status)
-        if self.want_full:
-            self.do(
-                "make-web-indices %s %s" % (target_dir, prefix),
-                self.make_web_indices, target_dir, prefix)
+        # The indices describe zsync metafiles, so they must all exist now.
+        indexed = plan.add(
+            "zsync metafiles and web indices", self.publish_web_indices,
+            (target_dir, prefix, prefix_status), after=last)
+        finished = [indexed]
 
         if self.want_pool:
-            logger.info("Checksumming simple tree (pool) ...")
-            self.checksum_directory(
-                [pool_dir, daily_dir],
-                map_expr="s/^%s-/%s-/" % (prefix_status, series))
+            finished.append(plan.add(
+                "checksum simple tree (pool)", self.checksum_tree,
+                ("Checksumming simple tree (pool) ...",
+                 [pool_dir, daily_dir],
+                 "s/^%s-/%s-/" % (prefix_status, series)),
+                after=last))
         if self.want_dist:
-            logger.info("Checksumming simple tree (%s) ..." % series)
-            self.checksum_directory(
-                [target_dir, daily_dir],
-                map_expr="s/^%s-/%s-/" % (prefix_status, series))
+            checksummed = plan.add(
+                "checksum simple tree (%s)" % series, self.checksum_tree,
+                ("Checksumming simple tree (%s) ..." % series,
+                 [target_dir, daily_dir],
+                 "s/^%s-/%s-/" % (prefix_status, series)),
+                after=last)
+            finished.append(checksummed)
             if self.want_metalink(publish_type):
-                logger.info(
-                    "Creating and publishing metalink files for the simple "
-                    "tree (%s) ..." % series)
-                self.make_metalink(
-                    target_dir, self.metalink_version, dry_run=self.dry_run)
+                finished.append(plan.add(
+                    "metalink simple tree (%s)" % series,
+                    self.publish_metalink,
+                    ("Creating and publishing metalink files for the simple "
+                     "tree (%s) ..." % series,
+                     target_dir, self.metalink_version),
+                    after=[checksummed, indexed]))
         if self.want_full:
-            logger.info("Checksumming full tree ...")
-            self.checksum_directory(
-                [target_dir, daily_dir],
-                map_expr="s/^%s-/%s-/" % (prefix, series))
+            checksummed = plan.add(
+                "checksum full tree", self.checksum_tree,
+                ("Checksumming full tree ...",
+                 [target_dir, daily_dir],
+                 "s/^%s-/%s-/" % (prefix, series)),
+                after=last)
+            finished.append(checksummed)
             if self.want_metalink(publish_type):
-                logger.info(
-                    "Creating and publishing metalink files for the full "
-                    "tree ...")
                 if self.official == "named":
                     metalink_target_dir = os.path.join(
                         self.tree.publish_target(source), "releases",
                         self.full_version, self.status)
                 else:
                     metalink_target_dir = target_dir
-                self.make_metalink(
-                    metalink_target_dir, self.version, dry_run=self.dry_run)
+                finished.append(plan.add(
+                    "metalink full tree", self.publish_metalink,
+                    ("Creating and publishing metalink files for the full "
+                     "tree ...",
+                     metalink_target_dir, self.version),
+                    after=[checksummed, indexed]))
 
         if self.want_dist or self.want_pool:
-            if self.dry_run:
-                logger.info("site-manifest %s .manifest" % self.tree.directory)
+            plan.add(
+                "site manifest", self.update_site_manifest, after=finished)
+
+        history = PublishHistory(self.history_path)
+        if self.journal is not None:
+            for op in plan.operations:
+                op.func, op.args = self.journaled, (op.label, op.func, op.args)
+
+        if self.dry_run:
+            logger.info("Publication plan:")
+            for line in plan.describe():
+                logger.info("  %s" % line)
+            logger.info(
+                "Estimated %.1f MiB to copy" % (plan.size / 1024.0 / 1024.0))
+            # Show the individual commands in the order they would run.
+            plan.run(jobs=1)
+            logger.info("Estimated cost:")
+            for line in self.cost.describe():
+                logger.info("  %s" % line)
+            predicted = history.predict(self.cost)
+            if predicted is None:
+                logger.info("No publication history to predict time from")
             else:
-                manifest_path = os.path.join(self.tree.directory, ".manifest")
-                with AtomicFile(manifest_path) as manifest:
-                    for line in self.tree.manifest():
-                        print(line, file=manifest)
-                os.chmod(
-                    manifest_path,
-                    os.stat(manifest_path).st_mode | stat.S_IWGRP)
-
-                # Create timestamps for this run.
-                if self.dry_run:
-                    logger.info("Would create trace file")
-                else:
-                    trace_dir = os.path.join(self.tree.directory, ".trace")
-                    osextras.ensuredir(trace_dir)
-                    fqdn = socket.getfqdn()
-                    with open(os.path.join(trace_dir, fqdn), "w") as trace:
-                        subprocess.check_call(["date", "-u"], stdout=trace)
+                count = len(history.entries())
+                logger.info(
+                    "Predicted time: %d:%02d:%02d (from %d recent "
+                    "publication%s)" % (
+                        predicted // 3600, predicted // 60 % 60,
+                        predicted % 60, count, "" if count == 1 else "s"))
+        else:
+            start = time.time()
+            plan.run(jobs=job_count(self.config))
+            if self.staging is not None:
+                shutil.rmtree(self.staging.directory)
+                self.staging = None
+            self.content_store.prune()
+            self.journal.remove()
+            self.journal = None
+            history.record(self.cost, time.time() - start)
 
         logger.info(
             "Done!  Remember to sync-mirrors after checking that everything "
@@ -0,0 +1,241 @@
+# Copyright (C) 2019 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Native generation of zsync metafiles.
+
+The output is byte-for-byte identical to that of "zsyncmake -Z" from zsync
+0.6.2: compressed input files are treated as opaque data.
+"""
+
+import hashlib
+import math
+import os
+import struct
+import time
+import zlib
+
+from cdimage.fanout import FanoutReader
+
+__metaclass__ = type
+
+
+zsync_version = "0.6.2"
+
+
+_md4_round1 = tuple(zip(range(16), (3, 7, 11, 19) * 4))
+_md4_round2 = tuple(zip(
+    (0, 4, 8, 12, 1, 5, 9, 13, 2, 6, 10, 14, 3, 7, 11, 15),
+    (3, 5, 9, 13) * 4))
+_md4_round3 = tuple(zip(
+    (0, 8, 4, 12, 2, 10, 6, 14, 1, 9, 5, 13, 3, 11, 7, 15),
+    (3, 9, 11, 15) * 4))
+
+
+def _md4_digest(data):
+    """Pure-Python MD4 (RFC 1320), for when hashlib lacks it."""
+    message = bytearray(data)
+    bit_length = (len(message) * 8) & 0xffffffffffffffff
+    message.append(0x80)
+    message.extend(b"\0" * ((55 - len(data)) % 64))
+    message.extend(struct.pack("<Q", bit_length))
+    words = struct.unpack("<%dI" % (len(message) // 4), bytes(message))
+    h0, h1, h2, h3 = 0x67452301, 0xefcdab89, 0x98badcfe, 0x10325476
+    for offset in range(0, len(words), 16):
+        x = words[offset:offset + 16]
+        a, b, c, d = h0, h1, h2, h3
+        for k, s in _md4_round1:
+            t = (a + ((b & c) | (~b & d)) + x[k]) & 0xffffffff
+            a, b, c, d = d, ((t << s) | (t >> (32 - s))) & 0xffffffff, b, c
+        for k, s in _md4_round2:
+            t = (a + ((b & c) | (b & d) | (c & d)) + x[k] +
+                 0x5a827999) & 0xffffffff
+            a, b, c, d = d, ((t << s) | (t >> (32 - s))) & 0xffffffff, b, c
+        for k, s in _md4_round3:
+            t = (a + (b ^ c ^ d) + x[k] + 0x6ed9eba1) & 0xffffffff
+            a, b, c, d = d, ((t << s) | (t >> (32 - s))) & 0xffffffff, b, c
+        h0 = (h0 + a) & 0xffffffff
+        h1 = (h1 + b) & 0xffffffff
+        h2 = (h2 + c) & 0xffffffff
+        h3 = (h3 + d) & 0xffffffff
+    return struct.pack("<4I", h0, h1, h2, h3)
+
+
+def _hashlib_md4_digest(data):
+    return hashlib.new("md4", data).digest()
+
+
+try:
+    hashlib.new("md4")
+    md4_digest = _hashlib_md4_digest
+except ValueError:
+    # OpenSSL 3 only provides MD4 in its legacy provider.
+    md4_digest = _md4_digest
+
+
+def md4_is_native():
+    """Return true if MD4 digests are computed by hashlib, not in Python."""
+    return md4_digest is _hashlib_md4_digest
+
+
+# Each byte is split into nibbles, and each block into spans short enough
+# that Adler-32 sums of a nibble plane cannot wrap modulo 65521.
+_low_nibbles = bytes(bytearray(c & 0xf for c in range(256)))
+_high_nibbles = bytes(bytearray(c >> 4 for c in range(256)))
+_adler_span = 64
+
+
+def rolling_sums(data, blocksize):
+    """Return the rolling checksum of each whole block in data.
+
+    For a block c of length n, zsync's rolling checksum is the pair of
+    sum(c[i]) and sum((n - i) * c[i]), each modulo 2^16.  Adler-32 computes
+    the same two sums modulo 65521, and is exact if they are small enough,
+    so this Adler-32s each span of each nibble plane and combines the
+    results rather than looping over every byte in Python.
+    """
+    sums = []
+    planes = (
+        (1, data.translate(_low_nibbles)),
+        (16, data.translate(_high_nibbles)),
+    )
+    for start in range(0, len(data) - blocksize + 1, blocksize):
+        end = start + blocksize
+        a = b = 0
+        for scale, plane in planes:
+            for offset in range(start, end, _adler_span):
+                span = plane[offset:min(offset + _adler_span, end)]
+                adler = zlib.adler32(span) & 0xffffffff
+                # Adler-32 starts its first sum at 1, and adds it to the
+                # second after every byte.
+                span_a = (adler & 0xffff) - 1
+                span_b = (adler >> 16) - len(span)
+                a += scale * span_a
+                b += scale * (span_b + (end - offset - len(span)) * span_a)
+        sums.append(struct.pack(">HH", a & 0xffff, b & 0xffff))
+    return sums
+
+
+def _log(n):
+    return math.log(n) if n > 0 else float("-inf")
+
+
+def _ceil(x):
+    return x if math.isinf(x) else int(math.ceil(x))
+
+
+def hash_lengths(length, blocksize):
+    """Return (seq_matches, rsum_bytes, checksum_bytes) as zsyncmake does."""
+    seq_matches = 2 if length > blocksize else 1
+    blocks = 1 + length // blocksize
+    rsum_bytes = _ceil(
+        ((_log(length) + _log(blocksize)) / math.log(2) - 8.6) /
+        seq_matches / 8)
+    rsum_bytes = int(min(max(rsum_bytes, 2), 4))
+    checksum_bytes = _ceil(
+        (20 + (_log(length) + _log(blocks)) / math.log(2)) /
+        seq_matches / 8)
+    checksum_bytes_min = int((7.9 + (20 + _log(blocks) / math.log(2))) / 8)
+    if not checksum_bytes > checksum_bytes_min:
+        checksum_bytes = checksum_bytes_min
+    checksum_bytes = int(min(checksum_bytes, 16))
+    return seq_matches, rsum_bytes, checksum_bytes
+
+
+class ZsyncMetafile:
+    """Incrementally compute a zsync metafile.
+
+    This has the same update interface as hashlib objects, so it can be fed
+    from a read loop that is also computing other checksums.  The input
+    length need not be known in advance.
+    """
+
+    def __init__(self, blocksize=2048):
+        self.blocksize = blocksize
+        self.length = 0
+        self.sha1 = hashlib.sha1()
+        self.partial = b""
+        self.block_sums = bytearray()
+
+    def _block_sums(self, data):
+        """Return the checksums of each whole block in data."""
+        block_sums = bytearray()
+        blocksize = self.blocksize
+        for offset, rsum in zip(
+                range(0, len(data), blocksize),
+                rolling_sums(data, blocksize)):
+            block_sums.extend(rsum)
+            block_sums.extend(md4_digest(data[offset:offset + blocksize]))
+        return block_sums
+
+    def update(self, data):
+        self.length += len(data)
+        self.sha1.update(data)
+        if self.partial:
+            data = self.partial + data
+        end = len(data) - len(data) % self.blocksize
+        self.block_sums.extend(self._block_sums(data))
+        self.partial = data[end:]
+
+    def headers(self, filename, url, mtime=None):
+        """Return the metafile headers as a list of (name, value) pairs."""
+        seq_matches, rsum_bytes, checksum_bytes = hash_lengths(
+            self.length, self.blocksize)
+        headers = [("zsync", zsync_version), ("Filename", filename)]
+        if mtime is not None:
+            headers.append((
+                "MTime",
+                time.strftime(
+                    "%a, %d %b %Y %H:%M:%S +0000", time.gmtime(mtime))))
+        headers.extend([
+            ("Blocksize", str(self.blocksize)),
+            ("Length", str(self.length)),
+            ("Hash-Lengths",
+             "%d,%d,%d" % (seq_matches, rsum_bytes, checksum_bytes)),
+            ("URL", url),
+            ("SHA-1", self.sha1.hexdigest()),
+        ])
+        return headers
+
+    def getvalue(self, filename, url, mtime=None):
+        """Return the complete metafile as bytes."""
+        _, rsum_bytes, checksum_bytes = hash_lengths(
+            self.length, self.blocksize)
+        block_sums = self.block_sums
+        if self.partial:
+            block_sums = block_sums + self._block_sums(
+                self.partial + b"\0" * (self.blocksize - len(self.partial)))
+        output = bytearray()
+        for name, value in self.headers(filename, url, mtime=mtime):
+            output.extend(("%s: %s\n" % (name, value)).encode("UTF-8"))
+        output.extend(b"\n")
+        for offset in range(0, len(block_sums), 20):
+            output.extend(
+                block_sums[offset + 4 - rsum_bytes:offset + 4 +
+                           checksum_bytes])
+        return bytes(output)
+
+    def write(self, path, filename, url, mtime=None):
+        """Atomically write the metafile to path."""
+        with open("%s.new" % path, "wb") as metafile:
+            metafile.write(self.getvalue(filename, url, mtime=mtime))
+        os.rename("%s.new" % path, path)
+
+
+def make_zsync_metafile(infile, outfile, url, blocksize=2048):
+    """Make a zsync metafile for infile, like "zsyncmake -Z"."""
+    reader = FanoutReader(infile)
+    metafile = reader.add("zsync", ZsyncMetafile(blocksize=blocksize))
+    reader.run()
+    mtime = os.stat(infile).st_mtime
+    metafile.write(outfile, os.path.basename(infile), url, mtime=int(mtime))